@@ -0,0 +1,3 @@
+'''Micro-benchmarks for distdb and bhindex.
+
+Run from the source directory, IE `python -m benchmarks.concurrent_ls`.'''
@@ -0,0 +1,51 @@
+'''Compares the storage backends on the same workload.
+
+The difference between a file-backed and an in-memory SQLite DB is storage latency,
+while the pure-Python MemoryDB shows the overhead of the DB interface itself.'''
+from argparse import ArgumentParser
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+from uuid import uuid4
+
+from distdb import DB, Key, MemoryDB
+from distdb.database import shared_memory
+
+from .ls import FIELDS, ls_dirent, ls_scan, measure
+from .synthetic import populate
+
+
+def backends(tmpdir):
+    yield 'file', lambda: DB(path.join(tmpdir, 'bench.sqlite'))
+    yield 'memory', lambda: DB(shared_memory(uuid4().hex))
+    yield 'dict', MemoryDB
+
+
+def query(db, dirid):
+    return db.query(Key('bh_availability').startswith(u'-1'), fields=FIELDS)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--dirs', type=int, default=50)
+    parser.add_argument('--files', type=int, default=200, help="Files per directory")
+    parser.add_argument('--rounds', type=int, default=100, help="Operations per method")
+    args = parser.parse_args()
+
+    tmpdir = mkdtemp()
+    try:
+        print "%-8s %12s %12s %12s %12s" % ("backend", "populate/s", "ls_dirent/s", "ls_scan/s", "query/s")
+        for name, open_db in backends(tmpdir):
+            db = open_db()
+            start = time()
+            dirids = populate(db, args.dirs, args.files)
+            populated = args.dirs * (args.files + 1) / (time() - start)
+            rates = [measure(ls, db, dirids, args.rounds) for ls in (ls_dirent, ls_scan, query)]
+            print "%-8s %12.1f %12.1f %12.1f %12.1f" % ((name, populated) + tuple(rates))
+    finally:
+        rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+'''Directory listing throughput from multiple threads, while a sync import is running.
+
+Compares reads through the shared, locked connection against per-thread read connections.'''
+from argparse import ArgumentParser
+from itertools import islice
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event, Thread
+from time import time
+
+from distdb import DB, Transaction
+
+from .synthetic import populate, updates
+
+CHUNK = 1024
+
+
+def ls(db, dirid):
+    children = db.dir_children([dirid], fields=('directory', 'xt', 'bh_availability'))
+    return sum(1 for _ in children)
+
+
+def importer(db, stop):
+    '''Applies chunks of updates the way the SyncWriter does'''
+    source = updates(10 ** 9)
+    applied = 0
+    while not stop.is_set():
+        with db.lock, db.transaction(Transaction.IMMEDIATE) as t:
+            for obj, key, values in islice(source, CHUNK):
+                t.update_attr(obj, key, values)
+                applied += 1
+    return applied
+
+
+def lister(db, dirids, stop, result):
+    count = 0
+    while not stop.is_set():
+        ls(db, dirids[count % len(dirids)])
+        count += 1
+    result.append(count)
+
+
+def run(db_path, dirids, threads, duration, read_pool):
+    db = DB(db_path, read_pool=read_pool)
+    stop = Event()
+    results = list()
+    imported = list()
+    workers = [Thread(target=lister, args=(db, dirids, stop, results)) for _ in range(threads)]
+    workers.append(Thread(target=lambda: imported.append(importer(db, stop))))
+    start = time()
+    for w in workers:
+        w.start()
+    stop.wait(duration)
+    stop.set()
+    for w in workers:
+        w.join()
+    elapsed = time() - start
+    print "read_pool=%-5s  %6.1f ls/s  %8.1f imported updates/s" % (
+        read_pool, sum(results) / elapsed, sum(imported) / elapsed)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--dirs', type=int, default=50)
+    parser.add_argument('--files', type=int, default=200, help="Files per directory")
+    parser.add_argument('--threads', type=int, default=4, help="Concurrent listing threads")
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds per run")
+    args = parser.parse_args()
+
+    tmpdir = mkdtemp()
+    try:
+        db_path = path.join(tmpdir, 'bench.sqlite')
+        dirids = populate(DB(db_path), args.dirs, args.files)
+        for read_pool in (False, True):
+            run(db_path, dirids, args.threads, args.duration, read_pool)
+    finally:
+        rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
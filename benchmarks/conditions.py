@@ -0,0 +1,84 @@
+'''Queries combining conditions on several keys, or on missing keys, on a large DB.
+
+Compares the correlated EXISTS-probes conditions compile to, with the uncorrelated
+IN-subqueries used before, which materialized every object with the key.'''
+from argparse import ArgumentParser
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from distdb import DB, Key, ObjId
+from distdb.query import AndCondition, ConditionExpr, KeyMissing, Query, _mkset
+
+from .synthetic import populate
+
+
+class NotIn(KeyMissing):
+    '''How KeyMissing compiled before'''
+    def apply(self):
+        key, = self
+        key_expr, key_params = Query(('objid',), key.any()).apply()
+        return ConditionExpr((), "objid NOT IN (%s)" % key_expr, key_params, False)
+
+
+class NestedIn(AndCondition):
+    '''How AndCondition compiled before'''
+    def expression_for(self, res, x):
+        sources, expression, params, condition_on_key = x.apply()
+        if res.condition_on_key and condition_on_key:
+            cond, params = Query(('objid',), x).apply()
+            expression = '(objid IN (%s))' % cond
+            sources = _mkset(())
+        else:
+            expression = "(%s)" % expression
+        return ConditionExpr(sources, expression, params, condition_on_key)
+
+
+def cases(db):
+    filesize = db._query_single("SELECT value FROM list NATURAL JOIN map NATURAL JOIN key "
+                                "WHERE key = 'filesize' LIMIT 1")
+    xt = db._query_single("SELECT obj FROM obj WHERE obj >= 'tree:tiger:' LIMIT 1")
+    yield 'value and key', (Key('filesize') == filesize, Key('xt').any())
+    yield 'obj and missing', (ObjId == xt, Key('bh_availability').missing())
+    yield 'keys and prefix', (Key('xt').any(), Key('filesize').any(), Key('directory').startswith(u'dir:'))
+    yield 'unchecked', (ObjId.startswith('tree:tiger:'), Key('bh_availability').missing())
+
+
+def before(criteria):
+    def rewrite(crit):
+        if isinstance(crit, KeyMissing):
+            return NotIn(*crit)
+        return crit
+    return (NestedIn(*(rewrite(c) for c in criteria)),)
+
+
+def measure(db, criteria, rounds):
+    start = time()
+    for _ in xrange(rounds):
+        sum(1 for _ in db.query_ids(criteria))
+    return (time() - start) / rounds
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--dirs', type=int, default=5000)
+    parser.add_argument('--files', type=int, default=200, help="Files per directory")
+    parser.add_argument('--rounds', type=int, default=3, help="Runs per query")
+    args = parser.parse_args()
+
+    tmpdir = mkdtemp()
+    try:
+        db_path = path.join(tmpdir, 'bench.sqlite')
+        populate(DB(db_path), args.dirs, args.files)
+        db = DB(db_path)
+        print "%-16s %12s %12s" % ("query", "IN (s)", "EXISTS (s)")
+        for name, criteria in cases(db):
+            print "%-16s %12.4f %12.4f" % (name, measure(db, before(criteria), args.rounds),
+                                          measure(db, criteria, args.rounds))
+    finally:
+        rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+'''Single directory listings, scanning directory-values against the dirent index.'''
+from argparse import ArgumentParser
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from distdb import DB, Key, Sort
+
+from .synthetic import populate
+
+FIELDS = ('directory', 'xt', 'bh_availability')
+
+
+def ls_scan(db, dirid):
+    '''How Directory.ls listed directories before the dirent table'''
+    return db.query_keyed(Key('directory').startswith(u'%s/' % dirid), key="+directory",
+                          sortmeth=Sort.split('/'), fields=FIELDS)
+
+
+def ls_dirent(db, dirid):
+    return db.dir_children([dirid], fields=FIELDS)
+
+
+def measure(ls, db, dirids, rounds):
+    start = time()
+    for i in xrange(rounds):
+        sum(1 for _ in ls(db, dirids[i % len(dirids)]))
+    return rounds / (time() - start)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--dirs', type=int, default=200)
+    parser.add_argument('--files', type=int, default=200, help="Files per directory")
+    parser.add_argument('--rounds', type=int, default=200, help="Listings per method")
+    args = parser.parse_args()
+
+    tmpdir = mkdtemp()
+    try:
+        db_path = path.join(tmpdir, 'bench.sqlite')
+        dirids = populate(DB(db_path), args.dirs, args.files)
+        db = DB(db_path)
+        for ls in (ls_scan, ls_dirent):
+            print "%-10s %8.1f ls/s" % (ls.__name__, measure(ls, db, dirids, args.rounds))
+    finally:
+        rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
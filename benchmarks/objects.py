@@ -0,0 +1,61 @@
+'''Memory and time used by objects loaded from the DB, for mutable and read-only objects.'''
+from argparse import ArgumentParser
+from inspect import getmro
+from os import path
+from shutil import rmtree
+from sys import getsizeof
+from tempfile import mkdtemp
+from time import time
+
+from distdb import DB, Key
+
+from .synthetic import populate
+
+
+def deep_size(x, seen):
+    '''Bytes used by x and everything it references, not already in seen'''
+    if id(x) in seen:
+        return 0
+    seen.add(id(x))
+    size = getsizeof(x)
+    if isinstance(x, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in x.iteritems())
+    elif isinstance(x, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in x)
+    elif not isinstance(x, basestring):
+        size += deep_size(getattr(x, '__dict__', None), seen)
+        for cls in getmro(x.__class__):
+            for slot in cls.__dict__.get('__slots__', ()):
+                size += deep_size(getattr(x, slot, None), seen)
+    return size
+
+
+def load(db, readonly):
+    start = time()
+    objs = list(db.query(Key('xt').any(), readonly=readonly))
+    elapsed = time() - start
+    seen = set([id(None)])
+    return len(objs), deep_size(objs, seen) - getsizeof(objs), elapsed
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--dirs', type=int, default=50)
+    parser.add_argument('--files', type=int, default=200, help="Files per directory")
+    args = parser.parse_args()
+
+    tmpdir = mkdtemp()
+    try:
+        db_path = path.join(tmpdir, 'bench.sqlite')
+        populate(DB(db_path), args.dirs, args.files)
+        db = DB(db_path)
+        for readonly in (False, True):
+            count, size, elapsed = load(db, readonly)
+            print "%-9s %8.1f bytes/object %8.1f objects/s" % (
+                readonly and "read-only" or "mutable", float(size) / count, count / elapsed)
+    finally:
+        rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
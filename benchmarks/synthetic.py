@@ -0,0 +1,46 @@
+'''Generators for synthetic indexes, shaped like a real bhindex database'''
+from base64 import b32encode
+from os import urandom
+from random import Random
+
+from distdb import Object, Transaction
+from distdb.obj import TimedValues
+
+
+def tiger_id(rnd):
+    return u'tree:tiger:' + unicode(b32encode(''.join(chr(rnd.randint(0, 255)) for _ in xrange(24))).rstrip('='))
+
+
+def populate(db, dirs=100, files_per_dir=200, seed=0, t=1):
+    '''Fills db with `dirs` directories under the root, each with `files_per_dir` files.
+
+    Returns the list of directory object ids.'''
+    rnd = Random(seed)
+    dirids = list()
+    with db.transaction(Transaction.IMMEDIATE) as tr:
+        for d in xrange(dirs):
+            dirid = u'dir:%s' % b32encode(urandom(10))
+            dirids.append(dirid)
+            tr.update(Object(dirid, {
+                u'directory': TimedValues(u'dir:/dir%d' % d, t),
+                u'bh_availability': TimedValues(u'600', t + 3600 * 24 * 365),
+            }))
+            for f in xrange(files_per_dir):
+                xt = tiger_id(rnd)
+                tr.update(Object(xt, {
+                    u'directory': TimedValues(u'%s/file%d.ext' % (dirid, f), t),
+                    u'xt': TimedValues(xt, t),
+                    u'filesize': TimedValues(unicode(rnd.randint(1, 2**32)), t),
+                    u'bh_availability': TimedValues(unicode(rnd.randint(-3000, 3000)), t + 3600 * 24 * 365),
+                }))
+    return dirids
+
+
+def updates(count, seed=1, t=2):
+    '''Yields (obj, key, TimedValues) as received from a syncing peer'''
+    rnd = Random(seed)
+    for i in xrange(count):
+        xt = tiger_id(rnd)
+        yield xt, u'xt', TimedValues(xt, t)
+        yield xt, u'directory', TimedValues(u'dir:imported/file%d' % i, t)
+        yield xt, u'filesize', TimedValues(unicode(rnd.randint(1, 2**32)), t)
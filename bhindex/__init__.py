@@ -1,5 +1,5 @@
 import logging
-from . import add, cat, config, fusefs, links, scanner, syncer, tree, vacuum
+from . import add, cat, config, fusefs, links, scanner, snapshot, stats, syncer, tree, vacuum
 from .util import noop_context_manager
 
 
@@ -9,7 +9,7 @@ def main(args=None):
         args = argv[1:]
 
     from argparse import ArgumentError, ArgumentParser
-    from distdb import DB
+    from distdb import DB, QueryStats, WALCheckpointer
 
     cfg = config.read()
 
@@ -40,9 +40,18 @@ def main(args=None):
     MV = subparsers.add_parser('mv', help='Move a file or directory in the bithorde tree')
     tree.prepare_mv_args(MV, cfg)
 
+    Search = subparsers.add_parser('search', help='Find files in BHIndex by name')
+    tree.prepare_search_args(Search, cfg)
+
     Scanner = subparsers.add_parser('update', help='Scans for asset-availability in bithorde and updates DB')
     scanner.prepare_args(Scanner, cfg)
 
+    Snapshot = subparsers.add_parser('snapshot', help='Exports or imports a snapshot of the DB, for bootstrapping new nodes')
+    snapshot.prepare_args(Snapshot, cfg)
+
+    Stats = subparsers.add_parser('stats', help='Shows statistics about the DB')
+    stats.prepare_args(Stats, cfg)
+
     Syncer = subparsers.add_parser('syncer', help='Runs online synchronization with other bhindex')
     syncer.prepare_args(Syncer, cfg)
 
@@ -58,7 +67,13 @@ def main(args=None):
         logging.basicConfig(level=lvl, format="%(levelname)-8s %(asctime)-15s <%(name)s> %(message)s")
         logging.getLogger().setLevel(lvl)
 
-        db = DB(args.db)
+        slow_query_ms = cfg.get('DB', 'slow_query_ms')
+        query_stats = slow_query_ms and QueryStats(QueryStats.path_for(args.db), float(slow_query_ms) / 1000)
+        profile = config.db_profile(cfg)
+        db = DB(args.db, object_cache=cfg.getint('DB', 'object_cache'), query_stats=query_stats or None,
+                profile=profile)
+        if profile.get('checkpoint_interval'):
+            WALCheckpointer(db, profile['checkpoint_interval']).start()
 
         ctx, main_args = args.setup(args, cfg, db)
         if args.suid:
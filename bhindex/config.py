@@ -5,6 +5,8 @@ from warnings import warn
 from ConfigParser import SafeConfigParser as ConfigParser, NoOptionError
 from socket import gethostname
 
+from distdb import profiles
+
 CODE_PATH = path.dirname(path.dirname(path.abspath(__file__)))
 if path.exists(path.join(CODE_PATH, 'bhindex.py')):
     BHINDEX_DEFAULT_PATH = CODE_PATH
@@ -16,6 +18,9 @@ BHINDEX_PATH = environ.get('BHINDEX_PATH', BHINDEX_DEFAULT_PATH)
 CONFIG_DEFAULTS = {
     "DB": {
         "file": path.join(BHINDEX_PATH, 'bhindex.sqlite'),
+        "object_cache": "0",
+        "profile": "default",
+        "slow_query_ms": "",
     },
     "BITHORDE": {
         "fusedir": "/tmp/bhfuse",
@@ -30,8 +35,10 @@ CONFIG_DEFAULTS = {
     "LIVESYNC": {
         "name": gethostname(),
         "db_poll_interval": "1.0",
+        "vacuum_interval": "0",
         "connect": "",
         "port": "4000",
+        "compress": "true",
     },
 }
 
@@ -94,6 +101,13 @@ def locate_config():
     raise ConfigNotFoundError("Could not locate config file neither in %s nor in $BHINDEX_CONF" % '|'.join(CONFIG_LOCATIONS))
 
 
+def db_profile(config):
+    '''Returns the DB performance profile selected in [DB], with any of its options overridden'''
+    overrides = dict((option, config.get('DB', option))
+                     for option in profiles.OPTIONS if config.has_option('DB', option))
+    return profiles.get(config.get('DB', 'profile'), **overrides)
+
+
 def read(configfile=None):
     if configfile is None:
         configfile = locate_config()
@@ -31,30 +31,30 @@ class Scanner(object):
         self.log = getLogger('scanner')
         self.last_unchecked_scan = 0
 
-    def pick_stale(self, expires_before):
+    def pick_stale(self, expires_before, limit=MAX_BATCH):
         q = self.db.query_keyed((
             ObjId.startswith('tree:tiger:'),
             Key('bh_availability').timed_before(expires_before),
         ), '+bh_availability', fields=self.fields,
-            sortmeth=Sort.timestamp)
+            sortmeth=Sort.timestamp, limit=limit)
         for _, obj in q:
             yield obj.getitem('bh_availability').t, obj.id
 
-    def pick_unchecked(self):
+    def pick_unchecked(self, limit=MAX_BATCH):
         q = self.db.query_ids((
             ObjId.startswith('tree:tiger:'),
             Key('bh_availability').missing(),
-        ))
+        ), limit=limit)
         for id in q:
             yield 0, id
 
     def pick_batch(self, expires_before, limit=MAX_BATCH):
-        objs = self.pick_stale(expires_before)
+        objs = self.pick_stale(expires_before, limit)
 
-        # pick_unchecked is slow, and unlikely to yield anything
+        # pick_unchecked probes every asset, and is unlikely to yield anything
         # so only run it in big intervals
         if self.last_unchecked_scan < expires_before - UNCHECKED_SCAN_INTERVAL:
-            objs = chain(self.pick_unchecked(), objs)
+            objs = chain(self.pick_unchecked(limit), objs)
             self.last_unchecked_scan = expires_before
 
         return islice(objs, limit)
@@ -70,7 +70,7 @@ class Scanner(object):
             batch = sorted(self._fudged_batch(limit))
             if batch:
                 sleep(max(batch[0][0] - limit, MIN_SLEEP))
-                self.run_batch((self.db[id] for _, id in batch))
+                self.run_batch(self.db.get_many(id for _, id in batch))
             else:
                 sleep(MIN_SLEEP)
 
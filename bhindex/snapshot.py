@@ -0,0 +1,32 @@
+from __future__ import absolute_import
+
+import logging
+import sys
+
+from distdb import snapshot
+
+log = logging.getLogger("snapshot")
+
+
+def prepare_args(parser, config):
+    parser.add_argument("action", choices=("export", "import"),
+                        help="Export this DB, or bootstrap an empty DB from an exported snapshot")
+    parser.add_argument("file", help="Snapshot file, or '-' for stdout/stdin")
+    parser.set_defaults(main=main)
+
+
+def main(args, config, db):
+    if args.action == "export":
+        f = sys.stdout if args.file == '-' else open(args.file, 'wb')
+        with f:
+            serial = snapshot.export(db, f, config.get('LIVESYNC', 'name'))
+        log.info("Exported snapshot up to #%d", serial)
+    else:
+        f = sys.stdin if args.file == '-' else open(args.file, 'rb')
+        with f:
+            try:
+                name, serial = snapshot.restore(db, f)
+            except snapshot.SnapshotError, e:
+                log.error("Failed to import snapshot: %s", e)
+                return
+        log.info("Imported snapshot of %s up to #%d", name, serial)
@@ -0,0 +1,72 @@
+from __future__ import absolute_import
+
+from time import time
+
+from distdb import Group, Key, ObjId, QueryStats
+from distdb.instrument import CACHE_STATS, percentile
+
+ASSETS = ObjId.startswith('tree:tiger:')
+GB = 1024.0 * 1024 * 1024
+
+
+def prepare_args(parser, config):
+    parser.add_argument("--queries", action="store_true", dest="queries", default=False,
+                        help="Show the most expensive SQL statements and the object cache hit rate, " +
+                             "as collected with DB.slow_query_ms")
+    parser.add_argument("--top", metavar="N", type=int, dest="top", default=10,
+                        help="Number of statements or directories to show")
+    parser.set_defaults(main=main)
+
+
+def print_summary(db, top, t=None):
+    '''Prints totals for the whole index, each aggregated by the DB in one pass'''
+    available = (ASSETS, Key('bh_availability').timed_after(t or time()), Key('bh_availability') > 0)
+    objects, = next(iter(db.aggregate(()).count()))
+    assets, size = next(iter(db.aggregate(ASSETS).count().sum(Key('filesize'))))
+    available_assets, available_size = next(iter(db.aggregate(available).count().sum(Key('filesize'))))
+
+    print "Objects:   %10d" % objects
+    print "Assets:    %10d %10.1f GB" % (assets, (size or 0) / GB)
+    print "Available: %10d %10.1f GB" % (available_assets, (available_size or 0) / GB)
+
+    directories = db.aggregate(available).group_by(Key('directory'), Group.prefix('/')).count().sum(Key('filesize'))
+    largest = sorted(directories, key=lambda (_, count, size): size or 0, reverse=True)[:top]
+    if largest:
+        print "Directories with the most available data:"
+    for dirid, count, size in largest:
+        paths = db.dir_paths(dirid)
+        print "%10d %10.1f GB  %s" % (count, (size or 0) / GB, '/'.join(min(paths)) if paths else dirid)
+
+
+def print_cache(cache):
+    lookups = cache["hits"] + cache["misses"]
+    print "Object cache: %d hits %d misses (%.1f%% hit rate) %d evictions %d invalidations" % (
+        cache["hits"], cache["misses"], lookups and cache["hits"] * 100.0 / lookups,
+        cache["evictions"], cache["invalidations"])
+
+
+def print_queries(stats, top):
+    stats = dict(stats)
+    cache = stats.pop(CACHE_STATS, None)
+    if not stats and not cache:
+        print "No query statistics collected. Enable them with slow_query_ms in the [DB] config."
+        return
+    if cache:
+        print_cache(cache)
+
+    worst = sorted(stats.iteritems(), key=lambda (_, entry): entry["time"], reverse=True)[:top]
+    for query, entry in worst:
+        count = entry["count"]
+        print "%8.2fs total %7d calls %8.2fms avg %6dms p95 %8.2fms max %8.1f rows/call" % (
+            entry["time"], count, entry["time"] * 1000 / count, percentile(entry, 0.95),
+            entry["max"] * 1000, float(entry["rows"]) / count)
+        print "    %s" % query
+        for line in (entry["plan"] or "").splitlines():
+            print "      %s" % line
+
+
+def main(args, config, db):
+    if args.queries:
+        print_queries(QueryStats.load(QueryStats.path_for(db.path)), args.top)
+    else:
+        print_summary(db, args.top)
@@ -1,4 +1,7 @@
 from distdb.syncer import Syncer
+from thread_io import spawn
+
+from . import vacuum
 
 
 def parse_addr(addr):
@@ -30,6 +33,11 @@ def main(args, config, db):
         'port': int(sync_config['port']),
         'connect_addresses': connect_addresses,
         'db_poll_interval': float(sync_config['db_poll_interval']),
+        'compress': config.getboolean('LIVESYNC', 'compress'),
     }
 
+    vacuum_interval = float(config.get('LIVESYNC', 'vacuum_interval'))
+    if vacuum_interval:
+        spawn(vacuum.run_periodically, db.clone(), vacuum_interval)
+
     Syncer(db, **sync_config).wait()
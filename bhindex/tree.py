@@ -3,7 +3,7 @@ from os.path import normpath as osnormpath
 from time import time
 from warnings import warn
 
-from distdb import Object, Key, Sort
+from distdb import Key, Object
 from .bithorde import Identifiers
 from .util import hasValidStatus, set_new_availability, updateFolderAvailability
 log = getLogger('tree')
@@ -88,27 +88,19 @@ class Directory(Node):
             yield name, self._map(children, name)
 
     def _ls(self, t):
-        dirids = set("%s" % dirobj.id for dirobj in self.objs)
-        children = self.db.query_keyed(
-            Key('directory').startswith("%s/" % d for d in dirids), key="+directory",
-            sortmeth=Sort.split('/'), fields=('directory', 'xt', 'bh_availability'),
-        )
-        for dirent, child in _filterAvailable(children, t):
-            try:
-                dir, name = split_directory_entry(dirent)
-            except ValueError:
-                warn("Malformed directory for %s: %s" % (child.id, dirent))
-                continue
-            if dir in dirids:
-                yield name, child
+        dirids = set(dirobj.id for dirobj in self.objs)
+        # Entries without a name are not indexed as children
+        for dirid in dirids:
+            for child in self.db.query(Key('directory') == u'%s/' % dirid, fields=('directory',)):
+                warn("Malformed directory for %s: %s/" % (child.id, dirid))
+        children = self.db.dir_children(dirids, fields=('directory', 'xt', 'bh_availability'))
+        return _filterAvailable(children, t)
 
     def __iter__(self):
         return self.ls()
 
     def __getitem__(self, key):
-        objs = list()
-        for obj in self.objs:
-            objs += self.db.query(Key('directory') == "%s/%s" % (obj.id, key))
+        objs = [obj for _, obj in self.db.dir_children((obj.id for obj in self.objs), name=key)]
         if objs:
             return self._map(objs, key)
         else:
@@ -228,7 +220,7 @@ class Filesystem(object):
             except ValueError:
                 warn("Malformed directory for %s: %s" % (obj.id, dirent))
             else:
-                res |= set(path + (name,) for path in self.paths_for(self.db[dir]))
+                res |= set(path + (name,) for path in self.db.dir_paths(dir))
         return res
 
     def root(self):
@@ -315,6 +307,20 @@ def ls_main(args, config, db):
                 print "%s -> %s" % (name, node.ids())
 
 
+def prepare_search_args(parser, config):
+    parser.add_argument("words", nargs='+', help="Words (or beginnings of words) in the file name")
+    parser.add_argument("--limit", type=int, default=20, help="Max number of files to show")
+    parser.set_defaults(main=search_main)
+
+
+def search_main(args, config, db):
+    fs = Filesystem(db)
+    words = u" ".join(unicode(word, 'utf8') for word in args.words)
+    for obj in db.search(words, limit=args.limit, fields=('directory',)):
+        for path in sorted(fs.paths_for(obj)):
+            print "/".join(path)
+
+
 def prepare_mv_args(parser, config):
     parser.add_argument("source", help="Source path to move. IE 'dir/file'")
     parser.add_argument("destination", help="Path and name to move the file to. IE 'dir/file'")
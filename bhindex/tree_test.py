@@ -1,10 +1,11 @@
 # -*- coding: utf8 -*-
 
 from nose.tools import *
-from warnings import catch_warnings
+from warnings import catch_warnings, simplefilter
 
 from .tree import *
 from distdb import DB, Object
+from distdb.memory import MemoryDB
 from distdb.obj import TimedValues
 
 P = Path
@@ -35,7 +36,7 @@ def test_Path():
 class TestFilesystem(object):
     def setup(self):
         xt = u'tree:tiger:ASDASDSADASDASDSADASDASDSADASDASDSADASD'
-        db = self.db = DB(':memory:')
+        db = self.db = self.make_db()
         with db.transaction() as t:
             self.d = t.update(Object(u"dir:some/dir", {
                 'directory': TimedValues(u"dir:/apa", 0),
@@ -50,6 +51,9 @@ class TestFilesystem(object):
             }))
         self.fs = Filesystem(db)
 
+    def make_db(self):
+        return DB(':memory:')
+
     def test_paths_for(self):
         assert_set_equal(self.fs.paths_for(self.d), fz((u"apa",)))
         assert_set_equal(self.fs.paths_for(self.d2), fz((u"apa",)))
@@ -71,9 +75,19 @@ class TestFilesystem(object):
 
         for o in broken:
             with catch_warnings(True) as w:
+                simplefilter("always")
                 assert_equal(self.fs.paths_for(o), set())
                 assert_equal(len(w), 1)
 
+    def test_ls_broken_direntry(self):
+        with self.fs.transaction() as t:
+            t.update(Object(u"broken", {u'directory': TimedValues(u"dir:/", 0)}))
+
+        with catch_warnings(True) as w:
+            simplefilter("always")
+            assert_not_in(u'', [name for name, _ in self.fs.root().ls(t=1)])
+            assert_equal(len(w), 1)
+
     def test_mkdir(self):
         self.fs.mkdir(P("Movies/Anime"))
         assert_is_instance(self.fs.lookup(P("Movies/Anime")), Directory)
@@ -159,3 +173,8 @@ class TestFilesystem(object):
         assert_set_equal(name_type_ids_set(self.fs.lookup(P('banan')).ls(t=1)), fz(
             (u'file', Directory, fz(f2.id,)),
         ))
+
+
+class TestMemoryFilesystem(TestFilesystem):
+    def make_db(self):
+        return MemoryDB()
@@ -1,8 +1,9 @@
-from time import time
+from time import sleep, time
 import logging
 
 from bhindex.util import validAvailability, Counter
 from distdb import Key
+from distdb.database import VACUUM_PAUSE
 
 log = logging.getLogger("vacuum")
 
@@ -10,6 +11,8 @@ log = logging.getLogger("vacuum")
 def prepare_args(parser, config):
     parser.add_argument("--wipe", metavar="SCORE", action="store", dest="wipe", type=int,
                         help="Wipe assets below negative SCORE availability. Typically '100000'")
+    parser.add_argument("--incremental", action="store_true", dest="incremental", default=False,
+                        help="Clean up in small steps, without blocking other users of the DB for long")
     parser.set_defaults(main=main)
 
 
@@ -19,7 +22,7 @@ def wipe(config, db, availability):
     total = Counter()
     wiped = Counter()
     with db.transaction() as tr:
-        for obj in db.query(Key('bh_availability').any()):
+        for obj in db.query(Key('bh_availability').any(), readonly=True):
             total.inc()
             if (validAvailability(obj, t) or 0) < availability:
                 tr.delete(obj, t)
@@ -28,8 +31,22 @@ def wipe(config, db, availability):
     log.info("Wiped %d objects out of %d (availability < %d)", wiped, total, availability)
 
 
+def run_periodically(db, interval):
+    '''Runs incremental vacuum every `interval` seconds, IE from the syncer daemon'''
+    while True:
+        sleep(interval)
+        try:
+            removed = dict()
+            for phase, count in db.vacuum_steps():
+                removed[phase] = removed.get(phase, 0) + count
+                sleep(VACUUM_PAUSE)
+            log.info("Incremental vacuum done: %s", ", ".join("%d %s" % (n, phase) for phase, n in sorted(removed.items())))
+        except Exception:
+            log.exception("Incremental vacuum failed")
+
+
 def main(args, config, db):
     if args.wipe:
         wipe(config, db, -args.wipe)
 
-    db.vacuum()
+    db.vacuum(incremental=args.incremental)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
-from database import DB, Transaction, AsyncCommitter
+from database import DB, Transaction, AsyncCommitter, WALCheckpointer
+from instrument import QueryStats
+from memory import MemoryDB
 from obj import Object
-from query import Key, ObjId, Sort
+from query import Group, Key, ObjId, Sort
 
 open = DB
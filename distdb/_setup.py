@@ -1,6 +1,33 @@
+from hashlib import sha1
+from itertools import groupby
+from logging import getLogger
+from sqlite3 import Binary, OperationalError
+
+log = getLogger('distdb')
+
+# Values of this key are "<parent obj>/<name>", and are indexed in the dirent table
+DIRECTORY_KEY = u'directory'
+
+
+def list_digest(values):
+    '''Canonical digest of a set of values, used to look up identical lists.
+
+    Each value is length-prefixed, so no values can be split or joined into others.'''
+    encoded = sorted(v.encode('utf-8') for v in values)
+    return Binary(sha1(''.join('%d:%s' % (len(v), v) for v in encoded)).digest())
+
+
+def split_dirent(value):
+    '''Returns (parent, name) of a directory-value, or None if malformed'''
+    parent, _, name = value.rpartition(u'/')
+    if parent and name:
+        return parent, name
+
+
 def create_DB(conn):
     with conn:
         conn.executescript("""
+        PRAGMA auto_vacuum = INCREMENTAL;
         PRAGMA journal_mode = WAL;
 
         CREATE TABLE IF NOT EXISTS obj (
@@ -26,7 +53,7 @@ def create_DB(conn):
             FOREIGN KEY (keyid) REFERENCES key (keyid),
             FOREIGN KEY (listid) REFERENCES list (listid)
         );
-        CREATE INDEX IF NOT EXISTS map_obj_values ON map (objid, listid);
+        CREATE INDEX IF NOT EXISTS map_obj_keys ON map (objid, keyid, listid);
         CREATE INDEX IF NOT EXISTS map_list ON map (listid);
         CREATE INDEX IF NOT EXISTS map_timestamp ON map (timestamp);
         CREATE INDEX IF NOT EXISTS map_key_timestamp ON map (keyid, timestamp);
@@ -40,8 +67,152 @@ def create_DB(conn):
         CREATE INDEX IF NOT EXISTS list_id ON list (listid);
         CREATE INDEX IF NOT EXISTS list_value ON list (value);
 
+        CREATE TABLE IF NOT EXISTS listhash (
+            listid INTEGER PRIMARY KEY AUTOINCREMENT,
+            digest BLOB UNIQUE NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS dirent (
+            parent_objid INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            child_objid INTEGER NOT NULL,
+            PRIMARY KEY (parent_objid, name, child_objid)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS dirent_child ON dirent (child_objid);
+
         CREATE TABLE IF NOT EXISTS sync_state (
             peername STRING PRIMARY KEY,
             last_received INTEGER NOT NULL
         );
+
+        CREATE TABLE IF NOT EXISTS vacuum_state (
+            phase TEXT PRIMARY KEY,
+            position INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS snapshot_state (
+            source STRING PRIMARY KEY,
+            serial INTEGER NOT NULL
+        );
         """)
+    migrate(conn)
+    ensure_name_index(conn)
+
+
+def _hash_lists(conn):
+    '''Builds listhash for existing lists, merging lists with identical content'''
+    rows = conn.execute("SELECT listid, value FROM list ORDER BY listid")
+    duplicates = list()
+    seen = dict()
+    for listid, items in groupby(rows, lambda row: row[0]):
+        digest = list_digest(value for _, value in items)
+        if str(digest) in seen:
+            duplicates.append((seen[str(digest)], listid))
+        else:
+            seen[str(digest)] = listid
+            conn.execute("INSERT INTO listhash (listid, digest) VALUES (?, ?)", (listid, digest))
+    for listid, duplicate in duplicates:
+        conn.execute("UPDATE map SET listid = ? WHERE listid = ?", (listid, duplicate))
+        conn.execute("DELETE FROM list WHERE listid = ?", (duplicate,))
+
+
+def _rehash_lists(conn):
+    '''Digests are length-prefixed, since values containing NUL collided with the lists
+    they split into'''
+    conn.execute("DELETE FROM listhash")
+    _hash_lists(conn)
+
+
+def _index_dirents(conn):
+    '''Fills dirent from existing directory-values'''
+    rows = conn.execute("SELECT objid, value FROM map NATURAL JOIN key NATURAL JOIN list WHERE key = ?",
+                        (DIRECTORY_KEY,)).fetchall()
+    for child, value in rows:
+        dirent = split_dirent(value)
+        if not dirent:
+            continue
+        parent, name = dirent
+        conn.execute("INSERT OR IGNORE INTO obj (obj) VALUES (?)", (parent,))
+        conn.execute("""INSERT OR IGNORE INTO dirent (parent_objid, name, child_objid)
+                        SELECT objid, ?, ? FROM obj WHERE obj = ?""", (name, child, parent))
+
+
+def _index_names(conn):
+    '''Creates the full-text index over directory entry names, one row per child
+    object. Without FTS5 in SQLite, search is not available, until ensure_name_index()
+    runs with a later SQLite.'''
+    if has_fts(conn):
+        return
+    if not _fts5_available(conn):
+        log.warning("Full-text search disabled: SQLite lacks FTS5")
+        return
+    conn.execute("CREATE VIRTUAL TABLE dirent_fts USING fts5(names)")
+    _fill_name_index(conn)
+
+
+def _fill_name_index(conn):
+    conn.execute("""INSERT INTO dirent_fts (rowid, names)
+                    SELECT child_objid, group_concat(name, ?) FROM dirent GROUP BY child_objid""", (u'\n',))
+
+
+def _fts5_available(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+    except OperationalError:
+        return False
+    conn.execute("DROP TABLE temp.fts5_probe")
+    return True
+
+
+def ensure_name_index(conn):
+    '''Creates the full-text index, if it was left out by migrations for lack of FTS5'''
+    if has_fts(conn) or not _fts5_available(conn):
+        return
+    conn.execute("BEGIN IMMEDIATE TRANSACTION")
+    try:
+        # Re-check inside the transaction, another process might have been first
+        if not has_fts(conn):
+            log.info("Full-text search enabled, indexing names")
+            conn.execute("CREATE VIRTUAL TABLE dirent_fts USING fts5(names)")
+            _fill_name_index(conn)
+    except:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def has_fts(conn):
+    return bool(conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'dirent_fts'").fetchone())
+
+
+def _drop_obj_values(conn):
+    '''map_obj_keys replaces map_obj_values, and also covers probes for a key of an object'''
+    conn.execute("DROP INDEX IF EXISTS map_obj_values")
+
+
+MIGRATIONS = [
+    _hash_lists,
+    _index_dirents,
+    _index_names,
+    _drop_obj_values,
+    _rehash_lists,
+]
+
+
+def _user_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    while _user_version(conn) < len(MIGRATIONS):
+        conn.execute("BEGIN IMMEDIATE TRANSACTION")
+        try:
+            # Re-read inside the transaction, another process might have been first
+            version = _user_version(conn)
+            if version < len(MIGRATIONS):
+                MIGRATIONS[version](conn)
+                conn.execute("PRAGMA user_version = %d" % (version + 1))
+        except:
+            conn.rollback()
+            raise
+        conn.commit()
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from threading import RLock
+
+
+class ObjectCache(object):
+    '''Bounded LRU-cache of object attributes, keyed by object id.
+
+    Entries are only stored if no invalidation happened since the caller
+    started loading them, as given by `generation`.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = RLock()
+        self.generation = 0
+        self.serial = None
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._entries = OrderedDict()
+
+    def get(self, id):
+        with self.lock:
+            try:
+                attrs = self._entries.pop(id)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[id] = attrs
+            self.hits += 1
+            return attrs
+
+    def put(self, id, attrs, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self._entries.pop(id, None)
+            self._entries[id] = attrs
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, ids):
+        with self.lock:
+            self.generation += 1
+            for id in ids:
+                if self._entries.pop(id, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
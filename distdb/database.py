@@ -1,15 +1,90 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import groupby, islice
+from operator import itemgetter
 import inspect
+import logging
+import os
 import sqlite3
-from time import time
-from threading import Event, Thread, RLock
+from time import sleep, time
+from thread import get_ident
+from threading import Condition as ThreadCondition, Event, Lock, Thread, RLock, local
 
-from obj import Object, TimedValues
-from query import Key as QueryKey, Condition, Query, Sort
-from _setup import create_DB
+from cache import ObjectCache
+from instrument import STATEMENT_CACHE
+import profiles
+from obj import Object, ReadOnlyObject, TimedValues
+from query import Key as QueryKey, Aggregate, Condition, Query, Sort
+from _setup import DIRECTORY_KEY, create_DB, has_fts, list_digest, split_dirent
+
+log = logging.getLogger('distdb')
 
 # Pointers to empty list will be wiped after 30 days.
 DEFAULT_GRACE = 3600 * 24 * 30
 
+# Number of objects loaded per round-trip in DB.get_many
+GET_MANY_BATCH = 256
+
+# Paths deeper than this (IE directory cycles) are ignored by DB.dir_paths
+MAX_DIR_DEPTH = 256
+
+# Default number of results from DB.search
+SEARCH_LIMIT = 100
+
+# Seconds between checks for commits by other processes, in Subscription.wait
+DATA_VERSION_POLL = 0.05
+
+# Rows fetched per round-trip when streaming query results
+QUERY_FETCH_BATCH = 1000
+
+# Number of assignments resolved and written per pass in Transaction.update_attrs
+WRITE_BATCH = 256
+
+# Rows examined per statement, and seconds spent per transaction, in DB.vacuum_steps
+VACUUM_BATCH = 1000
+VACUUM_SLICE = 0.1
+# Seconds to leave the DB to others, between the slices of DB.vacuum(incremental=True)
+VACUUM_PAUSE = 0.5
+
+
+def _batched(iterable, size):
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _placeholders(items):
+    return ', '.join(('?',) * len(items))
+
+
+def _attributes(fields):
+    '''Returns (SQL, params) LEFT JOINing the key, timestamp and value of each attribute of obj,
+    or only those in fields. Objects without attributes get a single row of NULLs.
+
+    The joins are kept flat, since SQLite materializes a parenthesized join before joining it.'''
+    join = "LEFT JOIN map ON (map.objid = obj.objid AND map.listid IS NOT NULL"
+    params = ()
+    if fields is not None:
+        params = tuple(fields)
+        join += " AND map.keyid IN (SELECT keyid FROM key WHERE key IN (%s))" % _placeholders(params)
+    join += ") LEFT JOIN key ON (key.keyid = map.keyid) LEFT JOIN list ON (list.listid = map.listid)"
+    return join, params
+
+
+def shared_memory(name):
+    '''Returns the path of an in-memory DB, shared by all connections to it in
+    this process. It lives as long as any connection is open.
+
+    Shared-cache connections lock whole tables, so they are not pooled for reads.'''
+    return 'file:%s?mode=memory&cache=shared' % name
+
+
+def _is_memory(path):
+    return path in (':memory:', '') or 'mode=memory' in path
+
 
 class Transaction(object):
     DEFERRED = "DEFERRED"
@@ -25,6 +100,7 @@ class Transaction(object):
         self.reserved = mode in self.ACTIVE
         self.created = inspect.getouterframes(inspect.currentframe(), 2)[1:]
         self.count = 0
+        self._touched = set()
 
     def _begin(self):
         self.last_yield = time()
@@ -33,6 +109,7 @@ class Transaction(object):
                 self.conn.execute('SAVEPOINT s%d' % self.count)
             else:
                 self.conn.execute('BEGIN %s TRANSACTION' % self.mode)
+                self.owner = get_ident()
                 self.db.in_transaction = self
 
     def __enter__(self):
@@ -56,6 +133,9 @@ class Transaction(object):
             else:
                 self.conn.rollback()
                 self.db.in_transaction = None
+                self._invalidate_touched()
+            # Might hold ids of keys inserted by what was rolled back
+            self.db.keys.clear()
 
     def _commit(self):
         assert self.db.in_transaction is self
@@ -65,6 +145,22 @@ class Transaction(object):
             else:
                 self.conn.commit()
                 self.db.in_transaction = None
+                wrote = bool(self._touched)
+                self._invalidate_touched()
+                if wrote:
+                    self.db.changes.notify()
+
+    def _touch(self, obj):
+        # Invalidated both now and when the transaction ends, since other threads
+        # may cache the committed state in between
+        self._touched.add(obj)
+        if self.db.cache:
+            self.db.cache.invalidate((obj,))
+
+    def _invalidate_touched(self):
+        touched, self._touched = self._touched, set()
+        if self.db.cache and touched:
+            self.db.cache.invalidate(touched)
 
     def yield_from(self, threshold=0):
         assert self.count == 1
@@ -74,104 +170,361 @@ class Transaction(object):
         self._begin()
 
     def _insert_list(self, values):
-        if not values:
-            return None
+        return self._list_ids([values])[0]
+
+    def _list_ids(self, value_lists):
+        '''Returns listid for each of value_lists, inserting the ones not yet in DB'''
         assert self.reserved
-        listid = self.db._get_list_id(values)
-        if listid:
-            return listid
-        newlistid = (
-            self.db._query_single("SELECT MAX(listid) FROM list") or 0) + 1
-        with self.lock:
-            self.conn.cursor().executemany("INSERT INTO list (listid, value) VALUES (?, ?)",
-                                           [(newlistid, value) for value in values])
-        return newlistid
+        digests = [list_digest(values) if values else None for values in value_lists]
+        known = dict()
+        wanted = set(str(d) for d in digests if d is not None)
+        if wanted:
+            known.update((str(d), listid) for listid, d in self.db._query_all(
+                "SELECT listid, digest FROM listhash WHERE digest IN (%s)" % _placeholders(wanted),
+                [sqlite3.Binary(d) for d in wanted]))
 
-    def update_attr(self, objid, key, assignment):
-        if not isinstance(assignment, TimedValues):
-            assignment = TimedValues(assignment)
-        objid = self.db._get_id('obj', objid)
-        keyid = self.db.keys(key)
-        tstamp = self.db._query_single(
-            "SELECT timestamp FROM map WHERE objid = ? AND keyid = ?", (objid, keyid))
-        if tstamp is None and not assignment.v:
-            return False
-        if assignment.t > tstamp:
-            newlistid = self._insert_list(assignment.v)
+        new = list()
+        for values, digest in zip(value_lists, digests):
+            if digest is not None and str(digest) not in known:
+                known[str(digest)] = None
+                new.append((values, digest))
+        if new:
             with self.lock:
                 cursor = self.conn.cursor()
-                cursor.execute("""INSERT OR REPLACE INTO map (objid, keyid, timestamp, listid)
-                            VALUES (?, ?, ?, ?)""",
-                               (objid, keyid, assignment.t, newlistid))
-            return cursor.lastrowid
-        else:
-            return False
+                cursor.executemany("INSERT INTO listhash (digest) VALUES (?)",
+                                   [(digest,) for _, digest in new])
+                known.update((str(d), listid) for listid, d in cursor.execute(
+                    "SELECT listid, digest FROM listhash WHERE digest IN (%s)" % _placeholders(new),
+                    [digest for _, digest in new]))
+                cursor.executemany("INSERT INTO list (listid, value) VALUES (?, ?)",
+                                   [(known[str(digest)], value) for values, digest in new for value in values])
 
-    def update(self, obj):
-        _dict = obj._dict
-        objid = self.db._get_id('obj', obj.id)
+        return [known[str(digest)] if digest is not None else None for digest in digests]
+
+    def update_attrs(self, assignments):
+        '''Applies (obj, key, TimedValues) assignments, as received from other nodes.
+
+        Each assignment is applied if newer than what is in the DB. Returns for each
+        assignment the serial it was written with, or False if it was not applied.'''
+        res = list()
+        for batch in _batched(assignments, WRITE_BATCH):
+            res += self._write(batch, replace_equal=False)
+        return res
+
+    def update_many(self, objs):
+        '''Writes the dirty attributes of many objects, where not older than what is in DB'''
+        for batch in _batched(objs, WRITE_BATCH):
+            self._write([(obj.id, key, obj._dict[key]) for obj in batch for key in obj._dirty],
+                        replace_equal=True)
+            for obj in batch:
+                obj._dirty.clear()
+        return objs
 
+    def _write(self, assignments, replace_equal):
+        assignments = [(obj, key, v if isinstance(v, TimedValues) else TimedValues(v))
+                       for obj, key, v in assignments]
+        if not assignments:
+            return []
+        db = self.db
+        for obj, _, _ in assignments:
+            self._touch(obj)
+        objids = db._get_ids('obj', set(obj for obj, _, _ in assignments))
+        rows = [(objids[obj], db.keys(key), v) for obj, key, v in assignments]
+
+        current = dict(((objid, keyid), tstamp) for objid, keyid, tstamp in db._query_all(
+            "SELECT objid, keyid, timestamp FROM map WHERE objid IN (%s)" % _placeholders(objids),
+            objids.values()))
+
+        accepted = list()
+        for i, (objid, keyid, v) in enumerate(rows):
+            tstamp = current.get((objid, keyid))
+            if replace_equal:
+                apply = not tstamp or v.t >= tstamp
+            else:
+                apply = (tstamp is not None or v.v) and v.t > tstamp
+            if apply:
+                current[(objid, keyid)] = v.t
+                accepted.append(i)
+
+        listids = self._list_ids([rows[i][2].v for i in accepted])
+        with self.lock:
+            self.conn.cursor().executemany(
+                "INSERT OR REPLACE INTO map (objid, keyid, timestamp, listid) VALUES (?, ?, ?, ?)",
+                [(rows[i][0], rows[i][1], rows[i][2].t, listid) for i, listid in zip(accepted, listids)])
+        self._update_dirents([(rows[i][0], rows[i][2].v) for i in accepted
+                              if rows[i][1].name == DIRECTORY_KEY])
+
+        res = [False] * len(rows)
+        if accepted and not replace_equal:
+            written = set(objids[assignments[i][0]] for i in accepted)
+            serials = dict(((objid, keyid), serial) for objid, keyid, serial in db._query_all(
+                "SELECT objid, keyid, serial FROM map WHERE objid IN (%s)" % _placeholders(written),
+                list(written)))
+            for i in accepted:
+                res[i] = serials[rows[i][:2]]
+        return res
+
+    def _update_dirents(self, assignments):
+        '''Replaces the dirent rows of children, from (child_objid, directory-values)'''
+        if not assignments:
+            return
+        # Last assignment of a child wins, like in map
+        latest = dict(assignments)
+        entries = [(child, dirent) for child, values in latest.iteritems()
+                   for dirent in (split_dirent(value) for value in values) if dirent]
+        parents = self.db._get_ids('obj', set(parent for _, (parent, _) in entries))
         with self.lock:
             cursor = self.conn.cursor()
-            for key in obj._dirty:
-                assignment = _dict[key]
-                keyid = self.db.keys(key)
-                old_timestamp = self.db._query_single(
-                    "SELECT timestamp FROM map WHERE objid = ? and keyid = ?", (objid, keyid))
-                if not old_timestamp or assignment.t >= old_timestamp:
-                    listid = self._insert_list(assignment.v)
-                    cursor.execute("""INSERT OR REPLACE INTO map (objid, keyid, timestamp, listid)
-                                        VALUES (?, ?, ?, ?)""",
-                                   (objid, keyid, assignment.t, listid))
-        obj._dirty.clear()
-        return obj
+            cursor.executemany("DELETE FROM dirent WHERE child_objid = ?", [(child,) for child in latest])
+            cursor.executemany(
+                "INSERT OR IGNORE INTO dirent (parent_objid, name, child_objid) VALUES (?, ?, ?)",
+                [(parents[parent], name, child) for child, (parent, name) in entries])
+            if self.db.fts:
+                names = dict()
+                for child, (_, name) in entries:
+                    names.setdefault(child, []).append(name)
+                cursor.executemany("DELETE FROM dirent_fts WHERE rowid = ?", [(child,) for child in latest])
+                cursor.executemany("INSERT INTO dirent_fts (rowid, names) VALUES (?, ?)",
+                                   [(child, u'\n'.join(n)) for child, n in names.iteritems()])
+
+    def update_attr(self, objid, key, assignment):
+        return self.update_attrs([(objid, key, assignment)])[0]
+
+    def update(self, obj):
+        return self.update_many((obj,))[0]
 
     def delete(self, obj, t=None):
         object_id = getattr(obj, 'id', obj)
+        self._touch(object_id)
         objid = self.db._get_id('obj', object_id)
         t = t or time()
         with self.lock:
             self.conn.execute("""INSERT OR REPLACE INTO map (objid, keyid, timestamp, listid)
                             SELECT objid, keyid, ?, NULL FROM map WHERE objid = ?""", (t, objid))
+            self.conn.execute("DELETE FROM dirent WHERE child_objid = ?", (objid,))
+            if self.db.fts:
+                self.conn.execute("DELETE FROM dirent_fts WHERE rowid = ?", (objid,))
 
 
 class AsyncCommitter(Thread):
-    def __init__(self, db, min_interval=0.5):
+    '''Writes updated objects from a background thread, many per transaction.
+
+    Pending updates of the same object are merged, keeping the newest value of
+    each key. Pending objects are written when `flush_size` are queued, or the
+    oldest has waited `max_age` seconds. Producers block while `max_pending`
+    objects are queued.'''
+    def __init__(self, db, max_age=0.5, flush_size=WRITE_BATCH * 4, max_pending=WRITE_BATCH * 16):
         super(AsyncCommitter, self).__init__(name="AsyncCommitter")
         self.daemon = True
         self.db = db
         self._db = db.clone()
-        self._min_interval = min_interval
-        self._pending = list()
+        self._max_age = max_age
+        self._flush_size = flush_size
+        self._max_pending = max_pending
+        self._pending = OrderedDict()
+        self._oldest = None
+        self._stopped = False
+        self._cond = ThreadCondition()
+        self._metrics = dict(updates=0, merged=0, flushes=0, flushed=0, max_depth=0,
+                             flush_time=0.0, max_flush_time=0.0, blocked_time=0.0)
 
     def __enter__(self):
-        self._stop = Event()
         self.start()
         return self
 
     def __exit__(self, type, exc, tb):
-        self._stop.set()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
         self.join()
+        log.debug("AsyncCommitter finished: %s", self.stats())
+
+    def _due(self):
+        return self._stopped or len(self._pending) >= self._flush_size or \
+            (self._pending and time() - self._oldest >= self._max_age)
 
     def run(self):
-        next_commit = 0
         stopped = False
         while not stopped:
-            stopped = self._stop.wait(next_commit - time())
-            next_commit = time() + self._min_interval
-
-            pending, self._pending = self._pending, list()
+            with self._cond:
+                while not self._due():
+                    self._cond.wait(self._oldest and max(self._oldest + self._max_age - time(), 0))
+                pending, self._pending = self._pending, OrderedDict()
+                self._oldest = None
+                stopped = self._stopped
+                self._cond.notify_all()
             self._flush(pending)
 
-    def _flush(self, objs):
-        if not objs:
+    def _flush(self, pending):
+        if not pending:
             return
-        with Transaction(self._db, Transaction.IMMEDIATE) as t:
-            for obj in objs:
-                t.update(obj)
+        start = time()
+        try:
+            with self._db.transaction(Transaction.IMMEDIATE) as t:
+                t.update_many([Object(id, attrs) for id, attrs in pending.iteritems()])
+        except Exception:
+            log.exception("AsyncCommitter failed to write %d objects", len(pending))
+        elapsed = time() - start
+        with self._cond:
+            metrics = self._metrics
+            metrics['flushes'] += 1
+            metrics['flushed'] += len(pending)
+            metrics['flush_time'] += elapsed
+            metrics['max_flush_time'] = max(metrics['max_flush_time'], elapsed)
 
     def update(self, obj):
-        self._pending.append(obj)
+        attrs = dict((key, obj._dict[key]) for key in obj._dirty)
+        obj._dirty.clear()
+        if not attrs:
+            return
+        with self._cond:
+            metrics = self._metrics
+            metrics['updates'] += 1
+            if obj.id in self._pending:
+                metrics['merged'] += 1
+            else:
+                start = time()
+                while len(self._pending) >= self._max_pending and obj.id not in self._pending:
+                    self._cond.wait()
+                metrics['blocked_time'] += time() - start
+            pending = self._pending.get(obj.id)
+            if pending is None:
+                pending = self._pending[obj.id] = dict()
+                self._oldest = self._oldest or time()
+                metrics['max_depth'] = max(metrics['max_depth'], len(self._pending))
+            for key, values in attrs.iteritems():
+                current = pending.get(key)
+                if current is None or values.t >= current.t:
+                    pending[key] = values
+            if len(self._pending) >= self._flush_size:
+                self._cond.notify_all()
+
+    def stats(self):
+        '''Returns queue depth, merge ratio and flush latencies'''
+        with self._cond:
+            res = dict(self._metrics, depth=len(self._pending))
+        res['merge_ratio'] = res['updates'] and float(res['merged']) / res['updates']
+        res['avg_flush_time'] = res['flushes'] and res['flush_time'] / res['flushes']
+        return res
+
+
+class ChangeNotifier(object):
+    '''Wakes subscribers on commits through any DB on the same file in this process'''
+    _registry = dict()
+    _registry_lock = RLock()
+
+    @classmethod
+    def for_db(cls, path):
+        if path in (':memory:', ''):
+            return cls()
+        if not _is_memory(path):
+            path = os.path.abspath(path)
+        with cls._registry_lock:
+            return cls._registry.setdefault(path, cls())
+
+    def __init__(self):
+        self.generation = 0
+        self._cond = ThreadCondition()
+
+    def notify(self):
+        with self._cond:
+            self.generation += 1
+            self._cond.notify_all()
+
+    def wait(self, generation, timeout):
+        '''Waits up to timeout seconds for a commit after `generation`'''
+        with self._cond:
+            if self.generation == generation:
+                self._cond.wait(timeout)
+            return self.generation != generation
+
+
+class Subscription(object):
+    '''Public changes committed after `serial`, as from DB.get_public_mappings_after.
+
+    Iterating yields non-empty batches of changes, waiting for commits in between.
+    Commits in this process wake the subscriber immediately, while commits by other
+    processes are detected by polling PRAGMA data_version.'''
+    def __init__(self, db, serial, limit=1024):
+        self.db = db
+        self.serial = serial
+        self.limit = limit
+        self.mark()
+
+    def mark(self):
+        '''Remembers the state of the DB, for wait() to detect later changes'''
+        self._generation = self.db.changes.generation
+        self._data_version = self.db.data_version()
+
+    def changed(self):
+        return self.db.changes.generation != self._generation or \
+            self.db.data_version() != self._data_version
+
+    def fetch(self):
+        '''Returns the next changes, up to `limit`, without waiting. Each change is returned once.'''
+        self.mark()
+        batch = list(self.db.get_public_mappings_after(self.serial, self.limit))
+        if batch:
+            self.serial = batch[-1][3]
+        return batch
+
+    def wait(self, timeout):
+        '''Waits up to timeout seconds for changes since the last fetch() or mark().
+        Returns whether there were any.'''
+        deadline = time() + timeout
+        while not self.changed():
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            self.db.changes.wait(self._generation, min(remaining, DATA_VERSION_POLL))
+        return True
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            batch = self.fetch()
+            if batch:
+                return batch
+            self.wait(DATA_VERSION_POLL * 20)
+
+
+class WALCheckpointer(Thread):
+    '''Checkpoints the WAL every `interval` seconds from its own connection.
+
+    SQLite's auto-checkpoints are run by committing writers, and give up while
+    readers use the WAL, so the -wal file may grow without bound during long syncs.'''
+    def __init__(self, db, interval):
+        super(WALCheckpointer, self).__init__(name="WALCheckpointer")
+        self.daemon = True
+        self._db = db.clone()
+        self._interval = interval
+        self._stop = Event()
+        self.last_result = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, exc, tb):
+        self._stop.set()
+        self.join()
+
+    def run(self):
+        while not self._stop.wait(self._interval):
+            self.checkpoint()
+
+    def checkpoint(self):
+        '''Returns (busy, wal pages, checkpointed pages)'''
+        try:
+            with self._db.lock:
+                self.last_result = self._db.conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        except sqlite3.Error:
+            log.exception("WAL checkpoint failed")
+        else:
+            log.debug("WAL checkpoint (busy, pages, checkpointed): %s", self.last_result)
+        return self.last_result
 
 
 class Key(int):
@@ -229,22 +582,49 @@ class DBQuery(Query):
 
     def __iter__(self):
         q, args = self.apply()
-        return iter(self.db._query_all(q, args))
+        return self.db._query_iter(q, args)
+
+
+class DBAggregate(Aggregate):
+    def __iter__(self):
+        q, args = self.apply()
+        return self.objects.db._query_iter(q, args)
 
 
 class DB(object):
-    def __init__(self, path):
+    def __init__(self, path, read_pool=True, object_cache=0, query_stats=None, profile=None):
         self.path = path
-        self.conn = sqlite3.connect(
-            path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.profile = profile or {}
+        self.conn = self._connect()
         self.cursor = self.conn.cursor()
         create_DB(self.conn)
+        self.fts = has_fts(self.conn)
         self.keys = Keys(self)
         self.lock = RLock()
         self.in_transaction = None
+        # In-memory databases are private to their connection, or lock whole tables, and can not be pooled
+        self._read_pool = read_pool and not _is_memory(path)
+        self._readers = local()
+        # Idle reader connections for streaming cursors, which may outlive a statement
+        self._streams = list()
+        self._streams_lock = Lock()
+        self._data_version = None
+        self.cache = object_cache and ObjectCache(object_cache) or None
+        self.query_stats = query_stats
+        if self.cache and query_stats:
+            query_stats.watch(self.cache)
+        self.changes = ChangeNotifier.for_db(path)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE)
+        profiles.apply(conn, self.profile)
+        return conn
 
     def clone(self):
-        return type(self)(self.path)
+        return type(self)(self.path, read_pool=self._read_pool,
+                          object_cache=self.cache and self.cache.size or 0,
+                          query_stats=self.query_stats, profile=self.profile)
 
     def set_volatile(self, v):
         sync = v and 'OFF' or 'NORMAL'
@@ -258,17 +638,123 @@ class DB(object):
             t.created = inspect.getouterframes(inspect.currentframe(), 2)[1:]
             return t
 
-    def _query_all(self, query, args):
+    def _owns_transaction(self):
+        in_transaction = self.in_transaction
+        return in_transaction is not None and in_transaction.owner == get_ident()
+
+    def _pooled_reads(self):
+        '''Returns whether the calling thread may read through reader connections.
+
+        WAL-mode allows readers to proceed concurrently with the writer, but reads
+        inside a transaction must see its uncommitted changes.'''
+        return self._read_pool and not self._owns_transaction()
+
+    def _connect_reader(self):
+        conn = self._connect()
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def _reader(self):
+        '''Returns a read-only connection private to the calling thread, or None if
+        reads must go through the shared (locked) connection.
+
+        Statements on it must be done with before returning, since an open cursor
+        holds its read snapshot. Streaming cursors use _stream_reader() instead.'''
+        if not self._pooled_reads():
+            return None
+        try:
+            return self._readers.conn
+        except AttributeError:
+            conn = self._readers.conn = self._connect_reader()
+            return conn
+
+    @contextmanager
+    def _stream_reader(self):
+        '''Lends a read-only connection to a streaming cursor, until it is closed.
+
+        No other statement runs on it meanwhile, so a partly consumed result neither
+        makes other reads stale, nor is affected by them. The cursor may be consumed
+        by another thread than the creator.'''
+        with self._streams_lock:
+            conn = self._streams.pop() if self._streams else None
+        if conn is None:
+            conn = self._connect_reader()
+        try:
+            yield conn
+        finally:
+            with self._streams_lock:
+                self._streams.append(conn)
+
+    def data_version(self):
+        '''Returns a value that changes when other connections commit'''
+        conn = self._reader()
+        if conn:
+            return conn, conn.execute("PRAGMA data_version").fetchone()[0]
         with self.lock:
-            c = self.conn.cursor()
-            c.execute(query, args)
-            return c.fetchall()
+            return self.conn, self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _execute(self, query, args, fetch):
+        '''Runs query on the right connection for the calling thread, returning fetch(cursor)'''
+        start = self.query_stats and time()
+        conn = self._reader()
+        if conn:
+            res = fetch(conn.execute(query, args))
+        else:
+            with self.lock:
+                c = self.conn.cursor()
+                c.execute(query, args)
+                res = fetch(c)
+        if self.query_stats:
+            rows = len(res) if isinstance(res, list) else int(res is not None)
+            self._record(conn, query, args, time() - start, rows)
+        return res
+
+    def _record(self, conn, query, args, elapsed, rows):
+        def explain():
+            if conn:
+                plan = conn.execute("EXPLAIN QUERY PLAN " + query, args).fetchall()
+            else:
+                with self.lock:
+                    plan = self.conn.execute("EXPLAIN QUERY PLAN " + query, args).fetchall()
+            return "\n".join(row[-1] for row in plan)
+        self.query_stats.record(query, elapsed, rows, explain)
+
+    def _query_all(self, query, args):
+        return self._execute(query, args, lambda c: c.fetchall())
+
+    def _query_iter(self, query, args):
+        '''Streams the rows of query, QUERY_FETCH_BATCH rows at a time.
+
+        The shared connection resets open cursors on commit, so there all rows
+        are fetched up front, like _query_all.'''
+        if not self._pooled_reads():
+            for row in self._query_all(query, args):
+                yield row
+            return
+
+        with self._stream_reader() as conn:
+            # Only time spent in SQLite is accounted, not the consumer of the rows
+            start = time()
+            cursor = conn.execute(query, args)
+            elapsed = time() - start
+            count = 0
+            try:
+                while True:
+                    start = time()
+                    rows = cursor.fetchmany(QUERY_FETCH_BATCH)
+                    elapsed += time() - start
+                    if not rows:
+                        break
+                    count += len(rows)
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+                if self.query_stats:
+                    self._record(conn, query, args, elapsed, count)
 
     def _query_first(self, query, args):
-        with self.lock:
-            c = self.conn.cursor()
-            c.execute(query, args)
-            return c.fetchone()
+        return self._execute(query, args, lambda c: c.fetchone())
 
     def _query_single(self, query, args=[], default=None):
         res = self._query_first(query, args)
@@ -277,6 +763,20 @@ class DB(object):
         else:
             return default
 
+    def _get_ids(self, tbl, names):
+        '''Returns a dict of name -> id for all names, inserting the missing ones'''
+        names = list(names)
+        query = "SELECT %sid, %s FROM %s WHERE %s IN (%%s)" % (tbl, tbl, tbl, tbl)
+        res = dict((name, id) for id, name in self._query_all(query % _placeholders(names), names))
+        missing = [name for name in names if name not in res]
+        if missing:
+            with self.lock:
+                self.cursor.executemany(
+                    "INSERT OR IGNORE INTO %s (%s) VALUES (?)" % (tbl, tbl), [(name,) for name in missing])
+                res.update((name, id) for id, name in self._query_all(
+                    query % _placeholders(missing), missing))
+        return res
+
     def _get_id(self, tbl, id):
         objid = self._query_single(
             "SELECT %sid FROM %s WHERE %s = ?" % (tbl, tbl, tbl), (id,))
@@ -288,24 +788,132 @@ class DB(object):
                     "SELECT %sid FROM %s WHERE %s = ?" % (tbl, tbl, tbl), (id,))
         return objid
 
-    def get(self, obj, fields=None):
-        if isinstance(obj, int):
-            objid = obj
-            obj = self._query_single(
-                'SELECT obj FROM obj WHERE objid = ?', (objid,))
+    def get(self, obj, fields=None, readonly=False):
+        return next(self.get_many((obj,), fields, readonly))
+
+    def get_many(self, objs, fields=None, readonly=False):
+        '''Loads objects given as objid or obj-names, in batches of one query each.
+
+        Yields one Object per requested item, in the requested order. With `readonly`,
+        ReadOnlyObjects are returned, which are cheaper for scans.'''
+        cache = self._valid_cache()
+        for batch in _batched(objs, GET_MANY_BATCH):
+            if cache:
+                objs = self._get_cached_batch(cache, batch, fields, readonly)
+            else:
+                objs = self._get_batch(batch, fields, readonly)
+            for obj in objs:
+                yield obj
+
+    def _valid_cache(self):
+        '''Returns the object cache, after expiring objects changed by other connections.
+
+        Returns None if there is no cache, or the calling thread is in a transaction,
+        where uncommitted changes might be visible.'''
+        cache = self.cache
+        if cache is None or self._owns_transaction():
+            return None
+
+        conn = self._reader()
+        if conn:
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            changed = getattr(self._readers, 'data_version', None) != data_version
+            self._readers.data_version = data_version
         else:
-            objid = self._query_single(
-                'SELECT objid FROM obj WHERE obj = ?', (obj,))
-        obj = Object(obj)
-        query = "SELECT key, timestamp, listid FROM map NATURAL JOIN key WHERE objid = ?"
-        if fields is not None:
-            query += " AND key IN (" + ', '.join(('?',) * len(fields)) + ")"
-        for key, timestamp, listid in self._query_all(query, (objid,) + tuple(fields or ())):
-            if listid is None:
+            with self.lock:
+                data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            changed = self._data_version != data_version
+            self._data_version = data_version
+
+        if changed:
+            self._expire_cache(cache)
+        return cache
+
+    def _expire_cache(self, cache):
+        with cache.lock:
+            serial = self.last_serial()
+            if cache.serial is not None and serial > cache.serial:
+                changed = self._query_all(
+                    "SELECT DISTINCT obj FROM map NATURAL JOIN obj WHERE serial > ? AND serial <= ? LIMIT ?",
+                    (cache.serial, serial, cache.size + 1))
+                if len(changed) > cache.size:
+                    cache.clear()
+                else:
+                    cache.invalidate(obj for obj, in changed)
+            cache.serial = serial
+
+    def _get_cached_batch(self, cache, objs, fields, readonly):
+        generation = cache.generation
+        cached = dict()
+        for x in objs:
+            if not isinstance(x, int):
+                attrs = cache.get(x)
+                if attrs is not None:
+                    cached[x] = attrs
+
+        missing = [x for x in objs if x not in cached and not isinstance(x, int)]
+        for x, obj in zip(missing, self._get_batch(missing, None)):
+            cache.put(x, obj._dict, generation)
+            cached[x] = obj._dict
+
+        by_id = self._get_batch([x for x in objs if isinstance(x, int)], fields, readonly)
+
+        for x in objs:
+            if isinstance(x, int):
+                yield next(by_id)
+                continue
+            attrs = cached[x]
+            if fields is not None:
+                attrs = dict((key, attrs[key]) for key in fields if key in attrs)
+            elif readonly:
+                # Never modified, so the cache entry itself can be shared
+                yield ReadOnlyObject(x, attrs)
                 continue
-            obj._dict[key] = TimedValues(v=(x for x, in self._query_all(
-                "SELECT value FROM list WHERE listid = ?", (listid,))), t=timestamp)
-        return obj
+            yield (ReadOnlyObject if readonly else Object).loaded(x, dict(attrs))
+
+    def _get_batch(self, objs, fields, readonly=False):
+        ids = [x for x in objs if isinstance(x, int)]
+        names = [x for x in objs if not isinstance(x, int)]
+
+        where = list()
+        if ids:
+            where.append("obj.objid IN (%s)" % _placeholders(ids))
+        if names:
+            where.append("obj.obj IN (%s)" % _placeholders(names))
+        by_id = dict()
+        by_name = dict()
+        if where:
+            join, params = _attributes(fields)
+            query = "SELECT obj.objid, obj.obj, key, timestamp, value FROM obj %s WHERE %s ORDER BY obj.objid" % (
+                join, ' OR '.join(where))
+            for (objid, name), obj in self._query_objects(query, params + tuple(ids) + tuple(names), readonly):
+                by_id[objid] = by_name[name] = obj
+
+        cls = ReadOnlyObject if readonly else Object
+        for x in objs:
+            if isinstance(x, int):
+                obj = by_id.get(x)
+                yield cls.loaded(None, {}) if obj is None else obj
+            else:
+                obj = by_name.get(x)
+                yield cls.loaded(x, {}) if obj is None else obj
+
+    def _query_objects(self, query, params, readonly=False):
+        '''Streams objects loaded in one statement. Each row of query holds some columns
+        identifying the result, ending with obj, followed by key, timestamp and value of one
+        attribute. Rows of the same result must be consecutive. Yields (identity, object).'''
+        cls = ReadOnlyObject if readonly else Object
+        for row, attr_rows in groupby(self._query_iter(query, params), itemgetter(slice(0, -3))):
+            attrs = dict()
+            for key, timestamp, value in (r[-3:] for r in attr_rows):
+                if key is None:
+                    continue
+                try:
+                    attrs[key][1].append(value)
+                except KeyError:
+                    attrs[key] = (timestamp, [value])
+            yield row, cls.loaded(row[-1], dict((key, TimedValues.trusted(values, timestamp))
+                                                for key, (timestamp, values) in attrs.iteritems()))
 
     def __getitem__(self, obj):
         return self.get(obj)
@@ -313,49 +921,162 @@ class DB(object):
     def _select(self, *columns):
         return DBQuery(self, columns)
 
-    def query(self, criteria, fields=None):
-        if isinstance(criteria, Condition):
-            criteria = (criteria,)
-        for objid, in self._select('objid').where(*criteria):
-            yield self.get(objid, fields)
+    def query(self, criteria, fields=None, readonly=False, limit=None, after=None):
+        '''Yields objects matching criteria. With `limit` or `after`, a page of at most `limit`
+        objects, following the object `after`.
+
+        Like the other paged methods, objects are in the order they were first stored, and
+        `after` is the id (name) of the last object of the previous page, or the Object.'''
+        after = self._after_objid(after)
+        if self.cache is not None:
+            objids = (objid for objid, in self._matching(criteria, limit, after))
+            return self.get_many(objids, fields, readonly)
+        return self._query_matching(criteria, fields, readonly, limit, after)
+
+    def _after_objid(self, after):
+        if after is None:
+            return None
+        objid = self._query_single("SELECT objid FROM obj WHERE obj = ?", (getattr(after, 'id', after),))
+        if objid is None:
+            raise KeyError(after)
+        return objid
 
-    def query_ids(self, criteria, fields=None):
+    def _query_matching(self, criteria, fields, readonly, limit, after):
+        # Matching and loading in one statement, in objid order like the pages
+        matching, matching_params = self._matching(criteria, limit, after).apply()
+        join, params = _attributes(fields)
+        query = "SELECT obj.objid, obj.obj, key, timestamp, value FROM obj %s " \
+                "WHERE obj.objid IN (%s) ORDER BY obj.objid" % (join, matching)
+        for _, obj in self._query_objects(query, params + tuple(matching_params), readonly):
+            yield obj
+
+    def query_ids(self, criteria, fields=None, limit=None, after=None):
+        '''Yields the id (name) of objects matching criteria, paged like query()'''
+        for obj, in self._matching(criteria, limit, self._after_objid(after), 'obj'):
+            yield obj
+
+    def _matching(self, criteria, limit, after, column='objid'):
         if isinstance(criteria, Condition):
             criteria = (criteria,)
-        for objid, in self._select('objid').where(*criteria):
-            yield objid
+        rows = self._select(column).where(*criteria)
+        if limit is not None:
+            rows.limit(limit)
+        if after is not None:
+            rows.after(after)
+        return rows
 
-    def query_keyed(self, criteria, key, fields=None, sortmeth=Sort.value):
+    def query_keyed(self, criteria, key, fields=None, sortmeth=Sort.value, readonly=False, limit=None, after=None):
+        '''Yields (value of key, obj) for objects matching criteria, sorted by sortmeth. With
+        `limit` or `after`, a page of at most `limit` rows, following the row (value, obj)
+        `after`, where obj is like `after` of query(). Ties are in the order of query().'''
         if isinstance(criteria, Condition):
             criteria = (criteria,)
         direction, key = _parse_sort(key)
         key_crit = [c for c in criteria if c.requires_key(key)] or [QueryKey(key).any()]
         other_crit = [c for c in criteria if not c.requires_key(key)]
-        for objid, key_value in self._select('objid', 'value') \
-                .where(*(key_crit + other_crit)) \
-                .order_by(sortmeth, direction):
-            yield key_value, self.get(objid, fields)
+        rows = self._select('objid', 'value') \
+            .where(*(key_crit + other_crit)) \
+            .order_by(sortmeth, direction)
+        if limit is not None:
+            rows.limit(limit)
+        if after is not None:
+            rows.after(*self._position(sortmeth, key, *after))
+        for batch in _batched(rows, GET_MANY_BATCH):
+            objs = self._get_batch([objid for objid, _ in batch], fields, readonly)
+            for (_, key_value), obj in zip(batch, objs):
+                yield key_value, obj
+
+    def aggregate(self, criteria):
+        '''Returns an Aggregate over the objects matching criteria, yielding its rows when iterated'''
+        if isinstance(criteria, Condition):
+            criteria = (criteria,)
+        return DBAggregate(self._select('objid').where(*criteria))
+
+    def _position(self, sortmeth, key, value, obj):
+        '''Returns the position of row (value, obj) in query_keyed, sorted by sortmeth'''
+        sort_key, sort_params = sortmeth()
+        row = self._query_first("SELECT %s, objid FROM map NATURAL JOIN key NATURAL JOIN list NATURAL JOIN obj "
+                                "WHERE key = ? AND obj = ? AND value = ?" % sort_key,
+                                sort_params + (key, getattr(obj, 'id', obj), value))
+        if not row:
+            raise KeyError((value, obj))
+        sort_value, objid = row
+        if sort_key == 'value':
+            return value, objid
+        return sort_value, objid, value
+
+    def dir_children(self, parents, name=None, fields=None, readonly=False):
+        '''Yields (name, obj) for the directory entries of parents, sorted by name.
+        With `name`, only entries with that name.'''
+        parents = tuple(parents)
+        join, params = _attributes(fields)
+        query = "SELECT dirent.name, dirent.parent_objid, obj.objid, obj.obj, key, timestamp, value " \
+                "FROM obj AS parent JOIN dirent ON (dirent.parent_objid = parent.objid) " \
+                "JOIN obj ON (obj.objid = dirent.child_objid) %s " \
+                "WHERE parent.obj IN (%s)" % (join, _placeholders(parents))
+        params += parents
+        if name is not None:
+            query += " AND dirent.name = ?"
+            params += (name,)
+        query += " ORDER BY dirent.name, obj.objid, dirent.parent_objid"
+        for (entry, _, _, _), obj in self._query_objects(query, params, readonly):
+            yield entry, obj
+
+    def dir_paths(self, obj):
+        '''Returns the set of paths (tuples of names) leading to obj, from objects
+        without directory-values. Paths through malformed values are left out, with
+        a warning.'''
+        obj = getattr(obj, 'id', obj)
+        rows = self._query_all("""
+            WITH RECURSIVE up (objid, path, depth) AS (
+                SELECT objid, '', 0 FROM obj WHERE obj = ?
+                UNION ALL
+                SELECT parent_objid, name || '/' || path, depth + 1 FROM dirent JOIN up ON (child_objid = objid)
+                WHERE depth < ?
+            )
+            SELECT objid, path, NOT EXISTS (SELECT 1 FROM dirent WHERE child_objid = up.objid) FROM up
+        """, (obj, MAX_DIR_DEPTH))
+        if not rows:
+            # Unknown to the DB, so not in any directory
+            return set([()])
+
+        # Only valid values are indexed in dirent, so look for the others among the values
+        objids = list(set(objid for objid, _, _ in rows))
+        in_directory = set()
+        for objid, name, value in self._query_all(
+                "SELECT objid, obj, value FROM obj NATURAL JOIN map NATURAL JOIN key NATURAL JOIN list "
+                "WHERE key = ? AND objid IN (%s)" % _placeholders(objids), (DIRECTORY_KEY,) + tuple(objids)):
+            in_directory.add(objid)
+            if not split_dirent(value):
+                log.warning("Malformed directory for %s: %s", name, value)
+        return set(tuple(path.split(u'/')[:-1]) for objid, path, root in rows
+                   if root and objid not in in_directory)
+
+    def search(self, text, limit=SEARCH_LIMIT, fields=None):
+        '''Returns objects with directory entry names matching all words in text
+        (as prefixes), best match first'''
+        if not self.fts:
+            raise RuntimeError("Search requires SQLite with FTS5")
+        match = u' '.join(u'"%s"*' % word.replace(u'"', u'""') for word in text.split())
+        if not match:
+            return iter(())
+        ids = [objid for objid, in self._query_all(
+            "SELECT rowid FROM dirent_fts WHERE dirent_fts MATCH ? ORDER BY rank LIMIT ?", (match, limit))]
+        return self.get_many(ids, fields)
 
     def _get_list_id(self, values):
-        _values = set(values)
-        suspects = [x for (x,) in self._query_all(
-            "SELECT listid FROM list WHERE value = ?", (_values.pop(),))]
-        while _values and suspects:
-            query = "SELECT listid FROM list WHERE value = ? AND listid IN (%s)" % (
-                ','.join(['?'] * len(suspects)))
-            suspects = [
-                x for (x,) in self._query_all(query, [_values.pop()] + suspects)]
-        if suspects and (not _values):
-            query = "SELECT listid FROM list WHERE listid IN (%s) GROUP BY listid HAVING COUNT(value) = ?" % (
-                ','.join(['?'] * len(suspects)))
-            listid = self._query_single(query, suspects + [len(values)])
-            if listid:
-                return listid
-
-    def vacuum(self, delete_grace=DEFAULT_GRACE):
+        return self._query_single("SELECT listid FROM listhash WHERE digest = ?", (list_digest(values),))
+
+    def vacuum(self, delete_grace=DEFAULT_GRACE, incremental=False):
+        if incremental:
+            for _ in self.vacuum_steps(delete_grace):
+                sleep(VACUUM_PAUSE)
+            return
+
         Q_CLEAN_MAP = "SELECT DISTINCT list.listid FROM list LEFT JOIN map ON (map.listid = list.listid) WHERE map.listid IS NULL"
         Q_CLEAN_LIST = "SELECT DISTINCT key.keyid FROM key LEFT JOIN map ON (key.keyid = map.keyid) WHERE map.keyid IS NULL"
-        Q_CLEAN_OBJS = "SELECT DISTINCT obj.objid FROM obj LEFT JOIN map ON (obj.objid = map.objid) WHERE map.objid IS NULL"
+        Q_CLEAN_OBJS = "SELECT DISTINCT obj.objid FROM obj LEFT JOIN map ON (obj.objid = map.objid) WHERE map.objid IS NULL " \
+                       "AND NOT EXISTS (SELECT 1 FROM dirent WHERE parent_objid = obj.objid)"
 
         with self.lock:
             with self.transaction():
@@ -363,22 +1084,110 @@ class DB(object):
                     self.conn.execute("DELETE FROM map WHERE timestamp < ? AND listid IS NULL", (time() - delete_grace,))
                 for x, in self._query_all(Q_CLEAN_MAP, ()):
                     self.conn.execute("DELETE FROM list WHERE listid = ?", (x,))
+                    self.conn.execute("DELETE FROM listhash WHERE listid = ?", (x,))
                 for x, in self._query_all(Q_CLEAN_LIST, ()):
                     self.conn.execute("DELETE FROM key WHERE key.keyid = ?", (x,))
                 for x, in self._query_all(Q_CLEAN_OBJS, ()):
                     self.conn.execute("DELETE FROM obj WHERE obj.objid = ?", (x,))
 
+        # Converts databases created before incremental vacuum was supported
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
         self.conn.execute("VACUUM")
 
+    def vacuum_steps(self, delete_grace=DEFAULT_GRACE, batch=VACUUM_BATCH, time_slice=VACUUM_SLICE):
+        '''Incremental vacuum, in transactions of about time_slice seconds.
+
+        A generator, yielding (phase, rows_removed) between the transactions, so the
+        caller can pace it. Progress is stored in the DB, and an interrupted vacuum
+        resumes where it left off. Unlike vacuum(), unused keys are kept, since
+        other processes may have their ids cached.'''
+        phases = [
+            ('lists', "SELECT listid FROM listhash WHERE listid > ? ORDER BY listid LIMIT ?",
+             "SELECT listid FROM listhash WHERE listid IN (%s) AND NOT EXISTS "
+             "(SELECT 1 FROM map WHERE map.listid = listhash.listid)",
+             ("DELETE FROM list WHERE listid IN (%s)", "DELETE FROM listhash WHERE listid IN (%s)")),
+            ('objs', "SELECT objid FROM obj WHERE objid > ? ORDER BY objid LIMIT ?",
+             "SELECT objid FROM obj WHERE objid IN (%s) AND NOT EXISTS "
+             "(SELECT 1 FROM map WHERE map.objid = obj.objid) AND NOT EXISTS "
+             "(SELECT 1 FROM dirent WHERE parent_objid = obj.objid)",
+             ("DELETE FROM obj WHERE objid IN (%s)",)),
+        ]
+
+        if delete_grace is not None:
+            done = False
+            while not done:
+                with self.lock, Transaction(self, Transaction.IMMEDIATE):
+                    deadline = time() + time_slice
+                    removed = 0
+                    while True:
+                        count = self.conn.execute(
+                            "DELETE FROM map WHERE serial IN (SELECT serial FROM map "
+                            "WHERE listid IS NULL AND timestamp < ? LIMIT ?)",
+                            (time() - delete_grace, batch)).rowcount
+                        removed += count
+                        done = count < batch
+                        if done or time() > deadline:
+                            break
+                yield 'map', removed
+
+        for phase, scan, orphans, deletes in phases:
+            position = self._query_single("SELECT position FROM vacuum_state WHERE phase = ?", (phase,), 0)
+            while position is not None:
+                with self.lock, Transaction(self, Transaction.IMMEDIATE):
+                    deadline = time() + time_slice
+                    removed = 0
+                    while True:
+                        ids = [x for x, in self._query_all(scan, (position, batch))]
+                        if not ids:
+                            position = None
+                            break
+                        position = ids[-1]
+                        orphaned = [x for x, in self._query_all(orphans % _placeholders(ids), ids)]
+                        if orphaned:
+                            for delete in deletes:
+                                self.conn.execute(delete % _placeholders(orphaned), orphaned)
+                        removed += len(orphaned)
+                        if time() > deadline:
+                            break
+                    self.conn.execute("INSERT OR REPLACE INTO vacuum_state (phase, position) VALUES (?, ?)",
+                                      (phase, position or 0))
+                yield phase, removed
+
+        while True:
+            with self.lock:
+                pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if pages:
+                    self.conn.execute("PRAGMA incremental_vacuum(%d)" % min(pages, batch)).fetchall()
+                    freed = pages - self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # Without auto_vacuum = INCREMENTAL nothing is freed. vacuum() converts the DB.
+            if not pages or not freed:
+                return
+            yield 'pages', freed
+
+    def subscribe(self, after_serial=None, limit=1024):
+        '''Returns a Subscription to public changes after `after_serial`, by default
+        from the current last serial'''
+        if after_serial is None:
+            after_serial = self.last_serial()
+        return Subscription(self, after_serial, limit)
+
     def get_public_mappings_after(self, serial=0, limit=1024):
-        for obj, key, tstamp, serial, listid in self._query_all("SELECT obj, key, timestamp, serial, listid FROM map NATURAL JOIN key NATURAL JOIN obj WHERE serial > ? AND NOT key LIKE '@%' ORDER BY serial LIMIT ?", (serial, limit)):
-            values = set(x for x, in self._query_all(
-                "SELECT value FROM list WHERE listid = ?", (listid,)))
-            yield obj, key, tstamp, serial, values
+        rows = self._query_iter("""
+            SELECT obj, key, timestamp, serial, value FROM (
+                SELECT serial, objid, key, timestamp, listid FROM map NATURAL JOIN key
+                WHERE serial > ? AND NOT key LIKE '@%' ORDER BY serial LIMIT ?
+            ) NATURAL JOIN obj LEFT JOIN list USING (listid)
+            ORDER BY serial""", (serial, limit))
+        for (obj, key, tstamp, serial), values in groupby(rows, itemgetter(0, 1, 2, 3)):
+            yield obj, key, tstamp, serial, set(value for _, _, _, _, value in values if value is not None)
 
     def last_serial(self):
         return self._query_single("SELECT MAX(serial) FROM map") or 0
 
+    def snapshot_serial(self, source):
+        '''Returns the serial of `source` up to which a snapshot was imported, or 0'''
+        return self._query_single("SELECT serial FROM snapshot_state WHERE source = ?", (source,)) or 0
+
     def get_sync_state(self, peername):
         return {
             "last_received": self._query_single("SELECT last_received FROM sync_state WHERE peername=?", (peername,)) or 0
@@ -1,12 +1,18 @@
 from tempfile import mkdtemp
 from shutil import rmtree
 from os import path
-from time import time
-
+from time import sleep, time
+from Queue import Queue
+import sqlite3
+from threading import Thread
+from uuid import uuid4
+
+from mock import patch
+from nose.plugins.skip import SkipTest
 from nose.tools import *
 from distdb.obj import TimedValues, Set, Object
-from distdb.database import DB
-from distdb.query import Key
+from distdb.database import AsyncCommitter, DB, shared_memory
+from distdb.query import Group, Key, ObjId, Sort
 
 HOURS = 3600
 
@@ -44,9 +50,251 @@ def test_DB_file_backed():
         assert_equal(obj1[u'name'], obj2[u'name'])
 
 
-class TestInRam():
+def test_DB_concurrent_reads():
+    with TempDir() as d:
+        db = DB(path.join(d.name, 'db'))
+        with db.transaction() as t:
+            t.update(Object(u'o', {u'k': TimedValues(u'old', t=1)}))
+
+        result = Queue()
+        with db.lock, db.transaction() as t:
+            t.update_attr(u'o', u'k', TimedValues(u'new', t=2))
+            assert_equal(db.get(u'o')[u'k'], Set([u'new']))
+
+            # Other threads read committed state without waiting for the lock
+            Thread(target=lambda: result.put(db.get(u'o'))).start()
+            assert_equal(result.get(timeout=5)[u'k'], Set([u'old']))
+
+        Thread(target=lambda: result.put(db.get(u'o'))).start()
+        assert_equal(result.get(timeout=5)[u'k'], Set([u'new']))
+
+
+def test_DB_incremental_vacuum():
+    with TempDir() as d:
+        db = DB(path.join(d.name, 'db'))
+        assert_equal(db._query_single("PRAGMA auto_vacuum"), 2)  # INCREMENTAL
+        with db.transaction() as t:
+            t.update_many([Object(u'obj%d' % i, {u'key': TimedValues(u'%d' % i * 1000, t=1)})
+                           for i in range(20)])
+        with db.transaction() as t:
+            for i in range(10):
+                t.delete(u'obj%d' % i, t=2)
+
+        steps = list(db.vacuum_steps(delete_grace=0, batch=3, time_slice=0))
+        phases = [phase for phase, _ in steps]
+        assert_equal(sum(removed for phase, removed in steps if phase == 'map'), 10)
+        assert_equal(sum(removed for phase, removed in steps if phase == 'lists'), 10)
+        assert_equal(sum(removed for phase, removed in steps if phase == 'objs'), 10)
+        assert_greater(phases.count('lists'), 3)
+        assert_in('pages', phases)
+        assert_equal(db._query_single("PRAGMA freelist_count"), 0)
+        assert_equal(db._query_single("SELECT COUNT(*) FROM list"), 10)
+        assert_equal(db._query_single("SELECT COUNT(*) FROM obj"), 10)
+        assert_equal(db.get(u'obj15')[u'key'], Set([u'15' * 1000]))
+
+        # Resumes from stored position
+        with db.transaction():
+            db.conn.execute("INSERT OR REPLACE INTO vacuum_state VALUES ('objs', 1000)")
+        steps = list(db.vacuum_steps(batch=3, time_slice=0))
+        assert_equal([x for x in steps if x[0] == 'objs'], [('objs', 0)])
+
+
+@patch('distdb.database.QUERY_FETCH_BATCH', 3)
+def test_DB_streaming_query():
+    with TempDir() as d:
+        db = DB(path.join(d.name, 'db'))
+        with db.transaction() as t:
+            t.update_many([Object(u'obj%d' % i, {u'key': TimedValues(u'v', t=1)}) for i in range(10)])
+
+        result = Queue()
+        ids = db.query_ids(Key(u'key').any())
+        assert_equal(len([next(ids) for _ in range(5)]), 5)
+
+        # Neither the lock, nor writers, are blocked while the query is open
+        def write():
+            with db.lock, db.transaction() as t:
+                t.update_attr(u'other', u'key', TimedValues(u'v', t=1))
+            result.put(True)
+        Thread(target=write).start()
+        assert_true(result.get(timeout=5))
+
+        assert_equal(len(list(ids)), 5)
+
+
+@patch('distdb.database.QUERY_FETCH_BATCH', 3)
+def test_DB_open_query_does_not_stale_reads():
+    with TempDir() as d:
+        db_path = path.join(d.name, 'db')
+        db = DB(db_path)
+        with db.transaction() as t:
+            t.update_many([Object(u'obj%d' % i, {u'k': TimedValues(u'v', t=1)}) for i in range(3000)])
+
+        # A partly consumed query keeps its statement, and read snapshot, open
+        objs = db.query(Key(u'k').any())
+        assert_is_not_none(next(objs))
+
+        with DB(db_path).transaction() as t:
+            t.update_attr(u'new', u'k', TimedValues(u'v', t=1))
+        assert_equal(db.get(u'new')[u'k'], Set([u'v']))
+
+        # Nor does it pin the connection to the thread that started it
+        result = Queue()
+        Thread(target=lambda: result.put(len(list(objs)))).start()
+        assert_equal(result.get(timeout=5), 2999)
+
+
+def test_DB_list_migration():
+    with TempDir() as d:
+        db_path = path.join(d.name, 'db')
+        db = DB(db_path)
+        with db.transaction():
+            db.conn.execute("DROP TABLE listhash")
+            db.conn.executemany("INSERT INTO list (listid, value) VALUES (?, ?)", [
+                (1, u'apa'), (1, u'banan'), (2, u'banan'), (2, u'apa'), (3, u'citron'),
+            ])
+            db.conn.executemany("INSERT INTO map (objid, keyid, timestamp, listid) VALUES (?, ?, ?, ?)", [
+                (db._get_id('obj', u'o1'), db.keys(u'k'), 1, 1),
+                (db._get_id('obj', u'o2'), db.keys(u'k'), 1, 2),
+                (db._get_id('obj', u'o3'), db.keys(u'k'), 1, 3),
+            ])
+        db.conn.execute("PRAGMA user_version = 0")
+
+        db = DB(db_path)
+        assert_equal(db._get_list_id([u'banan', u'apa']), 1)
+        assert_equal(db._get_list_id([u'citron']), 3)
+        assert_equal(db.get(u'o2')[u'k'], Set([u'apa', u'banan']))
+        assert_equal(db._query_single("SELECT COUNT(DISTINCT listid) FROM list"), 2)
+
+        with db.transaction() as t:
+            assert_equal(t._insert_list(Set([u'apa', u'banan'])), 1)
+            assert_equal(t._insert_list(Set([u'durian'])), 4)
+
+
+def test_DB_dirent_migration():
+    with TempDir() as d:
+        db_path = path.join(d.name, 'db')
+        db = DB(db_path)
+        with db.transaction() as t:
+            t.update_attr(u'f', u'directory', TimedValues([u'dir:/f', u'dir:x/y'], t=1))
+            db.conn.execute("DELETE FROM dirent")
+            db.conn.execute("DROP TABLE dirent_fts")
+        db.conn.execute("PRAGMA user_version = 1")
+
+        db = DB(db_path)
+        assert_equal(db.dir_paths(u'f'), set([(u'f',), (u'y',)]))
+        assert_equal([obj.id for obj in db.search(u'y')], [u'f'])
+
+
+def test_DB_name_index_created_later():
+    with TempDir() as d:
+        db_path = path.join(d.name, 'db')
+        db = DB(db_path)
+        with db.transaction() as t:
+            t.update_attr(u'f', u'directory', TimedValues(u'dir:/file', t=1))
+            # As if migrated by a SQLite without FTS5
+            db.conn.execute("DROP TABLE dirent_fts")
+        db = DB(db_path)
+        assert_true(db.fts)
+        assert_equal([obj.id for obj in db.search(u'file')], [u'f'])
+
+
+class TestSubscription:
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.db = DB(path.join(self.dir, 'db'))
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def _write_later(self, write):
+        def _():
+            sleep(0.1)
+            write()
+        Thread(target=_).start()
+
+    def test_delivered_once(self):
+        changes = self.db.subscribe()
+        assert_equal(changes.fetch(), [])
+        with self.db.transaction() as t:
+            t.update_attr(u'obj', u'key', TimedValues(u'value', t=1))
+            t.update_attr(u'obj', u'@private', TimedValues(u'value', t=1))
+        batch = changes.fetch()
+        assert_equal([(obj, key, values) for obj, key, _, _, values in batch], [(u'obj', u'key', set([u'value']))])
+        assert_equal(changes.fetch(), [])
+        assert_equal(self.db.subscribe(0).next(), batch)
+
+    def test_wakes_on_commit_in_process(self):
+        changes = self.db.subscribe()
+        assert_false(changes.wait(0.01))
+
+        def write():
+            with self.db.clone().transaction() as t:
+                t.update_attr(u'obj', u'key', TimedValues(u'value', t=1))
+        self._write_later(write)
+        start = time()
+        assert_equal(len(changes.next()), 1)
+        assert_less(time() - start, 1)
+
+    def test_wakes_on_commit_by_other_process(self):
+        changes = self.db.subscribe()
+
+        def write():
+            # A connection bypassing DB, like one in another process
+            with sqlite3.connect(self.db.path) as conn:
+                conn.execute("INSERT INTO map (objid, keyid, timestamp, listid) VALUES (1, 1, 1, NULL)")
+        self._write_later(write)
+        assert_true(changes.wait(5))
+
+
+class TestAsyncCommitter:
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.db = DB(path.join(self.dir, 'db'))
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_merges_pending(self):
+        with AsyncCommitter(self.db, max_age=60) as committer:
+            for i in range(10):
+                committer.update(Object(u'obj', {u'count': TimedValues(unicode(i), t=i)}))
+            committer.update(Object(u'obj', {u'older': TimedValues(u'x', t=1),
+                                             u'count': TimedValues(u'old', t=0)}))
+        assert_equal(self.db[u'obj'][u'count'], Set([u'9']))
+        assert_equal(self.db[u'obj'][u'older'], Set([u'x']))
+
+        stats = committer.stats()
+        assert_equal(stats['updates'], 11)
+        assert_equal(stats['merged'], 10)
+        assert_equal(stats['flushes'], 1)
+        assert_equal(stats['flushed'], 1)
+        assert_equal(stats['depth'], 0)
+
+    def test_flush_size(self):
+        with AsyncCommitter(self.db, max_age=60, flush_size=2) as committer:
+            committer.update(Object(u'obj1', {u'key': TimedValues(u'value', t=1)}))
+            committer.update(Object(u'obj2', {u'key': TimedValues(u'value', t=1)}))
+            for _ in range(50):
+                if committer.stats()['flushes']:
+                    break
+                sleep(0.1)
+            assert_equal(self.db[u'obj2'][u'key'], Set([u'value']))
+
+    def test_backpressure(self):
+        with AsyncCommitter(self.db, max_age=0.2, max_pending=1) as committer:
+            committer.update(Object(u'obj1', {u'key': TimedValues(u'value', t=1)}))
+            committer.update(Object(u'obj1', {u'key': TimedValues(u'value', t=2)}))
+            start = time()
+            committer.update(Object(u'obj2', {u'key': TimedValues(u'value', t=1)}))
+            assert_greater(time() - start, 0.1)
+        assert_greater(committer.stats()['blocked_time'], 0.1)
+        assert_equal(committer.stats()['max_depth'], 1)
+
+
+class BackendTests(object):
+    '''Behaviour common to all DB backends, run by subclasses implementing make_db()'''
     def setup(self):
-        self.db = db = DB(':memory:')
+        self.db = db = self.make_db()
         self.o = o = db.get('some_id')
         o[u'key'] = TimedValues([u'Test Person', u'And alternatives'], t=1)
         with self.db.transaction() as t:
@@ -66,6 +314,17 @@ class TestInRam():
             t.update(self.o)
         assert_equal(self.db[self.o.id], self.o)
 
+    def test_get_many(self):
+        with self.db.transaction() as t:
+            other = t.update(Object(u'other_id', init={u'key': TimedValues(u'Other Person', t=1),
+                                                       u'extra': TimedValues(u'x', t=1)}))
+        assert_equal(list(self.db.get_many([self.o.id, other.id, u'missing_id', self.o.id])),
+                     [self.o, other, Object(u'missing_id'), self.o])
+
+        o1, o2 = self.db.get_many([self.o.id, other.id], fields=(u'extra',))
+        assert_not_in(u'key', o1)
+        assert_equal(o2, Object(u'other_id', init={u'extra': TimedValues(u'x', t=1)}))
+
     def test_get_with_fields(self):
         o = self.db.get('some_id', fields="noexisting")
         assert_not_in(u'key', o)
@@ -81,6 +340,19 @@ class TestInRam():
             pass
         assert_not_in(u'name', self.db[self.o.id])
 
+    def test_rollback_does_not_notify(self):
+        generation = self.db.changes.generation
+        try:
+            with self.db.transaction() as t:
+                t.update_attr(self.o.id, u'name', TimedValues(u'Test Person', t=2))
+                raise KeyError
+        except KeyError:
+            pass
+        assert_equal(self.db.changes.generation, generation)
+        with self.db.transaction() as t:
+            t.update_attr(self.o.id, u'name', TimedValues(u'Test Person', t=2))
+        assert_not_equal(self.db.changes.generation, generation)
+
     def test_success_transaciton(self):
         with self.db.transaction() as t:
             self.o[u'name'] = Set(u'Test Person')
@@ -94,6 +366,70 @@ class TestInRam():
         assert_in(self.o, list(self.db.query(Key('apa').missing())))
         assert_in(self.o, list(self.db.query(Key('key').startswith('Test'))))
 
+    def test_query_combined(self):
+        with self.db.transaction() as t:
+            other = t.update(Object(u'other_id', init={u'key': TimedValues(u'Other Person', t=1),
+                                                       u'extra': TimedValues(u'x', t=1)}))
+        assert_equal(list(self.db.query((Key('key').any(), Key('extra') == u'x'))), [other])
+        assert_equal(list(self.db.query((Key('extra').any(), Key('key').startswith(u'Test')))), [])
+        assert_equal(list(self.db.query((ObjId.startswith(u'other'), Key('key').any()))), [other])
+        # Once per object, regardless of its number of keys
+        assert_equal(sorted(self.db.query(Key('apa').missing()), key=lambda o: o.id), [other, self.o])
+        assert_equal(list(self.db.query((ObjId.startswith(u'some'), Key('extra').missing()))), [self.o])
+        assert_equal(list(self.db.query((Key('extra').any(), Key('key').missing()))), [])
+
+    def test_query_pages(self):
+        with self.db.transaction() as t:
+            for i in range(5):
+                t.update(Object(u'obj%d' % i, init={u'n': TimedValues([u'%d' % i, u'x%d' % i], t=10 - i % 2)}))
+
+        def pages(query, position, **kwargs):
+            page = list(query(limit=2, **kwargs))
+            while page:
+                yield page
+                page = list(query(limit=2, after=position(page[-1]), **kwargs))
+
+        # All paged methods continue after an object id, in the order objects were first stored
+        ids = [u'obj%d' % i for i in range(5)]
+        id_pages = list(pages(lambda **kw: self.db.query_ids(Key('n').any(), **kw), lambda id: id))
+        assert_equal([len(page) for page in id_pages], [2, 2, 1])
+        assert_equal(sum(id_pages, []), ids)
+        paged = [obj for page in pages(lambda **kw: self.db.query(Key('n').any(), **kw), lambda obj: obj)
+                 for obj in page]
+        assert_equal([obj.id for obj in paged], ids)
+
+        for sortmeth, key in ((Sort.value, '+n'), (Sort.value, '-n'), (Sort.timestamp, '-n'), (Sort.split('x'), '+n')):
+            query = lambda **kw: self.db.query_keyed(Key('n').any(), key, sortmeth=sortmeth, **kw)
+            rows = [(value, obj.id) for value, obj in query()]
+            paged = [(value, obj.id) for page in pages(query, lambda (value, obj): (value, obj)) for value, obj in page]
+            assert_equal(len(paged), 10)
+            if sortmeth == Sort.timestamp:
+                assert_equal(sorted(paged), sorted(rows))
+            else:
+                assert_equal(paged, rows)
+
+        assert_raises(KeyError, lambda: list(self.db.query(Key('n').any(), after=u'unknown')))
+        assert_raises(KeyError, lambda: list(self.db.query_ids(Key('n').any(), after=u'unknown')))
+        assert_raises(KeyError, list, self.db.query_keyed(Key('n').any(), '+n', after=(u'0', u'obj1')))
+
+    def test_aggregate(self):
+        with self.db.transaction() as t:
+            for i, (parent, size, avail) in enumerate([(u'a', u'10', u'1'), (u'a', u'5', u'-1'), (u'b', u'7x', u'2')]):
+                t.update(Object(u'f%d' % i, init={u'directory': TimedValues(u'%s/f%d' % (parent, i), t=1),
+                                                  u'size': TimedValues(size, t=1),
+                                                  u'avail': TimedValues(avail, t=100 + i)}))
+
+        files = Key('directory').any()
+        assert_equal(list(self.db.aggregate(()).count()), [(4,)])
+        assert_equal(list(self.db.aggregate(files).count().sum(Key('size'))), [(3, 22)])
+        assert_equal(list(self.db.aggregate(Key('nokey').any()).count().sum(Key('size'))), [(0, None)])
+        assert_equal(list(self.db.aggregate((Key('avail') > 0,)).sum(Key('size'))), [(17,)])
+        assert_equal(list(self.db.aggregate((Key('avail').timed_after(101),)).count()), [(2,)])
+        assert_equal(sorted(self.db.aggregate(files).group_by(Key('directory'), Group.prefix('/'))
+                            .count().sum(Key('size'))), [(u'a', 2, 15), (u'b', 1, 7)])
+        assert_equal(sorted(self.db.aggregate(files).group_by(Key('avail')).count()),
+                     [(u'-1', 1), (u'1', 1), (u'2', 1)])
+
     def test_query_keyed(self):
         p1 = self.db.get("some_id")
         with self.db.transaction() as t:
@@ -132,6 +468,39 @@ class TestInRam():
             t.update_attr(o.id, 'key', TimedValues(u"future", future(100, HOURS)))
             assert_equal(db.get(o.id)[u'key'], set((u"future",)))
 
+    def test_update_many(self):
+        objs = [Object(u'obj%d' % i, {u'key': TimedValues(u'v%d' % (i % 3), t=2)}) for i in range(10)]
+        self.o[u'key'] = TimedValues(u'new', t=1)
+        with self.db.transaction() as t:
+            t.update_many(objs + [self.o])
+        for o in objs + [self.o]:
+            assert_false(o.dirty())
+            assert_equal(self.db[o.id], o)
+
+    def test_lists_with_separators(self):
+        with self.db.transaction() as t:
+            t.update_attr(u'a', u'k', TimedValues([u'x\0y'], t=1))
+            t.update_attr(u'b', u'k', TimedValues([u'x', u'y'], t=1))
+        assert_equal(self.db[u'a'][u'k'], Set([u'x\0y']))
+        assert_equal(self.db[u'b'][u'k'], Set([u'x', u'y']))
+
+    def test_update_attrs(self):
+        with self.db.transaction() as t:
+            serials = t.update_attrs([
+                (self.o.id, u'key', TimedValues(u'older', t=0)),
+                (self.o.id, u'key', TimedValues(u'same', t=1)),
+                (u'new_id', u'key', TimedValues(u'first', t=1)),
+                (u'new_id', u'key', TimedValues(u'second', t=2)),
+                (u'new_id', u'empty', TimedValues([], t=2)),
+                (self.o.id, u'other', [u'apa']),
+            ])
+        assert_equal(serials[:2], [False, False])
+        assert_equal(serials[2], serials[3])
+        assert_equal(serials[4], False)
+        assert_equal(serials[5], self.db.last_serial())
+        assert_equal(self.db[u'new_id'], Object(u'new_id', {u'key': TimedValues(u'second', t=2)}))
+        assert_equal(self.db[self.o.id][u'other'], Set([u'apa']))
+
     def test_del_attr(self):
         db, o1 = self.db, self.o
         with self.db.transaction() as t:
@@ -152,22 +521,6 @@ class TestInRam():
         assert_equal(db[o.id], Object(o.id))
         assert_equal(list(db.query(Key("key").any())), [])
 
-    def test_vacuum(self):
-        db, o = self.db, self.o
-        with self.db.transaction() as t:
-            t.delete(o)
-        assert_is_not_none(db._get_list_id(o[u'key']))
-        assert_is_not_none(db._get_id('key', u'key'))
-        assert_is_not_none(db._get_id('obj', o.id))
-        db.vacuum()
-        assert_is_none(db._get_list_id(self.o[u'key']))
-        assert_is_not_none(db._get_id('key', u'key'))
-        assert_is_not_none(db._get_id('obj', o.id))
-        db.vacuum(0)
-        assert_is_none(db._get_list_id(self.o[u'key']))
-        assert_is_not_none(db._get_id('key', u'key'))
-        assert_is_not_none(db._get_id('obj', o.id))
-
     def test_get_public_mappings_after(self):
         items = self.db.get_public_mappings_after()
         item = next((x for x in items if x[0] == u'some_id'), None)
@@ -184,10 +537,129 @@ class TestInRam():
         assert_equal(del_item[3], self.db.last_serial())
         assert_equal(del_item[4], set([]))
 
+    def test_readonly(self):
+        o = self.db.get(self.o.id, readonly=True)
+        assert_equal(o, self.o)
+        assert_raises(TypeError, o.set, u'key', u'value')
+        assert_equal([obj.id for obj in self.db.query(Key('key').any(), readonly=True)], [self.o.id])
+        assert_equal(self.db.get(self.o.id, fields=(u'other',), readonly=True), Object(self.o.id))
+
     def test_sync_state(self):
         assert_equal(self.db.get_sync_state('my_peer'), {"last_received": 0})
         self.db.set_sync_state('my_peer', 2)
         assert_equal(self.db.get_sync_state('my_peer'), {"last_received": 2})
+        assert_equal(self.db.snapshot_serial('my_peer'), 0)
+
+    def test_clone(self):
+        clone = self.db.clone()
+        assert_equal(clone[self.o.id], self.o)
+        with clone.transaction() as t:
+            t.update_attr(u'other_id', u'key', TimedValues(u'value', t=1))
+        assert_in(u'key', self.db[u'other_id'])
+        with self.db.transaction() as t:
+            t.update_attr(u'third_id', u'key', TimedValues(u'value', t=1))
+        assert_in(u'key', clone[u'third_id'])
+
+    def test_dirents(self):
+        db = self.db
+        with db.transaction() as t:
+            t.update_attr(u'dir:a', u'directory', TimedValues(u'dir:/a', t=1))
+            t.update_attr(u'f1', u'directory', TimedValues([u'dir:a/b', u'dir:a/x', u'broken'], t=1))
+            t.update_attr(u'f2', u'directory', TimedValues(u'dir:a/a', t=1))
+
+        assert_equal([(name, obj.id) for name, obj in db.dir_children([u'dir:a'])],
+                     [(u'a', u'f2'), (u'b', u'f1'), (u'x', u'f1')])
+        assert_equal([obj.id for _, obj in db.dir_children([u'dir:a', u'dir:'], name=u'a')], [u'dir:a', u'f2'])
+        assert_equal(db.dir_paths(u'f1'), set([(u'a', u'b'), (u'a', u'x')]))
+        assert_equal(db.dir_paths(u'dir:'), set([()]))
+        assert_equal(db.dir_paths(u'unknown'), set([()]))
+
+        with db.transaction() as t:
+            # Older assignments do not touch the index
+            t.update_attr(u'f1', u'directory', TimedValues(u'dir:/f1', t=0))
+            t.update_attr(u'f2', u'directory', TimedValues(u'dir:/f2', t=2))
+            t.delete(u'dir:a', t=2)
+        assert_equal([name for name, _ in db.dir_children([u'dir:'])], [u'f2'])
+        assert_equal(db.dir_paths(u'dir:a'), set([()]))
+        assert_equal(db.dir_paths(u'f1'), set([(u'b',), (u'x',)]))
+
+    def test_dir_paths_malformed(self):
+        db = self.db
+        with db.transaction() as t:
+            t.update_attr(u'dir:broken', u'directory', TimedValues(u'dir:x/', t=1))
+            t.update_attr(u'f', u'directory', TimedValues([u'dir:broken/f', u'dir:/g'], t=1))
+        # Like an object in no directory, but the path through it is dropped
+        assert_equal(db.dir_paths(u'dir:broken'), set())
+        assert_equal(db.dir_paths(u'f'), set([(u'g',)]))
+
+    def test_search(self):
+        db = self.db
+        with db.transaction() as t:
+            t.update_attr(u'f1', u'directory', TimedValues([u'dir:a/Some.Movie.2001.mkv', u'dir:b/movie'], t=1))
+            t.update_attr(u'f2', u'directory', TimedValues(u'dir:a/other_movie_2001.avi', t=1))
+            t.update_attr(u'f3', u'directory', TimedValues(u'dir:a/some "quoted" file', t=1))
+
+        assert_equal(sorted(obj.id for obj in db.search(u'movie 2001')), [u'f1', u'f2'])
+        assert_equal([obj.id for obj in db.search(u'movie')], [u'f1', u'f2'])
+        assert_equal([obj.id for obj in db.search(u'mov AVI')], [u'f2'])
+        assert_equal([obj.id for obj in db.search(u'"quoted"')], [u'f3'])
+        assert_equal(list(db.search(u' ')), [])
+
+        with db.transaction() as t:
+            t.update_attr(u'f1', u'directory', TimedValues(u'dir:a/renamed', t=2))
+            t.delete(u'f2')
+        assert_equal(list(db.search(u'movie')), [])
+        assert_equal([obj.id for obj in db.search(u'renamed')], [u'f1'])
+
+
+class TestInRam(BackendTests):
+    def make_db(self):
+        return DB(':memory:')
+
+    def test_clone(self):
+        raise SkipTest("Private in-memory databases can not be re-opened")
+
+    def test_get_many(self):
+        super(TestInRam, self).test_get_many()
+        objid = self.db._get_id('obj', u'other_id')
+        assert_equal(list(self.db.get_many([objid, self.o.id])), [self.db[u'other_id'], self.o])
+
+    def test_update_many(self):
+        super(TestInRam, self).test_update_many()
+        assert_equal(self.db._query_single("SELECT COUNT(*) FROM listhash"), 5)
+
+    def test_vacuum(self):
+        db, o = self.db, self.o
+        with self.db.transaction() as t:
+            t.delete(o)
+        assert_is_not_none(db._get_list_id(o[u'key']))
+        assert_is_not_none(db._get_id('key', u'key'))
+        assert_is_not_none(db._get_id('obj', o.id))
+        db.vacuum()
+        assert_is_none(db._get_list_id(self.o[u'key']))
+        assert_is_not_none(db._get_id('key', u'key'))
+        assert_is_not_none(db._get_id('obj', o.id))
+        db.vacuum(0)
+        assert_is_none(db._get_list_id(self.o[u'key']))
+        assert_is_not_none(db._get_id('key', u'key'))
+        assert_is_not_none(db._get_id('obj', o.id))
+
+    def test_loads_in_one_statement(self):
+        db = self.db
+        with db.transaction() as t:
+            t.update_attr(u'dir:a', u'directory', TimedValues(u'dir:/a', t=1))
+            t.update_attr(u'f1', u'directory', TimedValues([u'dir:a/b', u'dir:a/c'], t=1))
+            t.update_attr(u'f1', u'filesize', TimedValues(u'5', t=1))
+            t.update_attr(u'f2', u'directory', TimedValues(u'dir:a/d', t=1))
+        query_iter = db._query_iter
+        with patch.object(db, '_query_iter', side_effect=query_iter) as statements:
+            assert_equal([(name, obj.id, obj.get(u'filesize')) for name, obj in
+                          db.dir_children([u'dir:a'], fields=(u'filesize',))],
+                         [(u'b', u'f1', set([u'5'])), (u'c', u'f1', set([u'5'])), (u'd', u'f2', None)])
+            assert_equal(statements.call_count, 1)
+
+            assert_equal([obj.id for obj in db.query(Key(u'filesize').any())], [u'f1'])
+            assert_equal(statements.call_count, 2)
 
     def test_select(self):
         assert_equal(
@@ -199,3 +671,99 @@ class TestInRam():
             self.db._select('objid').where(Key('NONE_EXISTING').any()).apply(),
             ("SELECT objid FROM map WHERE LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL", (2,))
         )
+
+    def test_prefix_uses_index(self):
+        def plan(crit):
+            query, args = self.db._select('objid').where(crit).apply()
+            return ' '.join(row[-1] for row in self.db.conn.execute("EXPLAIN QUERY PLAN " + query, args))
+
+        assert_in('INDEX obj_obj (obj>? AND obj<?)', plan(ObjId.startswith('tree:tiger:')))
+        assert_in('INDEX list_value (value>? AND value<?)', plan(Key('directory').startswith(u'dir:')))
+        assert_equal(list(self.db.query_ids(ObjId.startswith(u'some_'))), [self.o.id])
+        assert_equal(list(self.db.query_ids(ObjId.startswith(u'some_j'))), [])
+
+    def test_conditions_use_index(self):
+        def plan(*crit):
+            query, args = self.db._select('objid').where(*crit).apply()
+            return ' '.join(row[-1] for row in self.db.conn.execute("EXPLAIN QUERY PLAN " + query, args))
+
+        probe = 'COVERING INDEX map_obj_keys (objid=? AND keyid=?'
+        assert_in(probe, plan(Key('key').any(), Key('extra') == u'x'))
+        missing = plan(ObjId.startswith(u'some'), Key('extra').missing())
+        assert_in(probe, missing)
+        assert_not_in('SCAN', missing)
+
+
+class TestSharedMemory(BackendTests):
+    def make_db(self):
+        return DB(shared_memory(uuid4().hex))
+
+
+class TestObjectCache():
+    def setup(self):
+        self.tmp = TempDir()
+        self.db = DB(path.join(self.tmp.name, 'db'), object_cache=2)
+        with self.db.transaction() as t:
+            for id in (u'o1', u'o2', u'o3'):
+                t.update(Object(id, {u'key': TimedValues(id, t=1)}))
+
+    def teardown(self):
+        self.tmp.__exit__(None, None, None)
+
+    def test_hit_miss_evict(self):
+        cache = self.db.cache
+        assert_equal(self.db[u'o1'][u'key'], Set([u'o1']))
+        assert_equal((cache.hits, cache.misses), (0, 1))
+        assert_equal(self.db[u'o1'][u'key'], Set([u'o1']))
+        assert_equal((cache.hits, cache.misses), (1, 1))
+        self.db.get(u'o2')
+        self.db.get(u'o3')
+        assert_equal(cache.stats(), dict(size=2, hits=1, misses=3, evictions=1, invalidations=0))
+
+    def test_returns_copies(self):
+        o = self.db[u'o1']
+        o[u'key'] = TimedValues(u'changed', t=2)
+        assert_equal(self.db[u'o1'][u'key'], Set([u'o1']))
+        assert_equal(self.db.get(u'o1', fields=(u'other',)), Object(u'o1'))
+
+    def test_readonly_shares_cache(self):
+        o = self.db.get(u'o1', readonly=True)
+        assert_is(self.db.get(u'o1', readonly=True)._dict, o._dict)
+        assert_is_not(self.db.get(u'o1')._dict, o._dict)
+        assert_equal(self.db.get(u'o1', fields=(u'other',), readonly=True), Object(u'o1'))
+
+    def test_invalidate_on_write(self):
+        o1 = self.db[u'o1']
+        with self.db.transaction() as t:
+            t.update_attr(u'o1', u'key', TimedValues(u'attr', t=2))
+        assert_equal(self.db[u'o1'][u'key'], Set([u'attr']))
+
+        o1.set(u'key', u'update', t=3)
+        with self.db.transaction() as t:
+            t.update(o1)
+        assert_equal(self.db[u'o1'][u'key'], Set([u'update']))
+
+        with self.db.transaction() as t:
+            t.delete(u'o1')
+        assert_equal(self.db[u'o1'], Object(u'o1'))
+
+    def test_rollback(self):
+        self.db.get(u'o1')
+        try:
+            with self.db.transaction() as t:
+                t.update_attr(u'o1', u'key', TimedValues(u'attr', t=2))
+                assert_equal(self.db[u'o1'][u'key'], Set([u'attr']))
+                raise KeyError
+        except KeyError:
+            pass
+        assert_equal(self.db[u'o1'][u'key'], Set([u'o1']))
+
+    def test_other_connection(self):
+        self.db.get(u'o1')
+        self.db.get(u'o2')
+        other = DB(self.db.path)
+        with other.transaction() as t:
+            t.update_attr(u'o1', u'key', TimedValues(u'other', t=2))
+        assert_equal(self.db[u'o1'][u'key'], Set([u'other']))
+        assert_equal(self.db.cache.invalidations, 1)
+        assert_equal(self.db[u'o2'][u'key'], Set([u'o2']))
@@ -0,0 +1,169 @@
+'''Opt-in instrumentation of the SQL run by DB, for finding slow queries.
+
+Statements are grouped by their shape, and latency histograms and row counts
+are collected per shape. Statistics are periodically merged into a JSON-file,
+shared by all processes using the same DB, together with the counters of the
+object caches of the DB:s.'''
+
+import atexit
+import fcntl
+import json
+import logging
+import re
+from os import fdopen, path, rename, unlink
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+from weakref import WeakKeyDictionary
+
+log = logging.getLogger('distdb.queries')
+
+# Upper bounds (in milliseconds) of the latency histogram buckets. A last bucket catches the rest.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Seconds between merging collected statistics into the stats file
+SAVE_INTERVAL = 60
+
+# Prepared statements kept per connection by the sqlite3 module (LRU, by SQL text)
+STATEMENT_CACHE = 100
+
+# Key of the summed ObjectCache counters in the stats file, besides the statement shapes
+CACHE_STATS = "object_cache"
+CACHE_COUNTERS = ("hits", "misses", "evictions", "invalidations")
+
+_PLACEHOLDER_LIST = re.compile(r'\?(\s*,\s*\?)+')
+
+
+def shape(query):
+    '''Normalizes query, so that IN-lists of different lengths count as the same statement'''
+    return _PLACEHOLDER_LIST.sub('?, ...', ' '.join(query.split()))
+
+
+def _new_entry():
+    return {"count": 0, "time": 0.0, "max": 0.0, "rows": 0, "histogram": [0] * (len(BUCKETS) + 1), "plan": None}
+
+
+def _merge(dst, src):
+    dst["count"] += src["count"]
+    dst["time"] += src["time"]
+    dst["max"] = max(dst["max"], src["max"])
+    dst["rows"] += src["rows"]
+    dst["histogram"] = [a + b for a, b in zip(dst["histogram"], src["histogram"])]
+    dst["plan"] = src["plan"] or dst["plan"]
+
+
+def percentile(entry, p):
+    '''Estimates the p:th percentile latency (in ms) of entry, from its histogram'''
+    limit = entry["count"] * p
+    seen = 0
+    for bound, n in zip(BUCKETS, entry["histogram"]):
+        seen += n
+        if seen >= limit:
+            return bound
+    return entry["max"] * 1000
+
+
+class QueryStats(object):
+    def __init__(self, path, slow_threshold):
+        '''Collects statistics into `path`. Statements slower than `slow_threshold`
+        seconds are logged with their query plan.'''
+        self.path = path
+        self.slow_threshold = slow_threshold
+        self.lock = Lock()
+        self._pending = {}
+        self._plans = {}
+        # Counters of each watched ObjectCache, as of the last save
+        self._caches = WeakKeyDictionary()
+        self._saved = time()
+        atexit.register(self.save)
+
+    @staticmethod
+    def path_for(db_path):
+        return db_path + '.querystats'
+
+    @staticmethod
+    def load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def watch(self, cache):
+        '''Includes the hits, misses, evictions and invalidations of the ObjectCache
+        `cache` in the saved statistics, for as long as it is in use.'''
+        with self.lock:
+            self._caches[cache] = dict.fromkeys(CACHE_COUNTERS, 0)
+
+    def _cache_deltas(self):
+        deltas = dict.fromkeys(CACHE_COUNTERS, 0)
+        for cache, last in self._caches.items():
+            current = cache.stats()
+            for counter in CACHE_COUNTERS:
+                deltas[counter] += current[counter] - last[counter]
+                last[counter] = current[counter]
+        return deltas
+
+    def record(self, query, elapsed, rows, explain):
+        '''Records one execution of query. `explain` is called for the query plan of
+        slow statements.'''
+        key = shape(query)
+        ms = elapsed * 1000
+        plan = None
+        if elapsed >= self.slow_threshold:
+            plan = self._plans.get(key)
+            if plan is None:
+                try:
+                    plan = self._plans[key] = explain()
+                except Exception:
+                    log.exception("Failed to explain query: %s", key)
+            log.warning("Slow query (%.1fms, %d rows): %s\n%s", ms, rows, key, plan)
+
+        with self.lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                entry = self._pending[key] = _new_entry()
+            entry["count"] += 1
+            entry["time"] += elapsed
+            entry["max"] = max(entry["max"], elapsed)
+            entry["rows"] += rows
+            entry["histogram"][sum(1 for bound in BUCKETS if ms > bound)] += 1
+            if plan:
+                entry["plan"] = plan
+            due = time() - self._saved > SAVE_INTERVAL
+        if due:
+            self.save()
+
+    def save(self):
+        '''Merges collected statistics into the stats file'''
+        with self.lock:
+            pending, self._pending = self._pending, {}
+            cache = self._cache_deltas()
+            self._saved = time()
+        if not pending and not any(cache.itervalues()):
+            return
+
+        try:
+            # Other processes merge into the same file
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                stats = self.load(self.path)
+                for key, entry in pending.iteritems():
+                    _merge(stats.setdefault(key, _new_entry()), entry)
+                if any(cache.itervalues()):
+                    totals = stats.setdefault(CACHE_STATS, dict.fromkeys(CACHE_COUNTERS, 0))
+                    for counter, n in cache.iteritems():
+                        totals[counter] += n
+                self._write(stats)
+        except (IOError, OSError):
+            log.exception("Failed to save query statistics to %s", path.abspath(self.path))
+
+    def _write(self, stats):
+        fd, tmp = mkstemp(prefix=path.basename(self.path) + '.', dir=path.dirname(path.abspath(self.path)))
+        try:
+            with fdopen(fd, 'w') as f:
+                json.dump(stats, f)
+            rename(tmp, self.path)
+        except:
+            unlink(tmp)
+            raise
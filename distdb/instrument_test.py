@@ -0,0 +1,84 @@
+from os import listdir, path
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+
+from nose.tools import *
+
+from distdb.database import DB
+from distdb.instrument import CACHE_STATS, QueryStats, percentile, shape
+from distdb.obj import TimedValues
+from distdb.query import Key
+
+
+def test_shape():
+    assert_equal(shape("SELECT x FROM y\n  WHERE z IN (?, ?,?) AND w = ?"),
+                 "SELECT x FROM y WHERE z IN (?, ...) AND w = ?")
+    assert_equal(shape("SELECT x FROM y WHERE z = ?"), "SELECT x FROM y WHERE z = ?")
+
+
+class TestQueryStats:
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = path.join(self.dir, 'stats')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_record_and_save(self):
+        stats = QueryStats(self.path, slow_threshold=1)
+        stats.record("SELECT ?", 0.0015, 1, None)
+        stats.record("SELECT ?", 0.0005, 3, None)
+        stats.save()
+        stats.record("SELECT ?", 0.0005, 0, None)
+        stats.save()
+
+        entry = QueryStats.load(self.path)["SELECT ?"]
+        assert_equal(entry["count"], 3)
+        assert_equal(entry["rows"], 4)
+        assert_almost_equal(entry["max"], 0.0015)
+        assert_equal(percentile(entry, 0.5), 1)
+        assert_equal(percentile(entry, 1), 2)
+
+    def test_concurrent_saves(self):
+        def save():
+            stats = QueryStats(self.path, slow_threshold=1)
+            for _ in range(20):
+                stats.record("SELECT ?", 0, 1, None)
+                stats.save()
+        threads = [Thread(target=save) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # Neither counts, nor temporary files, are lost
+        assert_equal(QueryStats.load(self.path)["SELECT ?"]["count"], 160)
+        assert_equal(sorted(listdir(self.dir)), ['stats', 'stats.lock'])
+
+    def test_slow_queries_explained(self):
+        stats = QueryStats(self.path, slow_threshold=0)
+        db = DB(path.join(self.dir, 'db'), query_stats=stats)
+        with db.transaction() as t:
+            t.update_attr(u'obj', u'key', TimedValues(u'value', t=1))
+        list(db.query_ids(Key(u'key').any()))
+        stats.save()
+
+        entries = QueryStats.load(self.path)
+        assert_true(entries)
+        assert_true(all(entry["plan"] for entry in entries.itervalues()))
+
+    def test_cache_counters(self):
+        stats = QueryStats(self.path, slow_threshold=1)
+        db = DB(path.join(self.dir, 'db'), object_cache=1, query_stats=stats)
+        with db.transaction() as t:
+            t.update_attr(u'o1', u'key', TimedValues(u'value', t=1))
+            t.update_attr(u'o2', u'key', TimedValues(u'value', t=1))
+        db.get(u'o1')
+        db.get(u'o1')
+        stats.save()
+        db.get(u'o2')
+        stats.save()
+
+        assert_equal(QueryStats.load(self.path)[CACHE_STATS],
+                     dict(hits=1, misses=2, evictions=1, invalidations=0))
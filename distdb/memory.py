@@ -0,0 +1,589 @@
+'''Pure-Python implementation of the DB interface, keeping everything in dicts.
+
+Intended for tests and for benchmarking the Python overhead separately from
+SQLite. Nothing is persisted, and transactions are serialized by holding the DB
+lock from begin to commit. Objects are looked up by id only (no objid), and
+low-level SQL access (_query_*, snapshots, migrations) is not available.'''
+
+from bisect import bisect_right
+from functools import wraps
+from itertools import islice
+import logging
+import re
+from thread import get_ident
+from threading import RLock
+from time import time
+from unicodedata import combining, normalize
+
+from database import DEFAULT_GRACE, MAX_DIR_DEPTH, SEARCH_LIMIT, WRITE_BATCH, \
+    ChangeNotifier, Subscription, _batched, _parse_sort
+from obj import Object, ReadOnlyObject, Set, TimedValues
+from query import Key as QueryKey, AndCondition, Condition, Equals, Greater, Group, KeyAny, KeyMissing, \
+    Matcher, OrCondition, Sort, Starts, TimedAfter, TimedBefore
+from _setup import DIRECTORY_KEY, split_dirent
+
+log = logging.getLogger('distdb')
+
+_WORD = re.compile(r'[^\W_]+', re.UNICODE)
+_NUMBER = re.compile(r'\s*[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?')
+
+# Python equivalents of the expressions returned by the Sort-methods
+_SORT_KEYS = {
+    "value": lambda (value, t), _: value,
+    "timestamp": lambda (value, t), _: t,
+    "substr(value, instr(value, ?))": lambda (value, t), (c,): value[max(value.find(c), 0):],
+}
+
+# Python equivalents of the expressions returned by the Group-methods
+_GROUP_KEYS = {
+    "value": lambda value, _: value,
+    "substr(value, 1, instr(value, ?) - 1)": lambda value, (c,): value.partition(c)[0] if c in value else u'',
+}
+
+
+def _numeric(value):
+    '''Returns value as a number, like CAST(value AS NUMERIC) in SQLite'''
+    match = _NUMBER.match(value)
+    if not match:
+        return 0
+    number = match.group(0)
+    try:
+        return int(number)
+    except ValueError:
+        return float(number)
+
+
+def _tokens(text):
+    '''Splits text into case- and diacritics-folded words, like the FTS5 unicode61 tokenizer'''
+    text = u''.join(c for c in normalize('NFKD', text.lower()) if not combining(c))
+    return _WORD.findall(text)
+
+
+def _accepts(comparer, value):
+    if isinstance(comparer, OrCondition):
+        return any(_accepts(c, value) for c in comparer)
+    _, expected = comparer
+    if isinstance(comparer, Equals):
+        return value == expected
+    elif isinstance(comparer, Starts):
+        return value.startswith(expected)
+    elif isinstance(comparer, Greater):
+        return _numeric(value) > expected
+    raise TypeError("Unsupported comparison %r" % (comparer,))
+
+
+def _matches(crit, obj, attrs):
+    '''Evaluates query-condition crit for object obj, with attributes {key: (t, values, serial)}'''
+    if isinstance(crit, Matcher):
+        _, what, comparer = crit
+        if isinstance(what, QueryKey):
+            values = attrs.get(what.v, (None, ()))[1]
+        else:
+            values = (obj,)
+        return any(_accepts(comparer, value) for value in values)
+    elif isinstance(crit, AndCondition):
+        return all(_matches(c, obj, attrs) for c in crit)
+    elif isinstance(crit, OrCondition):
+        return any(_matches(c, obj, attrs) for c in crit)
+    elif isinstance(crit, KeyAny):
+        key, = crit
+        return bool(attrs.get(key.v, (None, ()))[1])
+    elif isinstance(crit, KeyMissing):
+        key, = crit
+        return not attrs.get(key.v, (None, ()))[1]
+    elif isinstance(crit, TimedAfter):
+        key, timestamp = crit
+        t, values, _ = attrs.get(key.v, (None, (), None))
+        return bool(values) and t >= timestamp
+    elif isinstance(crit, TimedBefore):
+        key, timestamp = crit
+        t, values, _ = attrs.get(key.v, (None, (), None))
+        return bool(values) and t < timestamp
+    raise TypeError("Unsupported condition %r" % (crit,))
+
+
+class MemoryAggregate(object):
+    '''Python equivalent of query.Aggregate, over the objects matching criteria'''
+    def __init__(self, db, criteria):
+        self.db = db
+        self.criteria = criteria
+        self.aggregates = list()
+        self.grouping = ()
+
+    def count(self):
+        self.aggregates.append(len)
+        return self
+
+    def sum(self, key):
+        def total(objs):
+            sums = [sum(_numeric(value) for value in attrs[key.v][1]) for attrs in objs
+                    if attrs.get(key.v, (None, ()))[1]]
+            return sum(sums) if sums else None
+        self.aggregates.append(total)
+        return self
+
+    def group_by(self, key, meth=Group.value):
+        self.grouping = (key, meth)
+        return self
+
+    def __iter__(self):
+        ids = self.db.query_ids(self.criteria)
+        with self.db.lock:
+            objs = [self.db._objs[obj] for obj in ids]
+        if not self.grouping:
+            yield tuple(aggregate(objs) for aggregate in self.aggregates)
+            return
+
+        key, meth = self.grouping
+        expr, params = meth()
+        group_key = _GROUP_KEYS[expr]
+        groups = dict()
+        for attrs in objs:
+            for value in attrs.get(key.v, (None, ()))[1]:
+                groups.setdefault(group_key(value, params), []).append(attrs)
+        for group, members in sorted(groups.iteritems()):
+            yield (group,) + tuple(aggregate(members) for aggregate in self.aggregates)
+
+
+def _autocommit(method):
+    '''Like statements outside an SQLite transaction, writes outside `with` commit at once'''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.count:
+            return method(self, *args, **kwargs)
+        with self:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class MemoryTransaction(object):
+    '''Holds the DB lock until committed. Nested use acts as a savepoint.'''
+    def __init__(self, db):
+        self.db = db
+        self.count = 0
+        self._savepoints = list()
+
+    def _begin(self):
+        self.db.lock.acquire()
+        self.owner = get_ident()
+        self.last_yield = time()
+        self.db.in_transaction = self
+        self.db._undo = list()
+        self.db._wrote = False
+
+    def _end(self):
+        db = self.db
+        wrote = db._wrote
+        db._undo = None
+        db.in_transaction = None
+        db.lock.release()
+        if wrote:
+            db.changes.notify()
+
+    def __enter__(self):
+        self.count += 1
+        if self.count == 1:
+            self._begin()
+        self._savepoints.append(len(self.db._undo))
+        return self
+
+    def __exit__(self, type, exc, tb):
+        assert self.count
+        savepoint = self._savepoints.pop()
+        if exc:
+            self.db._rollback_to(savepoint)
+        self.count -= 1
+        if not self.count:
+            self._end()
+
+    def yield_from(self, threshold=0):
+        assert self.count == 1
+        if self.last_yield + threshold > time():
+            return
+        self._end()
+        self._begin()
+        self._savepoints = [0]
+
+    @_autocommit
+    def update_attrs(self, assignments):
+        '''Applies (obj, key, TimedValues) assignments, as received from other nodes.
+
+        Each assignment is applied if newer than what is in the DB. Returns for each
+        assignment the serial it was written with, or False if it was not applied.'''
+        res = list()
+        for batch in _batched(assignments, WRITE_BATCH):
+            res += self._write(batch, replace_equal=False)
+        return res
+
+    @_autocommit
+    def update_many(self, objs):
+        '''Writes the dirty attributes of many objects, where not older than what is in DB'''
+        for obj in objs:
+            self._write([(obj.id, key, obj._dict[key]) for key in obj._dirty], replace_equal=True)
+            obj._dirty.clear()
+        return objs
+
+    def _write(self, assignments, replace_equal):
+        db = self.db
+        accepted = list()
+        for obj, key, v in assignments:
+            if not isinstance(v, TimedValues):
+                v = TimedValues(v)
+            tstamp = db._objs.get(obj, {}).get(key, (None,))[0]
+            if replace_equal:
+                apply = not tstamp or v.t >= tstamp
+            else:
+                apply = (tstamp is not None or v.v) and v.t > tstamp
+            if apply:
+                db._set(obj, key, v.t, v.v)
+                if key == DIRECTORY_KEY:
+                    db._set_dirents(obj, v.v)
+            accepted.append(bool(apply))
+
+        if replace_equal:
+            return [False] * len(assignments)
+        return [apply and db._objs[obj][key][2] for (obj, key, _), apply in zip(assignments, accepted)]
+
+    def update_attr(self, objid, key, assignment):
+        return self.update_attrs([(objid, key, assignment)])[0]
+
+    def update(self, obj):
+        return self.update_many((obj,))[0]
+
+    @_autocommit
+    def delete(self, obj, t=None):
+        db = self.db
+        obj = getattr(obj, 'id', obj)
+        t = t or time()
+        for key in list(db._objs.get(obj, ())):
+            db._set(obj, key, t, Set())
+        db._set_dirents(obj, ())
+
+
+class MemoryDB(object):
+    '''Dict-of-maps storage, implementing the DB interface used by bhindex and the syncer'''
+    def __init__(self):
+        self.path = ':memory:'
+        self.lock = RLock()
+        self.in_transaction = None
+        self.fts = True
+        self.cache = None
+        self.query_stats = None
+        self.changes = ChangeNotifier()
+        # obj -> {key: (timestamp, values, serial)}
+        self._objs = dict()
+        # obj -> number in order of first being stored, ordering pages like objid in DB
+        self._objids = dict()
+        self._last_objid = 0
+        # Serials in order of writing, and the (obj, key) each is still current for
+        self._serials = list()
+        self._mappings = dict()
+        self._last_serial = 0
+        # parent -> set of (name, child), and child -> set of (parent, name)
+        self._children = dict()
+        self._parents = dict()
+        self._sync_state = dict()
+        # Functions reverting the writes of the current transaction
+        self._undo = None
+        self._wrote = False
+
+    def clone(self):
+        '''Memory DB:s are shared between threads, and cannot be re-opened. Like a clone
+        of a DB, the result sees all commits, and transactions are serialized with it.'''
+        return self
+
+    def set_volatile(self, v):
+        pass
+
+    def transaction(self, type=None):
+        t = self.in_transaction
+        if t is not None and t.owner == get_ident():
+            return t
+        return MemoryTransaction(self)
+
+    def data_version(self):
+        '''Nothing outside this process can write, so commits are only seen in `changes`'''
+        return None
+
+    def _rollback_to(self, savepoint):
+        undo = self._undo
+        while len(undo) > savepoint:
+            undo.pop()()
+        if not savepoint:
+            # Like a rolled back DB transaction, nothing to notify subscribers of
+            self._wrote = False
+
+    def _objid(self, obj):
+        objid = self._objids.get(obj)
+        if objid is None:
+            self._last_objid += 1
+            objid = self._objids[obj] = self._last_objid
+        return objid
+
+    def _set(self, obj, key, t, values):
+        self._objid(obj)
+        attrs = self._objs.setdefault(obj, dict())
+        previous = attrs.get(key)
+        last_serial = self._last_serial
+        serial = self._last_serial = last_serial + 1
+        attrs[key] = (t, values, serial)
+        self._serials.append(serial)
+        self._mappings[serial] = (obj, key)
+        if previous:
+            del self._mappings[previous[2]]
+
+        def undo():
+            self._last_serial = last_serial
+            self._serials.pop()
+            del self._mappings[serial]
+            if previous:
+                attrs[key] = previous
+                self._mappings[previous[2]] = (obj, key)
+            else:
+                del attrs[key]
+        self._undo.append(undo)
+        self._wrote = True
+
+    def _set_dirents(self, child, values):
+        previous = self._parents.get(child, set())
+        dirents = set(dirent for dirent in (split_dirent(value) for value in values) if dirent)
+        for parent, _ in dirents:
+            self._objid(parent)
+        self._link(child, dirents)
+        self._undo.append(lambda: self._link(child, previous))
+
+    def _link(self, child, dirents):
+        previous = self._parents.pop(child, set())
+        for parent, name in previous - dirents:
+            self._children[parent].discard((name, child))
+        for parent, name in dirents - previous:
+            self._children.setdefault(parent, set()).add((name, child))
+        if dirents:
+            self._parents[child] = dirents
+
+    def _forget(self, obj, attrs, key, mapping):
+        del attrs[key]
+        del self._mappings[mapping[2]]
+
+        def undo():
+            attrs[key] = mapping
+            self._mappings[mapping[2]] = (obj, key)
+        self._undo.append(undo)
+
+    def _drop(self, obj, attrs):
+        del self._objs[obj]
+        objid = self._objids.pop(obj, None)
+
+        def undo():
+            self._objs[obj] = attrs
+            if objid is not None:
+                self._objids[obj] = objid
+        self._undo.append(undo)
+
+    def _compact(self):
+        if len(self._serials) > 2 * len(self._mappings) + 1024:
+            serials = self._serials
+            self._serials = [serial for serial in serials if serial in self._mappings]
+            self._undo.append(lambda: setattr(self, '_serials', serials))
+
+    def _load(self, obj, fields, cls):
+        return cls.loaded(obj, dict((key, TimedValues.trusted(values, t))
+                                    for key, (t, values, _) in self._objs.get(obj, {}).iteritems()
+                                    if values and (fields is None or key in fields)))
+
+    def get(self, obj, fields=None, readonly=False):
+        return next(self.get_many((obj,), fields, readonly))
+
+    def get_many(self, objs, fields=None, readonly=False):
+        '''Yields one Object per requested id, in the requested order'''
+        if fields is not None:
+            fields = tuple(fields) if not isinstance(fields, basestring) else (fields,)
+        cls = ReadOnlyObject if readonly else Object
+        for batch in _batched(objs, WRITE_BATCH):
+            with self.lock:
+                loaded = [self._load(obj, fields, cls) for obj in batch]
+            for obj in loaded:
+                yield obj
+
+    def __getitem__(self, obj):
+        return self.get(obj)
+
+    def _where(self, criteria):
+        if isinstance(criteria, Condition):
+            return criteria
+        return AndCondition(*criteria)
+
+    def query(self, criteria, fields=None, readonly=False, limit=None, after=None):
+        return self.get_many(self.query_ids(criteria, limit=limit, after=after), fields, readonly)
+
+    def query_ids(self, criteria, fields=None, limit=None, after=None):
+        crit = self._where(criteria)
+        with self.lock:
+            objids = self._objids
+            after = 0 if after is None else self._after_objid(after)
+            ids = sorted((obj for obj, attrs in self._objs.iteritems()
+                          if _matches(crit, obj, attrs) and objids[obj] > after), key=objids.get)
+        return ids[:limit]
+
+    def _after_objid(self, after):
+        objid = self._objids.get(getattr(after, 'id', after))
+        if objid is None:
+            raise KeyError(after)
+        return objid
+
+    def query_keyed(self, criteria, key, fields=None, sortmeth=Sort.value, readonly=False, limit=None, after=None):
+        if isinstance(criteria, Condition):
+            criteria = (criteria,)
+        direction, key = _parse_sort(key)
+        key_crit = [c for c in criteria if c.requires_key(key)] or [QueryKey(key).any()]
+        crit = self._where([c for c in criteria if not c.requires_key(key)])
+        expr, params = sortmeth()
+        sort_key = _SORT_KEYS[expr]
+
+        rows = list()
+        with self.lock:
+            for obj, attrs in self._objs.iteritems():
+                if not _matches(crit, obj, attrs):
+                    continue
+                t, values, serial = attrs.get(key, (None, (), None))
+                for value in values:
+                    # Key-conditions select the values to sort by
+                    single = dict(attrs)
+                    single[key] = (t, (value,), serial)
+                    if all(_matches(c, obj, single) for c in key_crit):
+                        rows.append(((value, t), obj))
+        # Like the SQL, sorted on a unique position for paging
+        position = lambda ((value, t), obj): (sort_key((value, t), params), self._objids[obj], value)
+        descending = direction == Sort.DESCENDING
+        rows.sort(key=position, reverse=descending)
+        if after is not None:
+            value, obj = after
+            obj = getattr(obj, 'id', obj)
+            with self.lock:
+                t, values, _ = self._objs.get(obj, {}).get(key, (None, (), None))
+            if value not in values:
+                raise KeyError(after)
+            cursor = position(((value, t), obj))
+            rows = [row for row in rows if (position(row) < cursor if descending else position(row) > cursor)]
+        rows = rows[:limit]
+        for batch in _batched(rows, WRITE_BATCH):
+            objs = self.get_many([obj for _, obj in batch], fields, readonly)
+            for ((value, _), _), obj in zip(batch, objs):
+                yield value, obj
+
+    def aggregate(self, criteria):
+        return MemoryAggregate(self, criteria)
+
+    def dir_children(self, parents, name=None, fields=None, readonly=False):
+        '''Yields (name, obj) for the directory entries of parents, sorted by name.
+        With `name`, only entries with that name.'''
+        with self.lock:
+            entries = sorted(entry for parent in parents for entry in self._children.get(parent, ())
+                             if name is None or entry[0] == name)
+        for batch in _batched(entries, WRITE_BATCH):
+            objs = self.get_many([child for _, child in batch], fields, readonly)
+            for (entry, _), obj in zip(batch, objs):
+                yield entry, obj
+
+    def dir_paths(self, obj):
+        '''Returns the set of paths (tuples of names) leading to obj, from objects
+        without directory-values. Paths through malformed values are left out, with
+        a warning.'''
+        obj = getattr(obj, 'id', obj)
+
+        def paths(obj, depth):
+            _, values, _ = self._objs.get(obj, {}).get(DIRECTORY_KEY, (None, (), None))
+            for value in values:
+                if not split_dirent(value):
+                    log.warning("Malformed directory for %s: %s", obj, value)
+            dirents = self._parents.get(obj)
+            if not dirents:
+                return set() if values else set([()])
+            if depth >= MAX_DIR_DEPTH:
+                return set()
+            return set(path + (name,) for parent, name in dirents for path in paths(parent, depth + 1))
+        with self.lock:
+            return paths(obj, 0)
+
+    def search(self, text, limit=SEARCH_LIMIT, fields=None):
+        '''Returns objects with directory entry names matching all words in text
+        (as prefixes), best match first'''
+        phrases = [words for words in (_tokens(word) for word in text.split()) if words]
+        if not phrases:
+            return iter(())
+
+        def hits(tokens, phrase):
+            n = len(phrase)
+            return sum(1 for i in range(len(tokens) - n + 1)
+                       if tokens[i:i + n - 1] == phrase[:-1] and tokens[i + n - 1].startswith(phrase[-1]))
+
+        found = list()
+        with self.lock:
+            for child, dirents in self._parents.iteritems():
+                tokens = [_tokens(name) for _, name in dirents]
+                matches = [sum(hits(t, phrase) for t in tokens) for phrase in phrases]
+                if all(matches):
+                    found.append((-sum(matches), sum(len(t) for t in tokens), child))
+        return self.get_many([child for _, _, child in sorted(found)[:limit]], fields)
+
+    def vacuum(self, delete_grace=DEFAULT_GRACE, incremental=False):
+        for _ in self.vacuum_steps(delete_grace):
+            pass
+
+    def vacuum_steps(self, delete_grace=DEFAULT_GRACE, **_):
+        '''Forgets deleted attributes older than delete_grace. Yields ('map', count).'''
+        limit = time() - delete_grace
+        with self.transaction():
+            count = 0
+            for obj, attrs in self._objs.items():
+                for key, mapping in attrs.items():
+                    t, values, serial = mapping
+                    if not values and t < limit:
+                        self._forget(obj, attrs, key, mapping)
+                        count += 1
+                if not attrs:
+                    self._drop(obj, attrs)
+            self._compact()
+        yield 'map', count
+
+    def subscribe(self, after_serial=None, limit=1024):
+        '''Returns a Subscription to public changes after `after_serial`, by default
+        from the current last serial'''
+        if after_serial is None:
+            after_serial = self.last_serial()
+        return Subscription(self, after_serial, limit)
+
+    def get_public_mappings_after(self, serial=0, limit=1024):
+        res = list()
+        with self.lock:
+            serials = self._serials
+            for serial in islice(serials, bisect_right(serials, serial), None):
+                mapping = self._mappings.get(serial)
+                if mapping is None:
+                    continue
+                obj, key = mapping
+                if key.startswith(u'@'):
+                    continue
+                t, values, _ = self._objs[obj][key]
+                res.append((obj, key, t, serial, set(values)))
+                if len(res) >= limit:
+                    break
+        return iter(res)
+
+    def last_serial(self):
+        return self._last_serial
+
+    def snapshot_serial(self, source):
+        '''Snapshots can not be imported into a MemoryDB, so like a DB without them, 0'''
+        return 0
+
+    def get_sync_state(self, peername):
+        return {
+            "last_received": self._sync_state.get(peername, 0)
+        }
+
+    def set_sync_state(self, peername, last_received):
+        with self.transaction():
+            previous = self._sync_state.get(peername, 0)
+            self._sync_state[peername] = last_received
+            self._undo.append(lambda: self._sync_state.__setitem__(peername, previous))
@@ -0,0 +1,72 @@
+from time import time
+
+from mock import patch
+from nose.plugins.skip import SkipTest
+from nose.tools import *
+
+from distdb import database_test, syncer_test
+from distdb.memory import MemoryDB
+from distdb.obj import Object, TimedValues
+from distdb.query import Key, ObjId, Sort
+
+
+class TestMemoryDB(database_test.BackendTests):
+    def make_db(self):
+        return MemoryDB()
+
+    def test_savepoint(self):
+        db = self.db
+        with db.transaction() as t:
+            t.update_attr(u'a', u'directory', TimedValues(u'dir/a', t=1))
+            try:
+                with db.transaction() as t2:
+                    t2.update_attr(u'b', u'directory', TimedValues(u'dir/b', t=1))
+                    t2.delete(u'a', t=2)
+                    raise KeyError
+            except KeyError:
+                pass
+            serial = db.last_serial()
+        assert_in(u'directory', db[u'a'])
+        assert_not_in(u'directory', db[u'b'])
+        assert_equal([name for name, _ in db.dir_children([u'dir'])], [u'a'])
+        assert_equal([x[:2] for x in db.get_public_mappings_after(serial - 1)], [(u'a', u'directory')])
+
+    def test_query_conditions(self):
+        with self.db.transaction() as t:
+            t.update(Object(u'tv:1', {u'key': TimedValues(u'Test Person', t=5), u'x': TimedValues(u'1', t=5)}))
+        ids = lambda *crit: sorted(self.db.query_ids(crit))
+        assert_equal(ids(ObjId.startswith(u'tv:')), [u'tv:1'])
+        assert_equal(ids(Key(u'key') == u'Test Person'), [u'some_id', u'tv:1'])
+        assert_equal(ids(Key(u'key') == u'Test Person', Key(u'x').missing()), [u'some_id'])
+        assert_equal(ids(Key(u'key') == [u'And alternatives', u'Nope']), [u'some_id'])
+        assert_equal(ids(Key(u'key').timed_before(3)), [u'some_id'])
+        assert_equal([v for v, _ in self.db.query_keyed(Key(u'key').startswith(u'A'), u'-key')],
+                     [u'Test Person', u'And alternatives'])
+        assert_equal([obj.id for _, obj in self.db.query_keyed({}, u'-key', sortmeth=Sort.timestamp)],
+                     [u'tv:1', u'some_id', u'some_id'])
+
+    def test_vacuum(self):
+        now = time()
+        with self.db.transaction() as t:
+            t.delete(self.o, t=now)
+        self.db.vacuum()
+        assert_equal(list(self.db.get_public_mappings_after()), [(self.o.id, u'key', now, 2, set())])
+        self.db.vacuum(0)
+        assert_equal(list(self.db.get_public_mappings_after()), [])
+
+    def test_failed_vacuum(self):
+        now = time()
+        with self.db.transaction() as t:
+            t.delete(self.o, t=now - 10)
+        with patch.object(self.db, '_compact', side_effect=KeyError):
+            assert_raises(KeyError, self.db.vacuum, 0)
+        assert_equal(list(self.db.get_public_mappings_after()), [(self.o.id, u'key', now - 10, 2, set())])
+        assert_equal(list(self.db.query_ids({})), [self.o.id])
+
+
+class TestMemorySyncConnection(syncer_test.TestSyncConnection):
+    def make_db(self):
+        return MemoryDB()
+
+    def test_snapshot_handshake(self):
+        raise SkipTest("Snapshots require the SQLite backend")
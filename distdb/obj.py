@@ -19,7 +19,7 @@ class Set(frozenset):
         return default
 
 
-class TimedValues:
+class TimedValues(object):
     __slots__ = ("v", "t")
 
     def __init__(self, v, t=None):
@@ -33,6 +33,14 @@ class TimedValues:
                 assert isinstance(x, unicode)
         self.t = _time(t)
 
+    @classmethod
+    def trusted(cls, v, t):
+        '''Builds from values known to be unicode, IE loaded from the DB, skipping the checks'''
+        res = cls.__new__(cls)
+        res.v = Set(v)
+        res.t = t
+        return res
+
     def __nonzero__(self):
         return bool(self.v)
 
@@ -63,6 +71,13 @@ class Object(object):
         self._dict = dict()
         self.update(init)
 
+    @classmethod
+    def loaded(cls, objid, attrs):
+        '''Wraps attrs ({key: TimedValues}) loaded from the DB, without marking them dirty'''
+        obj = cls(objid)
+        obj._dict = attrs
+        return obj
+
     @classmethod
     def new(cls, prefix=None):
         id = b64encode(uuid4().bytes).strip('=')
@@ -156,3 +171,20 @@ class Object(object):
 
     def __unicode__(self):
         return u"db.Object {\n%s\n}" % u'\n'.join(u" %s: %s" % x for x in self._dict.iteritems())
+
+
+class ReadOnlyObject(Object):
+    '''An Object for reading only, without dirty-tracking.
+
+    Its attributes may be shared with other ReadOnlyObjects, IE in the DB object cache.'''
+    __slots__ = ()
+    _dirty = frozenset()
+
+    def __init__(self, objid, attrs={}):
+        self.id = objid
+        self._dict = attrs
+
+    def _read_only(self, *args):
+        raise TypeError("%s is read-only" % self.id)
+
+    __setitem__ = __delitem__ = set = update = _read_only
@@ -1,5 +1,5 @@
 from nose.tools import *
-from distdb.obj import TimedValues, Object
+from distdb.obj import TimedValues, Object, ReadOnlyObject
 from time import time
 
 HOURS = 3600
@@ -102,3 +102,18 @@ def test_Object_mutation():
 
     o['apa'] = TimedValues(u'Bleh', future(100, HOURS))
     assert_equals(o[u'apa'], TimedValues([u'Bleh']).v)
+
+
+def test_ReadOnlyObject():
+    apa = TimedValues.trusted([u'banan', u'citron'], 1)
+    assert_equals(apa, TimedValues([u'banan', u'citron'], t=1))
+    assert_equals(apa.t, 1)
+
+    o = ReadOnlyObject('aia', {u'apa': apa})
+    assert_equals(o, Object('aia', {u'apa': apa}))
+    assert_in(o.any(u'apa'), (u'banan', u'citron'))
+    assert_false(o.dirty())
+    assert_raises(TypeError, o.set, u'apa', u'x')
+    assert_raises(TypeError, o.__delitem__, u'apa')
+    assert_equals(o[u'apa'], apa.v)
+
@@ -0,0 +1,69 @@
+'''Performance profiles, tuning SQLite for different classes of hardware.
+
+A profile is a dict of SQLite PRAGMAs applied to every connection, plus
+`checkpoint_interval`, the seconds between WAL-checkpoints by WALCheckpointer.
+`page_size` only takes effect when creating a new DB.'''
+
+MB = 1024 * 1024
+
+
+def _temp_store(value):
+    value = str(value).upper()
+    if value not in ('DEFAULT', 'FILE', 'MEMORY'):
+        raise ValueError("temp_store must be one of DEFAULT, FILE or MEMORY")
+    return value
+
+
+PRAGMAS = {
+    'page_size': int,
+    'cache_size': int,
+    'mmap_size': int,
+    'temp_store': _temp_store,
+    'wal_autocheckpoint': int,
+    'journal_size_limit': int,
+}
+
+OPTIONS = dict(PRAGMAS, checkpoint_interval=float)
+
+PROFILES = {
+    # SQLite defaults
+    'default': {},
+    # Small boards with little RAM, and slow SD-cards
+    'small': {
+        'cache_size': -4 * 1024,
+        'mmap_size': 0,
+        'temp_store': 'FILE',
+        'wal_autocheckpoint': 1000,
+        'journal_size_limit': 16 * MB,
+        'checkpoint_interval': 60,
+    },
+    # Servers with RAM to spare for the whole index
+    'large': {
+        'page_size': 8192,
+        'cache_size': -512 * 1024,
+        'mmap_size': 8 * 1024 * MB,
+        'temp_store': 'MEMORY',
+        'wal_autocheckpoint': 10000,
+        'journal_size_limit': 256 * MB,
+        'checkpoint_interval': 10,
+    },
+}
+
+
+def get(name, **overrides):
+    '''Returns profile `name`, with (string or typed) values in overrides replacing its options'''
+    try:
+        profile = dict(PROFILES[name])
+    except KeyError:
+        raise ValueError("Unknown DB profile '%s', expected one of %s" % (name, ', '.join(sorted(PROFILES))))
+    for option, value in overrides.iteritems():
+        if option not in OPTIONS:
+            raise ValueError("Unknown DB profile option '%s'" % option)
+        profile[option] = value
+    return dict((option, OPTIONS[option](value)) for option, value in profile.iteritems())
+
+
+def apply(conn, profile):
+    for pragma, convert in PRAGMAS.iteritems():
+        if pragma in profile:
+            conn.execute("PRAGMA %s = %s" % (pragma, convert(profile[pragma]))).fetchall()
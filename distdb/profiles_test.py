@@ -0,0 +1,49 @@
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nose.tools import *
+
+from distdb import profiles
+from distdb.database import DB, WALCheckpointer
+from distdb.obj import TimedValues
+
+
+def test_get():
+    profile = profiles.get('small', cache_size='-100', temp_store='memory')
+    assert_equal(profile['cache_size'], -100)
+    assert_equal(profile['temp_store'], 'MEMORY')
+    assert_equal(profile['checkpoint_interval'], 60)
+    assert_equal(profiles.get('default'), {})
+
+    assert_raises(ValueError, profiles.get, 'huge')
+    assert_raises(ValueError, profiles.get, 'default', synchronous='OFF')
+    assert_raises(ValueError, profiles.get, 'default', cache_size='1; DROP TABLE map')
+    assert_raises(ValueError, profiles.get, 'default', temp_store='RAM')
+
+
+class TestProfile:
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.profile = profiles.get('large', cache_size=-1234)
+        self.db = DB(path.join(self.dir, 'db'), profile=self.profile)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_applied_to_all_connections(self):
+        db = self.db
+        with db.transaction() as t:
+            t.update_attr(u'obj', u'key', TimedValues(u'value', t=1))
+        assert_equal(db._query_single("PRAGMA page_size"), 8192)
+        for conn in (db.conn, db._reader(), db.clone().conn):
+            assert_equal(conn.execute("PRAGMA cache_size").fetchone()[0], -1234)
+            assert_equal(conn.execute("PRAGMA temp_store").fetchone()[0], 2)
+
+    def test_checkpointer(self):
+        with self.db.transaction() as t:
+            t.update_attr(u'obj', u'key', TimedValues(u'value', t=1))
+        busy, pages, checkpointed = WALCheckpointer(self.db, 1).checkpoint()
+        assert_equal(busy, 0)
+        assert_equal(pages, checkpointed)
+        assert_greater(pages, 0)
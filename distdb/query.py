@@ -1,3 +1,46 @@
+import sys
+from threading import Lock
+
+# Compiled SQL is cached by the shape of the query. All literals are passed as
+# parameters, so the SQL of a shape is always the same.
+COMPILED_CACHE_SIZE = 1024
+_compiled = dict()
+_compiled_stats = dict(hits=0, misses=0)
+_compiled_lock = Lock()
+
+
+def cache_info():
+    '''Returns hits, misses and size of the compiled query cache'''
+    with _compiled_lock:
+        return dict(_compiled_stats, size=len(_compiled))
+
+
+def _successor(prefix):
+    '''Returns the least string greater than all strings starting with prefix, in
+    BINARY collation, or None if there is none'''
+    if isinstance(prefix, unicode):
+        top, char = unichr(sys.maxunicode), unichr
+    else:
+        top, char = '\xff', chr
+    prefix = prefix.rstrip(top)
+    if not prefix:
+        return None
+    return prefix[:-1] + char(ord(prefix[-1]) + 1)
+
+
+def _exists(condition):
+    '''Returns (SQL, parameters) of an EXISTS-test for a row of the same object matching
+    condition. Correlated on objid, so it is an index probe of map (objid, keyid) per
+    object tested, rather than a scan of all objects matching condition.
+
+    Tables of the subquery are aliased, so that obj.objid refers to the outer query. SQLite
+    prefers the UNIQUE (objid, keyid) index for the probe, but it is not covering.'''
+    sources, expr, params, _ = condition.apply()
+    sources = ' NATURAL JOIN '.join(('map AS inner_map INDEXED BY map_obj_keys',) +
+                                    tuple('%s AS inner_%s' % (x, x) for x in sorted(sources)))
+    return "EXISTS (SELECT 1 FROM %s WHERE inner_map.objid = obj.objid AND %s)" % (sources, expr), params
+
+
 def _mkset(x):
     if isinstance(x, frozenset):
         return x
@@ -40,6 +83,12 @@ class ObjId:
     def apply(self):
         return ConditionExpr('obj', '', (), False)
 
+    def shape(self):
+        return 'ObjId'
+
+    def params(self):
+        return ()
+
     def __eq__(self, v):
         return Matcher.build((), self, (Equals, 'obj', v))
 
@@ -68,6 +117,14 @@ class Condition(object):
     def __repr__(self):
         return "%s%r" % (type(self).__name__, self.children)
 
+    def shape(self):
+        '''Returns a hashable description of the SQL of this condition, without literals'''
+        return (type(self),) + tuple(x.shape() for x in self.children)
+
+    def params(self):
+        '''Returns the parameters of the SQL of this condition, as from apply()'''
+        return sum((x.params() for x in self.children), ())
+
     def requires_key(self, key):
         if len(self.children) > 0:
             x = self.children[0]
@@ -79,25 +136,72 @@ class Condition(object):
             return False
 
 
-class Starts(Condition):
+class Comparison(Condition):
+    '''Compares column `key` with a literal value'''
+    def shape(self):
+        key, _ = self
+        return (type(self), key)
+
+    def params(self):
+        _, value = self
+        return (value,)
+
+
+class Starts(Comparison):
+    '''Prefix match, as a range that can be looked up in an index of the column'''
     def apply(self):
+        key, _ = self
+        params = self.params()
+        if len(params) > 1:
+            expr = "%s >= ? AND %s < ?" % (key, key)
+        else:
+            expr = "%s >= ?" % key
+        return ConditionExpr((), expr, params, False)
+
+    def shape(self):
         key, value = self
-        expr = "%s GLOB '%s*'" % (key, value.replace("'", "''"))
-        return ConditionExpr((), expr, (), False)
+        return (Starts, key, _successor(value) is None)
+
+    def params(self):
+        _, value = self
+        upper = _successor(value)
+        return (value,) if upper is None else (value, upper)
 
 
-class Equals(Condition):
+class Equals(Comparison):
     def apply(self):
         key, value = self
         expr = "%s=?" % key
         return ConditionExpr((), expr, value, False)
 
 
+class Greater(Comparison):
+    '''Compares as numbers, with values cast like SQLite does'''
+    def apply(self):
+        key, value = self
+        return ConditionExpr((), "CAST(%s AS NUMERIC) > ?" % key, value, False)
+
+
 class TimedBefore(Condition):
+    op = '<'
+
     def apply(self):
         key, timestamp = self
         sources, key_expr, key_params, condition_on_key = key.apply()
-        return ConditionExpr(sources, "%slistid IS NOT NULL AND timestamp < ?" % key_expr, key_params + (timestamp,), condition_on_key)
+        expr = "%slistid IS NOT NULL AND timestamp %s ?" % (key_expr, self.op)
+        return ConditionExpr(sources, expr, key_params + (timestamp,), condition_on_key)
+
+    def shape(self):
+        key, _ = self
+        return (type(self), key.shape())
+
+    def params(self):
+        key, timestamp = self
+        return key.params() + (timestamp,)
+
+
+class TimedAfter(TimedBefore):
+    op = '>='
 
 
 class KeyAny(Condition):
@@ -110,8 +214,8 @@ class KeyAny(Condition):
 class KeyMissing(Condition):
     def apply(self):
         key, = self
-        key_expr, key_params = Query(('objid',), key.any()).apply()
-        return ConditionExpr((), "objid NOT IN (%s)" % key_expr, key_params, False)
+        key_expr, key_params = _exists(key.any())
+        return ConditionExpr('obj', "NOT %s" % key_expr, key_params, False)
 
     def requires_key(self, _):
         return False
@@ -121,6 +225,12 @@ class Key(object):
     def __init__(self, v):
         self.v = v
 
+    def shape(self):
+        return (Key, isinstance(self.v, int))
+
+    def params(self):
+        return (self.v,)
+
     def apply(self):
         if isinstance(self.v, int):
             return ConditionExpr((), "LIKELIHOOD(keyid=?, 0.2) AND ", (self.v,), True)
@@ -133,9 +243,15 @@ class Key(object):
     def startswith(self, v):
         return Matcher.build('list', self, (Starts, 'value', v))
 
+    def __gt__(self, v):
+        return Matcher.build('list', self, (Greater, 'value', v))
+
     def timed_before(self, t):
         return TimedBefore(self, t)
 
+    def timed_after(self, t):
+        return TimedAfter(self, t)
+
     def any(self):
         return KeyAny(self)
 
@@ -147,6 +263,14 @@ class Key(object):
 
 
 class Matcher(Condition):
+    def shape(self):
+        extra_sources, key, comparer = self
+        return (Matcher, extra_sources, key.shape(), comparer.shape())
+
+    def params(self):
+        _, key, comparer = self
+        return key.params() + comparer.params()
+
     def apply(self):
         extra_sources, key, comparer = self
         key_sources, key_prefix, key_params, condition_on_key1 = key.apply()
@@ -198,9 +322,8 @@ class AndCondition(ListCondition):
     def expression_for(self, res, x):
         sources, expression, params, condition_on_key = super(AndCondition, self).expression_for(res, x)
         if res.condition_on_key and condition_on_key:
-            cond, params = Query(('objid',), x).apply()
-            expression = '(objid IN (%s))' % cond
-            sources = _mkset(())
+            expression, params = _exists(x)
+            sources = _mkset('obj')
         else:
             expression = "(%s)" % expression
 
@@ -211,6 +334,23 @@ class OrCondition(ListCondition):
     join = ' OR '.join
 
 
+def _keyset(order_by, direction):
+    '''Returns SQL for rows sorted after a position in order_by, with parameters from
+    _keyset_params(). Expanded, since row value comparisons need SQLite 3.15.'''
+    op = '>' if direction == Sort.ASCENDING else '<'
+    sort_key = order_by[0]
+    if len(order_by) == 1:
+        return "%s %s ?" % (sort_key, op)
+    return "(%s %s ? OR %s = ? AND %s)" % (sort_key, op, sort_key, _keyset(order_by[1:], direction))
+
+
+def _keyset_params(order_by, position):
+    (_, sort_params), value = order_by[0], position[0]
+    if len(order_by) == 1:
+        return sort_params + (value,)
+    return sort_params + (value,) + sort_params + (value,) + _keyset_params(order_by[1:], position[1:])
+
+
 class Sort:
     ASCENDING = "ASC"
     DESCENDING = "DESC"
@@ -228,11 +368,35 @@ class Sort:
         return "timestamp", ()
 
 
+class Group:
+    @staticmethod
+    def value():
+        return "value", ()
+
+    @staticmethod
+    def prefix(character):
+        '''Groups by the part of values before character, IE the parent of directory-values'''
+        return lambda: ("substr(value, 1, instr(value, ?) - 1)", (character,))
+
+
+def _keyid(key):
+    if isinstance(key.v, int):
+        return "?", (key.v,)
+    else:
+        return "(SELECT keyid FROM key WHERE key = ?)", (key.v,)
+
+
+# Columns of a query, that can be selected without joining map
+OBJ_COLUMNS = frozenset(('objid', 'obj'))
+
+
 class Query(object):
     def __init__(self, columns, criteria=()):
         self.columns = list(columns)
         self.sources = set(('map',))
         self.sorting = ()
+        self.position = ()
+        self.row_limit = None
 
         if isinstance(criteria, Condition):
             self.where(criteria)
@@ -247,21 +411,63 @@ class Query(object):
             self.sources.add('key')
 
     def apply(self):
+        '''Returns (SQL, parameters), with the SQL from the compiled cache if possible'''
+        order_by = self._order_by()
+        direction = self.sorting[1] if self.sorting else Sort.ASCENDING
+        if self.position and len(self.position) != len(order_by):
+            raise ValueError("Position %r does not match sort order %r" % (self.position, order_by))
+        shape = (tuple(self.columns), frozenset(self.sources), self.criteria.shape(),
+                 tuple(expr for expr, _ in order_by), direction, bool(self.position), self.row_limit is not None)
+
+        with _compiled_lock:
+            expr = _compiled.get(shape)
+            _compiled_stats['misses' if expr is None else 'hits'] += 1
+        if expr is None:
+            expr = self._compile(order_by, direction)
+            with _compiled_lock:
+                if len(_compiled) >= COMPILED_CACHE_SIZE:
+                    _compiled.clear()
+                _compiled[shape] = expr
+
+        params = self.criteria.params()
+        if self.position:
+            params += _keyset_params(order_by, self.position)
+        params += sum((sort_params for _, sort_params in order_by), ())
+        if self.row_limit is not None:
+            params += (self.row_limit,)
+        return expr, params
+
+    def _order_by(self):
+        '''Returns [(expression, parameters)] to sort by. Pages are sorted by a unique
+        position, with objid, and value if selected, breaking ties.'''
+        order_by = [self.sorting[0]()] if self.sorting else []
+        if self.position or self.row_limit is not None:
+            for column in ('objid', 'value'):
+                if (column == 'objid' or column in self.columns) and (column, ()) not in order_by:
+                    order_by.append((column, ()))
+        return order_by
+
+    def _compile(self, order_by, direction):
         cols = ', '.join(self.columns)
-        extra_sources, where_expr, params, _ = self.criteria.apply()
-        sources = ' NATURAL JOIN '.join(self.sources | frozenset(extra_sources))
+        extra_sources, where_expr, _, condition_on_key = self.criteria.apply()
+        where = [where_expr] if where_expr else []
+        sources = self.sources | extra_sources
+        if not condition_on_key and set(self.columns) <= OBJ_COLUMNS:
+            # Without a condition pinning a key, each object would be tested once per key in map
+            sources = sources - set(('map',)) | set(('obj',))
+            where.append("EXISTS (SELECT 1 FROM map WHERE map.objid = obj.objid)")
+        if self.position:
+            where.append(_keyset([expr for expr, _ in order_by], direction))
+        sources = ' NATURAL JOIN '.join(sources)
 
         expr = "SELECT %s FROM %s" % (cols, sources)
-        if where_expr:
-            expr += " WHERE %s" % where_expr
-
-        if self.sorting:
-            meth, direction = self.sorting
-            sort_key, sort_params = meth()
-            expr += " ORDER BY %s %s""" % (sort_key, direction)
-            params += sort_params
-
-        return expr, params
+        if where:
+            expr += " WHERE %s" % ' AND '.join(where)
+        if order_by:
+            expr += " ORDER BY %s" % ', '.join("%s %s" % (sort_key, direction) for sort_key, _ in order_by)
+        if self.row_limit is not None:
+            expr += " LIMIT ?"
+        return expr
 
     def where(self, *conditions):
         for x in conditions:
@@ -275,3 +481,59 @@ class Query(object):
     def order_by(self, meth, direction=Sort.ASCENDING):
         self.sorting = (meth, direction)
         return self
+
+    def limit(self, rows):
+        self.row_limit = rows
+        return self
+
+    def after(self, *position):
+        '''Continues after the row at position, being the values sorted by: the sort key
+        if sorted, objid, and value if selected and not the sort key'''
+        self.position = position
+        return self
+
+
+class Aggregate(object):
+    '''Counts and sums over the objects selected by Query `objects`, computed in one
+    statement. Rows hold the group if grouped, then the aggregates in the order added.'''
+    def __init__(self, objects):
+        self.objects = objects
+        self.aggregates = list()
+        self.grouping = ()
+
+    def count(self):
+        self.aggregates.append(("COUNT(*)", ()))
+        return self
+
+    def sum(self, key):
+        '''Sums all values of key, cast to numbers'''
+        keyid, params = _keyid(key)
+        self.aggregates.append(("SUM((SELECT SUM(CAST(value AS NUMERIC)) FROM map AS sum_map NATURAL JOIN list "
+                                "WHERE sum_map.objid = matched.objid AND sum_map.keyid = %s))" % keyid, params))
+        return self
+
+    def group_by(self, key, meth=Group.value):
+        '''Groups objects by the values of key, as mapped by meth. Objects are counted once for
+        each of their values, and not at all without the key.'''
+        self.grouping = (key, meth)
+        return self
+
+    def apply(self):
+        columns = list(self.aggregates)
+        join = ""
+        join_params = ()
+        if self.grouping:
+            key, meth = self.grouping
+            columns.insert(0, meth())
+            keyid, join_params = _keyid(key)
+            join = " JOIN map AS group_map ON (group_map.objid = matched.objid AND group_map.keyid = %s)" \
+                   " JOIN list AS group_list ON (group_list.listid = group_map.listid)" % keyid
+        objects, objects_params = self.objects.apply()
+
+        expr = "SELECT %s FROM obj AS matched%s WHERE matched.objid IN (%s)" % (
+            ', '.join(column for column, _ in columns), join, objects)
+        if self.grouping:
+            expr += " GROUP BY 1"
+        params = sum((params for _, params in columns), ()) + join_params + objects_params
+        return expr, params
+
@@ -1,6 +1,7 @@
 from nose.tools import *
 from distdb.query import *
-from distdb.query import _mkset as fz
+from distdb.query import _mkset as fz, _successor
+import sys
 
 
 def test_simple_queries():
@@ -35,12 +36,13 @@ def test_Key():
 
     assert_equal(
         (Key(14).startswith('monkey')).apply(),
-        ConditionExpr(fz('list'), "LIKELIHOOD(keyid=?, 0.2) AND (value GLOB 'monkey*')", (14), True),
+        ConditionExpr(fz('list'), "LIKELIHOOD(keyid=?, 0.2) AND (value >= ? AND value < ?)", (14, 'monkey', 'monkez'), True),
     )
 
     assert_equal(
         (Key(14).startswith(('monkey', 'banana'))).apply(),
-        ConditionExpr(fz('list'), "LIKELIHOOD(keyid=?, 0.2) AND (value GLOB 'monkey*' OR value GLOB 'banana*')", (14), True),
+        ConditionExpr(fz('list'), "LIKELIHOOD(keyid=?, 0.2) AND (value >= ? AND value < ? OR value >= ? AND value < ?)",
+                      (14, 'monkey', 'monkez', 'banana', 'bananb'), True),
     )
 
     assert_equal(
@@ -48,9 +50,21 @@ def test_Key():
         ConditionExpr(fz(()), "LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL AND timestamp < ?", (14, 42), True),
     )
 
+    assert_equal(
+        (Key(14) > 0).apply(),
+        ConditionExpr(fz('list'), 'LIKELIHOOD(keyid=?, 0.2) AND (CAST(value AS NUMERIC) > ?)', (14, 0), True),
+    )
+
+    assert_equal(
+        (Key(14).timed_after(42)).apply(),
+        ConditionExpr(fz(()), "LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL AND timestamp >= ?", (14, 42), True),
+    )
+
     assert_equal(
         (Key(14).missing()).apply(),
-        ConditionExpr(fz(()), "objid NOT IN (SELECT objid FROM map WHERE LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL)", (14), False),
+        ConditionExpr(fz('obj'), "NOT EXISTS (SELECT 1 FROM map AS inner_map INDEXED BY map_obj_keys "
+                                 "WHERE inner_map.objid = obj.objid AND LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL)",
+                      (14), False),
     )
 
 
@@ -58,9 +72,9 @@ def test_multiple_And_Key_Crit():
     assert_equal(
         AndCondition(Key('xt').any(), Key(32).any()).apply(),
         ConditionExpr(
-            fz('key'),
-            '(LIKELIHOOD(key=?, 0.2) AND listid IS NOT NULL) AND (objid IN'
-            ' (SELECT objid FROM map WHERE LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL))',
+            fz(('key', 'obj')),
+            '(LIKELIHOOD(key=?, 0.2) AND listid IS NOT NULL) AND EXISTS (SELECT 1 FROM map AS inner_map'
+            ' INDEXED BY map_obj_keys WHERE inner_map.objid = obj.objid AND LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL)',
             ('xt', 32),
             True
         ),
@@ -77,6 +91,16 @@ def test_multiple_And_Key_Crit():
     )
 
 
+def test_without_key_condition():
+    # Objects are tested once each, not once per key
+    assert_equal(
+        Query(('objid',)).where(ObjId.startswith('tree:'), Key(14).missing()).apply(),
+        ("SELECT objid FROM obj WHERE ((obj >= ? AND obj < ?)) AND (NOT EXISTS (SELECT 1 FROM map AS inner_map "
+         "INDEXED BY map_obj_keys WHERE inner_map.objid = obj.objid AND LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL)) "
+         "AND EXISTS (SELECT 1 FROM map WHERE map.objid = obj.objid)", ('tree:', 'tree;', 14)),
+    )
+
+
 def test_ObjId():
     assert_equal(
         (ObjId == 'monkey').apply(),
@@ -85,7 +109,7 @@ def test_ObjId():
 
     assert_equal(
         (ObjId.startswith('monkey')).apply(),
-        ConditionExpr(fz('obj'), "(obj GLOB 'monkey*')", (), False),
+        ConditionExpr(fz('obj'), "(obj >= ? AND obj < ?)", ('monkey', 'monkez'), False),
     )
 
 
@@ -96,3 +120,75 @@ def test_Sorting():
         Query(('objid', 'value')).where(Key('xt').any()).order_by(Sort.value, Sort.ASCENDING).apply(),
         (baseq + 'NATURAL JOIN key WHERE LIKELIHOOD(key=?, 0.2) AND listid IS NOT NULL ORDER BY value ASC', ('xt',)),
     )
+
+
+def test_paging():
+    assert_equal(
+        Query(('objid',)).where(Key(3).any()).limit(2).after(4).apply(),
+        ("SELECT objid FROM map WHERE LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL AND objid > ? "
+         "ORDER BY objid ASC LIMIT ?", (3, 4, 2)),
+    )
+
+    assert_equal(
+        Query(('objid', 'value')).where(Key(3).any()).order_by(Sort.value, Sort.DESCENDING).limit(10).apply(),
+        ("SELECT objid, value FROM map NATURAL JOIN list WHERE LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL "
+         "ORDER BY value DESC, objid DESC LIMIT ?", (3, 10)),
+    )
+
+    # Ties on the sort key are broken by objid and value, with the sort parameters repeated
+    assert_equal(
+        Query(('objid', 'value')).where(Key(3).any()).order_by(Sort.split('/')).after(u'a', 5, u'x/a').apply(),
+        ("SELECT objid, value FROM map NATURAL JOIN list WHERE LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL "
+         "AND (substr(value, instr(value, ?)) > ? OR substr(value, instr(value, ?)) = ? AND "
+         "(objid > ? OR objid = ? AND value > ?)) "
+         "ORDER BY substr(value, instr(value, ?)) ASC, objid ASC, value ASC",
+         (3, '/', u'a', '/', u'a', 5, 5, u'x/a', '/')),
+    )
+
+    assert_raises(ValueError, Query(('objid',)).where(Key(3).any()).after(1, 2).apply)
+
+
+def test_aggregate():
+    objects = Query(('objid',), Key(3).any())
+    assert_equal(
+        Aggregate(objects).count().sum(Key('size')).apply(),
+        ("SELECT COUNT(*), SUM((SELECT SUM(CAST(value AS NUMERIC)) FROM map AS sum_map NATURAL JOIN list "
+         "WHERE sum_map.objid = matched.objid AND sum_map.keyid = (SELECT keyid FROM key WHERE key = ?))) "
+         "FROM obj AS matched WHERE matched.objid IN "
+         "(SELECT objid FROM map WHERE LIKELIHOOD(keyid=?, 0.2) AND listid IS NOT NULL)", ('size', 3)),
+    )
+
+    sql, params = Aggregate(objects).group_by(Key(4), Group.prefix('/')).count().apply()
+    assert_equal(sql, "SELECT substr(value, 1, instr(value, ?) - 1), COUNT(*) FROM obj AS matched "
+                      "JOIN map AS group_map ON (group_map.objid = matched.objid AND group_map.keyid = ?) "
+                      "JOIN list AS group_list ON (group_list.listid = group_map.listid) "
+                      "WHERE matched.objid IN (SELECT objid FROM map WHERE LIKELIHOOD(keyid=?, 0.2) "
+                      "AND listid IS NOT NULL) GROUP BY 1")
+    assert_equal(params, ('/', 4, 3))
+
+
+def test_compiled_cache():
+    def query(*crit):
+        return Query(('objid',)).where(*crit).apply()
+
+    crit = lambda prefix, t: (Key(3).startswith(prefix), ObjId == prefix, Key('xt').timed_before(t), Key(4).missing())
+    sql, params = query(*crit(u'a*[b', 10))
+    assert_equal(params, (3, u'a*[b', u'a*[c', u'a*[b', 'xt', 10, 4))
+    before = cache_info()
+    assert_equal(query(*crit(u'other', 20)), (sql, (3, u'other', u'othes', u'other', 'xt', 20, 4)))
+    after = cache_info()
+    assert_equal(after['misses'], before['misses'])
+    assert_equal(after['hits'] - before['hits'], 1)
+
+    # Different shapes get different SQL
+    assert_not_equal(query(Key(3).startswith((u'a', u'b')))[0], query(Key(3).startswith(u'a'))[0])
+    assert_not_equal(query(Key(3).any())[0], query(Key('3').any())[0])
+
+
+def test_prefix_range():
+    assert_equal(_successor(u'tree:tiger:'), u'tree:tiger;')
+    assert_equal(_successor('a\xff\xff'), 'b')
+    assert_equal(_successor(u'a' + unichr(sys.maxunicode)), u'b')
+    assert_is_none(_successor(u''))
+    assert_equal(ObjId.startswith(u'').apply(), ConditionExpr(fz('obj'), "(obj >= ?)", (u'',), False))
+
@@ -1,8 +1,20 @@
 from collections import deque
+from time import time
+import zlib
 
 from bithorde.protocol import decodeMessage, encodeMessage
 from distdb import sync_pb2
 
+# Largest message accepted from a peer, so a stream can not grow the buffer without bound
+MAX_MESSAGE_SIZE = 8 * 1024 * 1024
+
+# Bytes decompressed at a time, before being decoded
+INFLATE_CHUNK = 64 * 1024
+
+
+class ProtocolError(Exception):
+    '''The peer sent something it should not have'''
+
 
 class StringBuf(object):
     def __init__(self):
@@ -14,6 +26,9 @@ class StringBuf(object):
     def clear(self, count):
         self._buf = self._buf[count:]
 
+    def __len__(self):
+        return len(self._buf)
+
     def __str__(self):
         return self._buf
 
@@ -22,11 +37,23 @@ class MessageDecoder(object):
     def __init__(self, msg_map):
         self.msg_map = msg_map
 
-    def __call__(self, tgt):
+    def __call__(self, tgt, filter_after=None):
+        '''Returns a function decoding data into messages passed to tgt.
+
+        With `filter_after`, it is called with each message, and may return a filter
+        to pass the rest of the stream through before decoding, like an Inflater. A
+        filter returns its output in pieces, each decoded before the next is made.
+
+        Raises ProtocolError for a message larger than MAX_MESSAGE_SIZE.'''
         buf = StringBuf()
+        filters = list()
 
-        def decoder(data):
-            buf.append(str(data))
+        def feed(data, level):
+            if level < len(filters):
+                for piece in filters[level](data):
+                    feed(piece, level + 1)
+                return
+            buf.append(data)
 
             while True:
                 try:
@@ -36,6 +63,17 @@ class MessageDecoder(object):
 
                 buf.clear(consumed)
                 tgt(msg)
+                f = filter_after and filter_after(msg)
+                if f:
+                    filters.append(f)
+                    rest = str(buf)
+                    buf.clear(len(rest))
+                    feed(rest, len(filters) - 1)
+            if len(buf) > MAX_MESSAGE_SIZE:
+                raise ProtocolError("Message of more than %d bytes" % MAX_MESSAGE_SIZE)
+
+        def decoder(data):
+            feed(str(data), 0)
 
         return decoder
 
@@ -65,15 +103,75 @@ MESSAGE_DECODER = MessageDecoder(sync_pb2._STREAM.fields_by_number)
 MESSAGE_ENCODER = MessageEncoder(sync_pb2._STREAM.fields_by_name)
 
 
+class Deflater(object):
+    '''Compresses a stream with zlib. Each call is flushed, so the receiver can
+    decode everything sent so far.'''
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self._zlib = zlib.compressobj(level)
+        self.raw = self.compressed = 0
+        self.time = 0.0
+
+    def __call__(self, data):
+        start = time()
+        res = self._zlib.compress(str(data)) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        self.time += time() - start
+        self.raw += len(data)
+        self.compressed += len(res)
+        return res
+
+
+class Inflater(object):
+    '''Decompresses a zlib stream, received in arbitrary pieces'''
+    def __init__(self, max_length=INFLATE_CHUNK):
+        self._zlib = zlib.decompressobj()
+        self.max_length = max_length
+        self.raw = self.compressed = 0
+        self.time = 0.0
+
+    def __call__(self, data):
+        '''Yields the decompressed data in pieces of at most max_length bytes, so a
+        small piece of stream can not inflate into unbounded memory at once'''
+        self.compressed += len(data)
+        while True:
+            start = time()
+            try:
+                res = self._zlib.decompress(data, self.max_length)
+            except zlib.error, e:
+                raise ProtocolError("Corrupt zlib stream: %s" % e)
+            data = self._zlib.unconsumed_tail
+            self.time += time() - start
+            self.raw += len(res)
+            if res:
+                yield res
+            # A full piece may leave more output pending, even without input left
+            if not data and len(res) < self.max_length:
+                break
+
+
 class MessageQueue(object):
     def __init__(self, decoder=MESSAGE_DECODER):
         self._queue = deque()
-        self._write = decoder(self._queue.append)
+        self._inflate_after = None
+        self.inflater = None
+        self._write = decoder(self._queue.append, self._filter_after)
+
+    def inflate_after(self, predicate):
+        '''Decompresses the stream after the first message matching predicate'''
+        self._inflate_after = predicate
+
+    def _filter_after(self, msg):
+        if self._inflate_after and self._inflate_after(msg):
+            self._inflate_after = None
+            self.inflater = Inflater()
+            return self.inflater
 
     def __call__(self, data):
         self._write(data)
         return len(data)
 
+    def __len__(self):
+        return len(self._queue)
+
     def pop(self):
         return self._queue.popleft()
 
@@ -1,5 +1,5 @@
 from cStringIO import StringIO
-from mock import Mock, call
+from mock import Mock, call, patch
 from nose.tools import *
 
 from distdb.serialize import *
@@ -59,3 +59,43 @@ class test_MessageQueue():
 
     def test_clear(self):
         assert_equal(self.q.clear(), [hello_world, hello_other])
+
+    def test_inflate_after(self):
+        q = MessageQueue(MESSAGE_DECODER)
+        q.inflate_after(lambda msg: msg.name == 'World')
+        deflate = Deflater()
+        buf = StringIO()
+        MESSAGE_ENCODER(buf.write)('hello', hello_world)
+        MESSAGE_ENCODER(lambda data: buf.write(deflate(data)))('hello', [hello_other, hello_world, hello_other])
+
+        # The compressed part may arrive with the message switching to it
+        data = buf.getvalue()
+        q(data[:-3])
+        q(data[-3:])
+        assert_equal(q.clear(), [hello_world, hello_other, hello_world, hello_other])
+        assert_equal(q.inflater.raw, deflate.raw)
+        assert_equal(q.inflater.compressed, deflate.compressed)
+
+    @patch('distdb.serialize.MAX_MESSAGE_SIZE', 1024)
+    def test_message_too_large(self):
+        q = MessageQueue(MESSAGE_DECODER)
+        q.inflate_after(lambda msg: msg.name == 'World')
+        deflate = Deflater()
+        buf = StringIO()
+        MESSAGE_ENCODER(buf.write)('hello', hello_world)
+        MESSAGE_ENCODER(lambda data: buf.write(deflate(data)))('hello', Hello(name='x' * 100000))
+
+        # A small frame, that would inflate far beyond the limit
+        assert_less(len(buf.getvalue()), 1024)
+        assert_raises(ProtocolError, q, buf.getvalue())
+        assert_less(q.inflater.raw, 100000)
+
+
+def test_inflater_pieces():
+    data = ''.join(chr(i % 7) for i in range(10000))
+    compressed = Deflater()(data)
+    inflate = Inflater(max_length=100)
+    pieces = list(inflate(compressed[:10])) + list(inflate(compressed[10:]))
+    assert_true(all(0 < len(piece) <= 100 for piece in pieces))
+    assert_equal(''.join(pieces), data)
+    assert_raises(ProtocolError, list, Inflater()('not zlib'))
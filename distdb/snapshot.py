@@ -0,0 +1,228 @@
+'''Compact binary snapshots of a DB, for bootstrapping new nodes.
+
+A snapshot is MAGIC followed by chunks. Each chunk has a header of (type,
+length, CRC32) followed by `length` bytes of zlib-compressed rows. Rows are
+sequences of tagged values: varint integers, doubles, utf-8 strings or null.
+
+The first chunk describes the source (node name and last serial), the last one
+holds the number of rows of each type, to detect truncated snapshots. Private
+keys (starting with '@') are left out.'''
+
+from contextlib import contextmanager
+from cStringIO import StringIO
+import struct
+import zlib
+
+from _setup import _fill_name_index, _hash_lists, _index_dirents
+from database import Transaction
+
+MAGIC = 'BHSNAP\x00\x01'
+
+# Rows per chunk
+CHUNK_ROWS = 4096
+
+HEADER, OBJ, KEY, LIST, MAP, END = 'HOKLME'
+
+_CHUNK = struct.Struct('>cII')
+_DOUBLE = struct.Struct('>d')
+
+# (chunk type, columns, export query, import statement)
+TABLES = [
+    (OBJ, 2, "SELECT objid, obj FROM obj ORDER BY objid",
+     "INSERT INTO obj (objid, obj) VALUES (?, ?)"),
+    (KEY, 2, "SELECT keyid, key FROM key WHERE NOT key LIKE '@%' ORDER BY keyid",
+     "INSERT INTO key (keyid, key) VALUES (?, ?)"),
+    (LIST, 2, "SELECT listid, value FROM list WHERE listid IN ("
+              "SELECT listid FROM map NATURAL JOIN key WHERE NOT key LIKE '@%' AND serial <= ?"
+              ") ORDER BY itemid",
+     "INSERT INTO list (listid, value) VALUES (?, ?)"),
+    (MAP, 5, "SELECT serial, objid, keyid, timestamp, listid FROM map NATURAL JOIN key "
+             "WHERE NOT key LIKE '@%' AND serial <= ? ORDER BY serial",
+     "INSERT INTO map (serial, objid, keyid, timestamp, listid) VALUES (?, ?, ?, ?, ?)"),
+]
+COLUMNS = dict((type, columns) for type, columns, _, _ in TABLES)
+COLUMNS[HEADER] = 2
+COLUMNS[END] = 2
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _write_varint(out, n):
+    while n > 0x7f:
+        out.write(chr(0x80 | (n & 0x7f)))
+        n >>= 7
+    out.write(chr(n))
+
+
+def _read_varint(buf, pos):
+    n = shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _encode(out, row):
+    for value in row:
+        if value is None:
+            out.write('n')
+        elif isinstance(value, (int, long)):
+            out.write('i')
+            _write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+        elif isinstance(value, float):
+            out.write('f')
+            out.write(_DOUBLE.pack(value))
+        else:
+            value = value.encode('utf-8')
+            out.write('s')
+            _write_varint(out, len(value))
+            out.write(value)
+
+
+def _decode(buf, columns):
+    pos = 0
+    row = list()
+    while pos < len(buf):
+        tag = buf[pos]
+        pos += 1
+        if tag == 'n':
+            row.append(None)
+        elif tag == 'i':
+            n, pos = _read_varint(buf, pos)
+            row.append(n >> 1 if not n & 1 else -((n + 1) >> 1))
+        elif tag == 'f':
+            row.append(_DOUBLE.unpack_from(buf, pos)[0])
+            pos += _DOUBLE.size
+        elif tag == 's':
+            length, pos = _read_varint(buf, pos)
+            row.append(buf[pos:pos + length].decode('utf-8'))
+            pos += length
+        else:
+            raise SnapshotError("Unknown value tag %r" % tag)
+        if len(row) == columns:
+            yield tuple(row)
+            row = list()
+    if row:
+        raise SnapshotError("Truncated row")
+
+
+def _write_chunk(f, type, rows):
+    buf = StringIO()
+    for row in rows:
+        _encode(buf, row)
+    data = zlib.compress(buf.getvalue())
+    f.write(_CHUNK.pack(type, len(data), zlib.crc32(data) & 0xffffffff))
+    f.write(data)
+
+
+def _read_chunks(f):
+    while True:
+        header = f.read(_CHUNK.size)
+        if not header:
+            raise SnapshotError("Snapshot ended before its end marker")
+        if len(header) < _CHUNK.size:
+            raise SnapshotError("Truncated chunk header")
+        type, length, crc = _CHUNK.unpack(header)
+        data = f.read(length)
+        if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+            raise SnapshotError("Corrupt or truncated chunk of type %r" % type)
+        if type not in COLUMNS:
+            raise SnapshotError("Unknown chunk type %r" % type)
+        yield type, list(_decode(zlib.decompress(data), COLUMNS[type]))
+
+
+@contextmanager
+def _read_transaction(db):
+    '''Yields a connection reading a consistent state of db.
+
+    A connection from the read pool is used, so neither writers nor other readers
+    wait for the export. In-memory DBs have none, and are read under the lock.'''
+    conn = db._reader()
+    if conn is None:
+        with db.lock, db.transaction(Transaction.DEFERRED):
+            yield db.conn
+        return
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        conn.execute("COMMIT")
+
+
+def export(db, f, name):
+    '''Writes a snapshot of db to file-like f, naming `name` as the source. Returns the
+    last serial included.'''
+    f.write(MAGIC)
+    counts = dict()
+    with _read_transaction(db) as conn:
+        serial = conn.execute("SELECT MAX(serial) FROM map").fetchone()[0] or 0
+        _write_chunk(f, HEADER, [(name, serial)])
+        for type, _, query, _ in TABLES:
+            args = (serial,) if type in (LIST, MAP) else ()
+            cursor = conn.execute(query, args)
+            counts[type] = 0
+            while True:
+                rows = cursor.fetchmany(CHUNK_ROWS)
+                if not rows:
+                    break
+                _write_chunk(f, type, rows)
+                counts[type] += len(rows)
+    _write_chunk(f, END, sorted(counts.iteritems()))
+    return serial
+
+
+def restore(db, f):
+    '''Imports a snapshot from file-like f into an empty db.
+
+    Secondary indexes are dropped during the import, and rebuilt afterwards.
+    The source is recorded as synced up to the snapshot, so it only sends
+    later changes. Returns (source name, serial).'''
+    if f.read(len(MAGIC)) != MAGIC:
+        raise SnapshotError("Not a bhindex snapshot")
+    if db.last_serial() or any(db._query_single("SELECT EXISTS (SELECT 1 FROM %s)" % table)
+                               for table in ('obj', 'key', 'list')):
+        raise SnapshotError("Snapshots can only be imported into an empty DB")
+
+    statements = dict((type, insert) for type, _, _, insert in TABLES)
+    counts = dict((type, 0) for type in statements)
+    source = None
+    db.set_volatile(True)
+    try:
+        with db.lock, db.transaction():
+            conn = db.conn
+            indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+                                   "AND tbl_name IN ('obj', 'key', 'list', 'map')").fetchall()
+            for index, _ in indexes:
+                conn.execute("DROP INDEX %s" % index)
+
+            for type, rows in _read_chunks(f):
+                if type == HEADER:
+                    source, = rows
+                elif type == END:
+                    if dict(rows) != counts:
+                        raise SnapshotError("Snapshot should have %s rows, but had %s" % (dict(rows), counts))
+                    break
+                elif source is None:
+                    raise SnapshotError("Snapshot lacks header")
+                else:
+                    conn.executemany(statements[type], rows)
+                    counts[type] += len(rows)
+
+            for _, sql in indexes:
+                conn.execute(sql)
+            _hash_lists(conn)
+            _index_dirents(conn)
+            if db.fts:
+                _fill_name_index(conn)
+
+            name, serial = source
+            db.set_sync_state(name, serial)
+            conn.execute("INSERT INTO snapshot_state (source, serial) VALUES (?, ?)", (name, serial))
+    finally:
+        db.set_volatile(False)
+    return source
@@ -0,0 +1,104 @@
+from cStringIO import StringIO
+from os import path
+from Queue import Queue
+from threading import Thread
+
+from nose.tools import *
+
+from distdb import DB, Object
+from distdb.database_test import TempDir
+from distdb.obj import TimedValues
+from distdb.snapshot import END, LIST, MAGIC, SnapshotError, _read_chunks, export, restore
+
+
+def populate(db):
+    with db.transaction() as t:
+        for i in range(100):
+            t.update(Object(u'file%d' % i, {
+                u'name': TimedValues([u'file %d' % i, u'fil %d' % i], t=i),
+                u'directory': TimedValues(u'dir/file%d' % i, t=i),
+                u'size': TimedValues(u'%d' % (i * 1024), t=i + 0.5),
+                u'@private': TimedValues(u'secret', t=i),
+            }))
+        t.update(Object(u'dir', {u'name': TimedValues(u'dir', t=1)}))
+        t.delete(Object(u'file0'), t=200)
+
+
+def snapshot_of(db, name=u'source'):
+    buf = StringIO()
+    serial = export(db, buf, name)
+    return serial, buf.getvalue()
+
+
+class TestSnapshot():
+    def setup(self):
+        self.src = DB(':memory:')
+        populate(self.src)
+        self.serial, self.data = snapshot_of(self.src)
+
+    def test_roundtrip(self):
+        dst = DB(':memory:')
+        assert_equal(restore(dst, StringIO(self.data)), (u'source', self.serial))
+
+        assert_equal(dst.last_serial(), self.serial)
+        assert_equal(dst.get_sync_state(u'source')['last_received'], self.serial)
+        assert_equal(dst.snapshot_serial(u'source'), self.serial)
+        for i in range(1, 100):
+            obj = dst[u'file%d' % i]
+            assert_not_in(u'@private', obj)
+            for key in (u'name', u'directory', u'size'):
+                assert_equal(obj.item(key), self.src[obj.id].item(key))
+        assert_equal(dst[u'file0'].get(u'name'), None)
+        assert_equal([name for name, _ in dst.dir_children([u'dir'])],
+                     sorted(u'file%d' % i for i in range(1, 100)))
+
+        # Indexes are rebuilt
+        indexes = lambda db: sorted(db._query_all("SELECT name FROM sqlite_master WHERE type = 'index'", ()))
+        assert_equal(indexes(dst), indexes(self.src))
+
+        # Further changes are assigned new serials
+        with dst.transaction() as t:
+            t.update_attr(u'file1', u'name', TimedValues(u'renamed', t=300))
+        assert_greater(dst.last_serial(), self.serial)
+
+    def test_corruption(self):
+        dst = DB(':memory:')
+        corrupt = self.data[:100] + chr(ord(self.data[100]) ^ 1) + self.data[101:]
+        assert_raises(SnapshotError, restore, dst, StringIO(corrupt))
+        assert_equal(dst.last_serial(), 0)
+
+        dst = DB(':memory:')
+        assert_raises(SnapshotError, restore, dst, StringIO(self.data[:-20]))
+        assert_equal(dst.last_serial(), 0)
+
+        assert_raises(SnapshotError, restore, DB(':memory:'), StringIO('not a snapshot'))
+
+    def test_private_values_left_out(self):
+        f = StringIO(self.data[len(MAGIC):])
+        values = set()
+        for type, rows in _read_chunks(f):
+            if type == LIST:
+                values.update(value for _, value in rows)
+            elif type == END:
+                break
+        assert_in(u'dir/file1', values)
+        assert_not_in(u'secret', values)
+
+    def test_nonempty(self):
+        assert_raises(SnapshotError, restore, self.src, StringIO(self.data))
+
+        dst = DB(':memory:')
+        dst.keys(u'leftover')
+        assert_raises(SnapshotError, restore, dst, StringIO(self.data))
+
+
+def test_export_does_not_lock():
+    with TempDir() as d:
+        db = DB(path.join(d.name, 'db'))
+        populate(db)
+        result = Queue()
+        with db.lock:
+            Thread(target=lambda: result.put(snapshot_of(db))).start()
+            serial, data = result.get(timeout=5)
+        assert_equal(serial, db.last_serial())
+        assert_equal(restore(DB(':memory:'), StringIO(data)), (u'source', serial))
@@ -18,7 +18,7 @@ _sym_db = _symbol_database.Default()
 DESCRIPTOR = _descriptor.FileDescriptor(
   name='sync.proto',
   package='distdb.sync',
-  serialized_pb=_b('\n\nsync.proto\x12\x0b\x64istdb.sync\"\x15\n\x05Hello\x12\x0c\n\x04name\x18\x01 \x02(\t\"@\n\x05Setup\x12\x19\n\x11last_serial_in_db\x18\x01 \x02(\x04\x12\x1c\n\x14last_serial_received\x18\x02 \x02(\x04\"B\n\x06Update\x12\x0b\n\x03obj\x18\x01 \x02(\t\x12\x0b\n\x03key\x18\x02 \x02(\t\x12\x0e\n\x06tstamp\x18\x03 \x02(\x03\x12\x0e\n\x06values\x18\x04 \x03(\t\"\x1c\n\nCheckpoint\x12\x0e\n\x06serial\x18\x01 \x02(\x03\"\xa0\x01\n\x06Stream\x12!\n\x05hello\x18\x01 \x02(\x0b\x32\x12.distdb.sync.Hello\x12!\n\x05setup\x18\x02 \x02(\x0b\x32\x12.distdb.sync.Setup\x12#\n\x06update\x18\x03 \x03(\x0b\x32\x13.distdb.sync.Update\x12+\n\ncheckpoint\x18\x04 \x03(\x0b\x32\x17.distdb.sync.Checkpoint')
+  serialized_pb=_b('\n\nsync.proto\x12\x0b\x64istdb.sync\"*\n\x05Hello\x12\x0c\n\x04name\x18\x01 \x02(\t\x12\x13\n\x0bzlib_stream\x18\x02 \x01(\x08\"Y\n\x05Setup\x12\x19\n\x11last_serial_in_db\x18\x01 \x02(\x04\x12\x1c\n\x14last_serial_received\x18\x02 \x02(\x04\x12\x17\n\x0fsnapshot_serial\x18\x03 \x01(\x04\"B\n\x06Update\x12\x0b\n\x03obj\x18\x01 \x02(\t\x12\x0b\n\x03key\x18\x02 \x02(\t\x12\x0e\n\x06tstamp\x18\x03 \x02(\x03\x12\x0e\n\x06values\x18\x04 \x03(\t\"\x1c\n\nCheckpoint\x12\x0e\n\x06serial\x18\x01 \x02(\x03\"\xa0\x01\n\x06Stream\x12!\n\x05hello\x18\x01 \x02(\x0b\x32\x12.distdb.sync.Hello\x12!\n\x05setup\x18\x02 \x02(\x0b\x32\x12.distdb.sync.Setup\x12#\n\x06update\x18\x03 \x03(\x0b\x32\x13.distdb.sync.Update\x12+\n\ncheckpoint\x18\x04 \x03(\x0b\x32\x17.distdb.sync.Checkpoint')
 )
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
@@ -39,6 +39,13 @@ _HELLO = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    _descriptor.FieldDescriptor(
+      name='zlib_stream', full_name='distdb.sync.Hello.zlib_stream', index=1,
+      number=2, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
@@ -51,7 +58,7 @@ _HELLO = _descriptor.Descriptor(
   oneofs=[
   ],
   serialized_start=27,
-  serialized_end=48,
+  serialized_end=69,
 )
 
 
@@ -76,6 +83,13 @@ _SETUP = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    _descriptor.FieldDescriptor(
+      name='snapshot_serial', full_name='distdb.sync.Setup.snapshot_serial', index=2,
+      number=3, type=4, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
@@ -87,8 +101,8 @@ _SETUP = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=50,
-  serialized_end=114,
+  serialized_start=71,
+  serialized_end=160,
 )
 
 
@@ -138,8 +152,8 @@ _UPDATE = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=116,
-  serialized_end=182,
+  serialized_start=162,
+  serialized_end=228,
 )
 
 
@@ -168,8 +182,8 @@ _CHECKPOINT = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=184,
-  serialized_end=212,
+  serialized_start=230,
+  serialized_end=258,
 )
 
 
@@ -219,8 +233,8 @@ _STREAM = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=215,
-  serialized_end=375,
+  serialized_start=261,
+  serialized_end=421,
 )
 
 _STREAM.fields_by_name['hello'].message_type = _HELLO
@@ -1,45 +1,77 @@
+from collections import deque
 from cStringIO import StringIO
 from obj import TimedValues
-from uuid import uuid4 as uuid
+from Queue import Empty, Queue
+from select import error as select_error, select
+from sys import exc_info
+from threading import Thread
+import errno
+import fcntl
 import logging
+import os
 import socket
 
-from thread_io import connect, listen, serve, sleep, spawn, ThreadPool
+from thread_io import spawn
 
-from distdb.serialize import MESSAGE_DECODER, MESSAGE_ENCODER, MessageQueue
+from distdb.serialize import MESSAGE_DECODER, MESSAGE_ENCODER, Deflater, MessageQueue, ProtocolError
 from distdb import sync_pb2, Transaction
 
 from time import time
 
 HANDSHAKE_TIMEOUT = 5
 WRITE_TIMEOUT = 3
+LISTEN_BACKLOG = 16
 
+# Received messages queued per peer, before it is no longer read from
+READ_BACKLOG = 16384
 
-class Deadline(object):
-    def __init__(self, timeout):
-        self.value = timeout and time() + timeout
-
-    def timeleft(self):
-        return self.value and self.value - time()
+# Bounds of the number of changes pushed per message, adapting to how fast the peer receives
+PUSH_BATCH_MIN = 64
+PUSH_BATCH_MAX = 16384
 
 
 class SyncConnection(object):
-    def __init__(self, db, name, sock, uuid):
+    '''A sync session with a peer, on a non-blocking socket, driven by the Syncer loop.
+
+    Sent messages are buffered, and written by flush() as the socket accepts them.
+    Received messages are queued by receive(), until process() hands them on to be
+    applied in a transaction.'''
+    CONNECTING, HELLO, SETUP, RUNNING = 'connecting', 'hello', 'setup', 'running'
+
+    def __init__(self, db, name, sock, connect_address=None, compress=True):
         self.db = db
         self.name = name
+        self.compress = compress
+        self.connect_address = connect_address
         self._sock = sock
         self._msg_queue = MessageQueue(MESSAGE_DECODER)
+        self._deflater = None
+        if compress:
+            self._msg_queue.inflate_after(lambda msg: isinstance(msg, sync_pb2.Hello) and msg.zlib_stream)
         self._echo_prevention = set()
         self._log = logging.getLogger('[anon]')
 
         self.peername = None
         self._last_serial_received = 0
+        self.busy = False
+        self.eof = False
+        self._handshake_deadline = time() + HANDSHAKE_TIMEOUT
+        self._outbuf = deque()
+        self._progress = None
+        self._pushed = None
 
         # Configure TCP keepalive
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 15)
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        sock.setblocking(0)
+
+        if connect_address:
+            self.stage = self.CONNECTING
+        else:
+            self.stage = self.HELLO
+            self._sendmsg(['hello', self._hello()])
 
     def __enter__(self):
         return self
@@ -47,86 +79,238 @@ class SyncConnection(object):
     def __exit__(self, type, value, tb):
         self.close()
 
-    def handshake(self):
-        assert not self.peername
-        self._sendmsg(['hello', sync_pb2.Hello(name=self.name)])
-        peerhello = self.read_msg(timeout=HANDSHAKE_TIMEOUT)
-        if not peerhello:
-            return
-        self.peername = peerhello.name
-        with self.db.lock, self.db.transaction():
-            self._last_serial_received = self.db.get_sync_state(self.peername)['last_received']
-            self._sendmsg(['setup', sync_pb2.Setup(
-                last_serial_received=self._last_serial_received,
-                last_serial_in_db=self.db.last_serial(),
-            )])
+    def __str__(self):
+        return str(self.peername or self.connect_address)
+
+    def fileno(self):
+        return self._sock.fileno()
 
+    def wants_read(self):
+        if self.closed() or self.eof or self.stage == self.CONNECTING:
+            return False
+        # Leave the rest in the socket buffers, until the SyncWriter has caught up
+        return len(self._msg_queue) < READ_BACKLOG
+
+    def wants_write(self):
+        return not self.closed() and (self.stage == self.CONNECTING or bool(self._outbuf))
+
+    def deadline(self):
+        '''Time when the handshake, or the write in progress, has taken too long'''
+        if self.stage != self.RUNNING:
+            return self._handshake_deadline
+        if self._outbuf:
+            return self._progress + WRITE_TIMEOUT
+        return None
+
+    def connected(self):
+        '''Completes a connection in progress. Returns whether it succeeded.'''
+        err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            logging.debug("Failed to connect to %s: errno %d", self.connect_address, err)
+            self.close()
+            return False
+        self.stage = self.HELLO
+        self._sendmsg(['hello', self._hello()])
+        return True
+
+    def _hello(self):
+        hello = sync_pb2.Hello(name=self.name)
+        if self.compress:
+            hello.zlib_stream = True
+        return hello
+
+    def _setup(self, peerhello):
+        '''Returns the Setup for the peer introduced by peerhello. Must run in a transaction.
+
+        Only reads, so it may be retried. Apply the result with _set_up().'''
+        return sync_pb2.Setup(
+            last_serial_received=self.db.get_sync_state(peerhello.name)['last_received'],
+            last_serial_in_db=self.db.last_serial(),
+            snapshot_serial=self.db.snapshot_serial(peerhello.name),
+        )
+
+    def _set_up(self, peerhello, setup):
+        self.peername = peerhello.name
         self._log = logging.getLogger(self.peername)
+        self._last_serial_received = setup.last_serial_received
+        if self.compress and peerhello.zlib_stream:
+            # From here on, both directions are zlib streams
+            self._deflater = Deflater()
+        self._sendmsg(['setup', setup])
+        self.stage = self.SETUP
+
+    def _configure(self, peersetup):
+        '''Returns (last serial sent, last serial received, Subscription) to resume from in
+        both directions, given the Setup of the peer. Must run in a transaction.
+
+        Only reads, so it may be retried. Apply the result with _configured().'''
+        last_serial = self.db.last_serial()
+        if peersetup.last_serial_received <= last_serial:
+            sent = peersetup.last_serial_received
+        else:
+            self._log.warn("detecting local db was reset")
+            sent = 0
 
-        peersetup = self.read_msg(timeout=HANDSHAKE_TIMEOUT)
-        if not peersetup:
-            return
-        with self.db.lock, self.db.transaction():
-            if peersetup.last_serial_received <= self.db.last_serial():
-                self._last_serial_sent = peersetup.last_serial_received
-            else:
-                self._log.warn("detecting local db was reset")
-                self._last_serial_sent = 0
+        received = self._last_serial_received
+        if peersetup.last_serial_in_db < received:
+            self._log.warn("detecting remote db was reset")
+            received = 0
+
+        # Peer was bootstrapped from a snapshot of this DB, only send the tail after it
+        if sent < peersetup.snapshot_serial <= last_serial:
+            self._log.info("%s has a snapshot up to my #%d", self.peername, peersetup.snapshot_serial)
+            sent = peersetup.snapshot_serial
 
-            if peersetup.last_serial_in_db < self._last_serial_received:
-                self._log.warn("detecting remote db was reset")
-                self._last_serial_received = 0
+        # This DB was bootstrapped from a snapshot of the peer, which already has all of it
+        imported = self.db.snapshot_serial(self.peername)
+        if sent < imported <= last_serial:
+            self._log.info("I have a snapshot of %s up to #%d", self.peername, imported)
+            sent = imported
 
-        self._log.info("%s is requesting from my #%d (is %d behind) ", self.peername,
-                       self._last_serial_sent, self.db.last_serial() - self._last_serial_sent)
+        self._log.info("%s is requesting from my #%d (is %d behind) ", self.peername, sent, last_serial - sent)
         self._log.info("%s is currently at #%d (I'm %d behind)", self.peername, peersetup.last_serial_in_db,
-                       peersetup.last_serial_in_db - self._last_serial_received)
+                       peersetup.last_serial_in_db - received)
+        return sent, received, self.db.subscribe(sent)
 
-        return self
+    def _configured(self, positions):
+        self._last_serial_sent, self._last_serial_received, self._changes = positions
+        self.stage = self.RUNNING
 
     def _sendmsg(self, *msg_groups):
         if not self._sock:
             return
+        data, res = self._encode(msg_groups)
+        if data:
+            if not self._outbuf:
+                self._progress = time()
+            self._outbuf.append(data)
+        return res
+
+    def _encode(self, msg_groups):
+        '''Returns (bytes, number of messages) of msg_groups'''
         buf = StringIO()
         enc = MESSAGE_ENCODER(buf.write)
         res = 0
         for field, msg in msg_groups:
             res += enc(field, msg)
-        self._sock.send_within(WRITE_TIMEOUT, buf.getvalue())
-        return res
-
-    def _read_and_queue(self, timeout=None):
+        data = buf.getvalue()
+        if self._deflater and data:
+            data = self._deflater(data)
+        return data, res
+
+    def compression_stats(self):
+        '''Returns (bytes, bytes compressed, seconds spent compressing) for 'sent' and
+        (bytes, bytes compressed, seconds spent decompressing) for 'received', or
+        None if the stream is not compressed'''
+        inflater = self._msg_queue.inflater
+        if not self._deflater:
+            return None
+        return dict((direction, z and (z.raw, z.compressed, z.time))
+                    for direction, z in (('sent', self._deflater), ('received', inflater)))
+
+    def log_compression_stats(self):
+        stats = self.compression_stats()
+        for direction, counts in sorted((stats or {}).iteritems()):
+            if counts and counts[0]:
+                raw, compressed, elapsed = counts
+                self._log.info("%s %d bytes as %d with zlib (%.1f%%), in %.3fs", direction,
+                               raw, compressed, compressed * 100.0 / raw, elapsed)
+
+    def receive(self):
         try:
-            sock = self._sock
-            if not sock:
-                return False
-
-            sock.settimeout(timeout)
-            if self._msg_queue(sock.recv(64 * 1024)):
-                return True
-            else:
+            data = self._sock.recv(64 * 1024)
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._log.info("Failed to receive: errno: %s (%s)", e.errno, e.strerror)
+                self.close()
+            return
+        if data:
+            try:
+                self._msg_queue(data)
+            except ProtocolError, e:
+                self._log.warning("Protocol error from %s: %s", self, e)
                 self.close()
+        else:
+            # Messages already received are still applied, before closing
+            self.eof = True
+
+    def flush(self):
+        '''Writes what the socket accepts without blocking. Returns whether all was written.'''
+        while self._outbuf and self._sock:
+            data = self._outbuf[0]
+            try:
+                sent = self._sock.send(data)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            self._progress = time()
+            if sent < len(data):
+                self._outbuf[0] = data[sent:]
                 return False
+            self._outbuf.popleft()
+
+        if self._pushed:
+            fetched, start = self._pushed
+            self._pushed = None
+            self._adapt_batch_size(fetched, time() - start)
+        return True
+
+    def push(self):
+        '''Buffers the next changes for the peer, unless the last ones are still being
+        written. Returns the number of updates.'''
+        if self.closed() or self.stage != self.RUNNING or self._outbuf:
+            return 0
+        updates, last_serial, fetched = self._poll_updates()
+        msg_groups = self._push_messages(updates, last_serial)
+        if msg_groups:
+            self._sendmsg(*msg_groups)
+            self._pushed = fetched, time()
+        self._last_serial_sent = last_serial
+        return len(updates)
 
-        except IOError, e:
-            self._log.info("Failed to receive: errno: %s (%s)", e.errno, e.strerror)
-            self.close()
+    def process(self, submit):
+        '''Hands the next received messages on to submit(job, then, rollback), which must run
+        job(transaction) in a transaction, then then(result) once committed, or
+        rollback(result) if rolled back after job succeeded. Returns whether a job was
+        submitted. Until then() is called, nothing more is, so messages are applied in order.'''
+        if self.busy or self.closed():
+            return False
+        queue = self._msg_queue
+        if self.stage == self.HELLO and len(queue):
+            hello = self._expect(sync_pb2.Hello)
+            if hello is None:
+                return False
+            job, then, rollback = (lambda t: self._setup(hello)), (lambda setup: self._set_up(hello, setup)), None
+        elif self.stage == self.SETUP and len(queue):
+            setup = self._expect(sync_pb2.Setup)
+            if setup is None:
+                return False
+            job, then, rollback = (lambda t: self._configure(setup)), self._configured, None
+        elif self.stage == self.RUNNING and len(queue):
+            chunk = queue.clear()
+            job, then, rollback = (lambda t: self._process_updates(chunk, t)), self._received, self._rolled_back
+        else:
+            if self.eof:
+                self.close()
             return False
 
-    def read_chunk(self):
-        chunk = self._msg_queue.clear()
-        while (not chunk) and self._read_and_queue():
-            chunk = self._msg_queue.clear()
-        return chunk
-
-    def read_msg(self, timeout=None):
-        deadline = Deadline(timeout)
-        while True:
-            try:
-                return self._msg_queue.pop()
-            except IndexError:
-                if not self._read_and_queue(timeout=deadline.timeleft()):
-                    return None
+        def done(result):
+            self.busy = False
+            then(result)
+        self.busy = True
+        submit(job, done, rollback)
+        return True
+
+    def _expect(self, msg_type):
+        '''Returns the next received message, or None after closing if it is not a msg_type'''
+        msg = self._msg_queue.pop()
+        if isinstance(msg, msg_type):
+            return msg
+        self._log.warning("Protocol error from %s: expected %s, got %s",
+                          self, msg_type.__name__, type(msg).__name__)
+        self.close()
+        return None
 
     def shutdown(self):
         if self._sock:
@@ -146,129 +330,161 @@ class SyncConnection(object):
         return self._sock is None
 
     def _process_updates(self, chunk, transaction):
-        chunk_applied = 0
-        chunk_had = 0
+        '''Applies a chunk of Updates and Checkpoints from the peer in transaction. Returns
+        (serials written, last serial received).
+
+        The serials are kept from being echoed right away, since they may be pushed as soon
+        as committed. The rest is applied with _received() once committed, or the serials
+        forgotten with _rolled_back() if not, so a retry gives the same result.'''
+        updates = list()
         last_serial = self._last_serial_received
         for msg in chunk:
             if isinstance(msg, sync_pb2.Update):
-                chunk_had += 1
-                serial = transaction.update_attr(msg.obj, msg.key, TimedValues(msg.values, t=msg.tstamp))
-                if serial:
-                    self._echo_prevention.add(serial)
-                    chunk_applied += 1
+                updates.append((msg.obj, msg.key, TimedValues(msg.values, t=msg.tstamp)))
             elif isinstance(msg, sync_pb2.Checkpoint):
                 last_serial = max(last_serial, msg.serial)
             else:
                 raise TypeError("Unknown message")
 
-        if chunk_had:
-            self._log.debug("Commit %d/%d", chunk_applied, chunk_had)
+        serials = [serial for serial in transaction.update_attrs(updates) if serial]
+        if updates:
+            self._log.debug("Commit %d/%d", len(serials), len(updates))
         if self._last_serial_received != last_serial:
             self._log.debug("Checkpoint %d", last_serial)
-            self._last_serial_received = last_serial
-            self.db.set_sync_state(self.peername, last_received=self._last_serial_received)
-
-    def _step(self):
-        chunk = self.read_chunk()
-        if chunk:
-            with self.db.lock, self.db.transaction(Transaction.IMMEDIATE) as t:
-                self._process_updates(chunk, t)
-            return True
-        else:
-            return False
-
-    def run(self):
-        while self._step():
-            sleep(0.0001)
-
-    def db_push(self):
-        def poll_updates(last_serial):
-            updates = list()
-            for obj, key, tstamp, serial, values in self.db.get_public_mappings_after(last_serial):
-                if serial in self._echo_prevention:
-                    self._echo_prevention.discard(serial)
-                else:
-                    updates.append(sync_pb2.Update(obj=obj, key=key, tstamp=int(tstamp), values=values))
-                last_serial = max(last_serial, serial)
-            return updates, last_serial
-
-        def send_messages(updates, last_serial):
-            msg_groups = list()
-            if updates:
-                msg_groups.append(['update', updates])
-            if last_serial > self._last_serial_sent:
-                msg_groups.append(['checkpoint', sync_pb2.Checkpoint(serial=last_serial)])
-            if msg_groups:
-                try:
-                    self._sendmsg(*msg_groups)
-                except socket.timeout:
-                    logging.getLogger('syncer').warning("Peer %s is blocking on writes (too slow?). Disconnecting.", self.peername)
-                    self.close()
-
-        updates, last_serial = poll_updates(self._last_serial_sent)
-        send_messages(updates, last_serial)
-        self._last_serial_sent = last_serial
-
-        return len(updates)
-
-
-class OwnedKeyDict:
-    def __init__(self):
-        self._dict = dict()
-
-    def __getitem__(self, k):
-        return self._dict[k]
+            self.db.set_sync_state(self.peername, last_received=last_serial)
+        self._echo_prevention.update(serials)
+        return serials, last_serial
+
+    def _received(self, processed):
+        _, self._last_serial_received = processed
+
+    def _rolled_back(self, processed):
+        serials, _ = processed
+        self._echo_prevention.difference_update(serials)
+
+    def _poll_updates(self):
+        '''Returns (Updates for the next changes not from the peer itself, serial of the last
+        change, number of changes fetched)'''
+        updates = list()
+        changes = self._changes.fetch()
+        for obj, key, tstamp, serial, values in changes:
+            if serial in self._echo_prevention:
+                self._echo_prevention.discard(serial)
+            else:
+                updates.append(sync_pb2.Update(obj=obj, key=key, tstamp=int(tstamp), values=values))
+        return updates, self._changes.serial, len(changes)
+
+    def _push_messages(self, updates, last_serial):
+        msg_groups = list()
+        if updates:
+            msg_groups.append(['update', updates])
+        if last_serial > self._last_serial_sent:
+            msg_groups.append(['checkpoint', sync_pb2.Checkpoint(serial=last_serial)])
+        return msg_groups
+
+    def _adapt_batch_size(self, fetched, elapsed):
+        '''Grows the push batch while the peer quickly drains full batches, and
+        shrinks it when sending stalls'''
+        changes = self._changes
+        if elapsed > WRITE_TIMEOUT / 4.0:
+            changes.limit = max(changes.limit // 2, PUSH_BATCH_MIN)
+        elif fetched >= changes.limit and elapsed < WRITE_TIMEOUT / 30.0:
+            changes.limit = min(changes.limit * 2, PUSH_BATCH_MAX)
+
+
+class SyncWriter(Thread):
+    '''Applies the DB writes of all peers from one thread.
+
+    Jobs queued while a transaction runs are applied together in the next, so
+    peers share commits instead of queueing on the DB lock one by one.'''
+    def __init__(self, db, done):
+        super(SyncWriter, self).__init__(name="SyncWriter")
+        self.daemon = True
+        self._db = db
+        self._done = done
+        self._jobs = Queue()
 
-    def __contains__(self, k):
-        return k in self._dict
+    def submit(self, job, callback, rollback=None):
+        '''Runs job(transaction) in the writer thread, and then
+        done(callback, result, exc_info) where exc_info is None on success.
 
-    def itervalues(self):
-        return self._dict.itervalues()
+        If the transaction is rolled back after job succeeded, rollback(result) is called
+        before the job is retried, or failed.'''
+        self._jobs.put((job, callback, rollback))
 
-    def values(self):
-        return self._dict.values()
+    def close(self):
+        self._jobs.put(None)
 
-    def key_context(self):
-        return self.KeyContext(self._dict)
+    def run(self):
+        stopped = False
+        while not stopped:
+            batch = [self._jobs.get()]
+            try:
+                while True:
+                    batch.append(self._jobs.get_nowait())
+            except Empty:
+                pass
+            stopped = None in batch
+            self._apply([x for x in batch if x])
 
-    class KeyContext:
-        def __init__(self, dict):
-            self.dict = dict
-            self.keys = set()
+    def _apply(self, batch):
+        if not batch:
+            return
+        results = list()
+        try:
+            with self._db.lock, self._db.transaction(Transaction.IMMEDIATE) as t:
+                for job, _, _ in batch:
+                    results.append(job(t))
+        except Exception:
+            exc = exc_info()
+            for (_, _, rollback), result in zip(batch, results):
+                if rollback:
+                    rollback(result)
+            if len(batch) == 1:
+                self._done(batch[0][1], None, exc)
+            else:
+                # Everything was rolled back. Retry one by one, to only fail the culprit.
+                for job in batch:
+                    self._apply([job])
+            return
+        for (_, callback, _), result in zip(batch, results):
+            self._done(callback, result, None)
 
-        def __enter__(self):
-            return self
 
-        def __exit__(self, exc_type, exc_value, traceback):
-            for key in self.keys:
-                try:
-                    del self.dict[key]
-                except KeyError:
-                    pass
+class Syncer(object):
+    '''Syncs db with peers, all multiplexed on one thread.
 
-        def set_key(self, key, value):
-            if key in self.dict:
-                return None   # Slot was already occupied
-            else:
-                # Slot was empty, we set a new key
-                self.keys.add(key)
-                self.dict[key] = value
-                return value
-
-
-class P2P(object):
-    def __init__(self, listen_addr, handler, connect_addresses=set(), connect_interval=30):
-        if isinstance(listen_addr, int):
-            listen_addr = ('0.0.0.0', listen_addr)
-        self.uuid = uuid()
-        self.handler = handler
-        self.connections = OwnedKeyDict()
+    The loop thread polls the sockets of all peers, connects, handshakes and
+    pushes changes. DB writes for all peers are applied by a SyncWriter, and a
+    third thread only waits for local commits, to wake the loop.'''
+    def __init__(self, db, name, port, connect_addresses=set(), db_poll_interval=5, connect_interval=30,
+                 compress=True):
+        if isinstance(port, int):
+            port = ('0.0.0.0', port)
+        self._db = db
+        self.name = name
+        self.compress = compress
+        self.connections = dict()
         self.connect_interval = connect_interval
+        self.running = True
+        # Address -> True to connect, False while connecting, or the name of the peer once connected
         self._connectAddresses = dict((addr, True) for addr in connect_addresses)
-        self._sock = listen(listen_addr)
-        self._server = spawn(serve, self._sock, self._connectionWrapper)
-        self._connectThread = spawn(self._connector)
-        logging.getLogger('syncer').info("Listening on %s", listen)
+        self._peers = set()
+        self._callbacks = deque()
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(port)
+        self._sock.listen(LISTEN_BACKLOG)
+        self._sock.setblocking(0)
+        self._wakeup, self._waker = os.pipe()
+        fcntl.fcntl(self._waker, fcntl.F_SETFL, os.O_NONBLOCK)
+
+        self._writer = SyncWriter(db, self._completed)
+        self._writer.start()
+        self._loop = spawn(self._run)
+        self._notifier = spawn(self._notify, db_poll_interval)
+        logging.getLogger('syncer').info("Listening on %s", self.local_addr())
 
     def add_address(self, addr):
         if addr not in self._connectAddresses:
@@ -277,131 +493,185 @@ class P2P(object):
     def remove_address(self, addr):
         del self._connectAddresses[addr]
 
-    def _connector(self):
-        def _connect(addr):
-            try:
-                return addr, connect(addr)
-            except Exception:
-                return addr, None
-
-        connectPool = ThreadPool(20)
-        while self._sock:
-            addresses = [addr for addr, uuid in self._connectAddresses.iteritems() if uuid and (uuid not in self.connections)]
-            for address, sock in connectPool.imap(_connect, addresses):
-                if sock:
-                    self._connectAddresses[address] = False
-
-                    def run():
-                        try:
-                            self._connectionWrapper(sock, address, address)
-                        finally:
-                            if not self._connectAddresses[address]:
-                                self._connectAddresses[address] = True
-                    spawn(run)
-            sleep(self.connect_interval)
-
-    def _connectionWrapper(self, sock, client_address, connectAddress=None):
-        if connectAddress:
-            logging.debug("Connection established to %s", sock.getpeername())
-        else:
-            logging.debug("Connection established from %s", sock.getpeername())
-
-        with self.connections.key_context() as o:
-            def set_session(uuid, s):
-                if not self._sock:
-                    return False
-                if connectAddress in self._connectAddresses:
-                    self._connectAddresses[connectAddress] = uuid
-                return o.set_key(uuid, s)
-            self.handler(sock, set_session)
-
     def local_addr(self):
         return self._sock.getsockname()
 
-    def wait(self):
-        try:
-            self._server.wait()
-        except:
-            pass
-        try:
-            self._connectThread.wait()
-        except:
-            pass
-
-    def close(self):
-        if self._sock:
-            sock = self._sock
-            self._sock = None
-            sname = sock.getsockname()
-            sock.close()
-
-            # Connect to break possibly hung accept()-call
-            try:
-                connect(sname)
-            except socket.error:
-                pass
-        self.wait()
-
+    def compression_stats(self):
+        '''Returns SyncConnection.compression_stats() of each connected peer, by name'''
+        return dict((name, peer.compression_stats()) for name, peer in self.connections.items())
 
-class Syncer(P2P):
-    def __init__(self, db, name, port, connect_addresses=set(), db_poll_interval=5, connect_interval=30):
-        self._db = db
-        self.name = name
-        super(Syncer, self).__init__(port, self._spawn, connect_addresses, connect_interval)
-        self.running = True
-        self._pusher = spawn(self._db_push, db_poll_interval)
+    def _call_soon(self, callback):
+        '''Runs callback in the loop thread. Safe to call from any thread.'''
+        self._callbacks.append(callback)
+        try:
+            os.write(self._waker, 'x')
+        except (OSError, TypeError):
+            pass  # Pipe full, so the loop is already woken, or closed along with the loop
 
-    def _spawn(self, sock, set_session):
-        peer = sock.getpeername()
-        with SyncConnection(self._db, self.name, sock, self.uuid) as conn:
-            try:
-                logging.debug("Handshaking with remote address %s", peer)
-                if not conn.handshake():
-                    logging.debug("Handshake ended prematurely with %s", peer)
-                    return
-            except Exception:
-                logging.exception("Handshake failed with %s", peer)
-                return
-
-            peername = conn.peername
-            logging.info("connection established with %s (%s)", peername, peer)
-            if not set_session(peername, conn):
-                logging.info('%s already connected. Dropping.', peername)
-                return
+    def _completed(self, callback, result, exc):
+        self._call_soon(lambda: callback(result, exc))
 
-            try:
-                conn.run()
-            except Exception:
-                logging.exception("%s died", peername)
-            else:
-                logging.info('%s disconnected from %s', conn.peername, peer)
-
-    def _db_push(self, db_poll_interval):
+    def _notify(self, db_poll_interval):
+        # Only used to wake up on changes. Each connection has its own position.
+        changes = self._db.subscribe()
         while self.running:
-            sent = 0
-            with self._db.lock, self._db.transaction():
-                for conn in self.connections.values():
-                    try:
-                        sent += conn.db_push()
-                    except IOError:
-                        logging.debug("Failed to push to %s, disconnecting", conn.peername)
-                    except Exception:
-                        logging.exception("%s push hit error", conn.peername)
-                        conn.shutdown()
-            if sent:
-                sleep(0)
-            else:
-                sleep(db_poll_interval)
+            changes.mark()
+            self._call_soon(self._push)
+            changes.wait(db_poll_interval)
+
+    def _run(self):
+        next_connect = time()
+        try:
+            while self.running:
+                now = time()
+                if now >= next_connect:
+                    self._connect()
+                    next_connect = now + self.connect_interval
+                deadlines = [next_connect]
+                for peer in list(self._peers):
+                    deadline = peer.deadline()
+                    if deadline is not None and deadline <= now:
+                        self._expire(peer)
+                    elif deadline is not None:
+                        deadlines.append(deadline)
+                self._drop_closed()
+
+                readers = [self._wakeup, self._sock] + [peer for peer in self._peers if peer.wants_read()]
+                writers = [peer for peer in self._peers if peer.wants_write()]
+                try:
+                    readable, writable, _ = select(readers, writers, (), max(min(deadlines) - now, 0))
+                except select_error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                for peer in writable:
+                    self._guarded(peer, self._on_writable, peer)
+                for x in readable:
+                    if x is self._sock:
+                        self._accept()
+                    elif x == self._wakeup:
+                        os.read(self._wakeup, 4096)
+                    else:
+                        self._guarded(x, x.receive)
+                        self._guarded(x, self._process, x)
+                while self._callbacks:
+                    self._callbacks.popleft()()
+        except Exception:
+            logging.exception("Sync loop died")
+        finally:
+            self._shutdown()
+
+    def _guarded(self, peer, f, *args):
+        try:
+            f(*args)
+        except Exception:
+            logging.exception("%s died", peer)
+            peer.close()
+
+    def _connect(self):
+        for address, state in self._connectAddresses.items():
+            if not state or state in self.connections:
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            err = sock.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS):
+                logging.debug("Failed to connect to %s: errno %d", address, err)
+                sock.close()
+                continue
+            self._connectAddresses[address] = False
+            self._peers.add(SyncConnection(self._db, self.name, sock, address, self.compress))
+
+    def _accept(self):
+        try:
+            sock, addr = self._sock.accept()
+        except socket.error:
+            return
+        logging.debug("Connection established from %s", addr)
+        self._peers.add(SyncConnection(self._db, self.name, sock, compress=self.compress))
+
+    def _on_writable(self, peer):
+        if peer.stage == SyncConnection.CONNECTING:
+            if peer.connected():
+                logging.debug("Connection established to %s", peer.connect_address)
+        elif peer.flush():
+            peer.push()
+
+    def _expire(self, peer):
+        if peer.stage == SyncConnection.RUNNING:
+            logging.getLogger('syncer').warning("Peer %s is blocking on writes (too slow?). Disconnecting.", peer)
+        else:
+            logging.debug("Handshake timed out with %s", peer)
+        peer.close()
+
+    def _process(self, peer):
+        peer.process(lambda job, then, rollback: self._submit(peer, job, then, rollback))
+
+    def _submit(self, peer, job, then, rollback):
+        def done(result, exc):
+            if exc:
+                peer.busy = False
+                if peer.stage == SyncConnection.RUNNING:
+                    logging.error("%s died", peer, exc_info=exc)
+                else:
+                    logging.error("Handshake failed with %s", peer, exc_info=exc)
+                peer.close()
+            elif not peer.closed():
+                was_running = peer.stage == SyncConnection.RUNNING
+                then(result)
+                if not was_running and peer.stage == SyncConnection.RUNNING:
+                    self._established(peer)
+                self._guarded(peer, self._process, peer)
+        self._writer.submit(job, done, rollback)
+
+    def _established(self, peer):
+        if peer.connect_address in self._connectAddresses:
+            self._connectAddresses[peer.connect_address] = peer.peername
+        if peer.peername in self.connections:
+            logging.info('%s already connected. Dropping.', peer.peername)
+            peer.close()
+            return
+        logging.info("connection established with %s", peer.peername)
+        self.connections[peer.peername] = peer
+        peer.push()
+
+    def _push(self):
+        # Reads through the read pool, so neither writers nor readers wait on slow peers
+        for peer in self.connections.values():
+            self._guarded(peer, peer.push)
+
+    def _drop_closed(self):
+        for peer in [peer for peer in self._peers if peer.closed()]:
+            self._peers.discard(peer)
+            if self.connections.get(peer.peername) is peer:
+                del self.connections[peer.peername]
+                logging.info('%s disconnected', peer.peername)
+                peer.log_compression_stats()
+            if self._connectAddresses.get(peer.connect_address) is False:
+                self._connectAddresses[peer.connect_address] = True
+
+    def _shutdown(self):
+        for peer in self._peers:
+            peer.close()
+        self._peers.clear()
+        self.connections.clear()
+        self._sock.close()
+        self._writer.close()
 
     def close(self):
         self.running = False
-        for connection in self.connections.itervalues():
-            connection.close()
-        super(Syncer, self).close()
+        self._call_soon(lambda: None)
+        self.wait()
 
     def wait(self):
-        super(Syncer, self).wait()
-        try:
-            self._pusher.wait()
-        except:
-            pass
+        for thread in (self._loop, self._notifier):
+            try:
+                thread.wait()
+            except:
+                pass
+        self._writer.join()
+        if self._waker is not None:
+            os.close(self._waker)
+            os.close(self._wakeup)
+            self._waker = self._wakeup = None
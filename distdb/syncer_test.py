@@ -1,15 +1,19 @@
 from nose.tools import *
 from time import time
 from mock import patch
+from select import select
 import socket
+from cStringIO import StringIO
+from Queue import Queue
 
 from distdb.serialize import *
 from distdb.syncer import *
-from distdb import DB, Object, sync_pb2
+from distdb import DB, Object, Transaction, snapshot, sync_pb2
 
 from .obj import TimedValues
 
-from thread_io import spawn, listen
+from thread_io import connect, listen, sleep, spawn
+from threading import active_count
 
 HOURS = 3600
 
@@ -18,11 +22,6 @@ def future(n, unit):
     return time() + n * unit
 
 
-def run_parallel(*jobs):
-    running = [spawn(x) for x in jobs]
-    return [x.wait() for x in running]
-
-
 def socket_pair():
     s = listen(('', 0), backlog=1)
     try:
@@ -46,49 +45,77 @@ def wait_for(condition, timeout=1):
         sleep(interval)
 
 
+def inline(db):
+    '''Applies jobs of SyncConnection.process() right away, instead of in a SyncWriter'''
+    def submit(job, then, rollback):
+        with db.lock, db.transaction(Transaction.IMMEDIATE) as t:
+            result = job(t)
+        then(result)
+    return submit
+
+
+def pump(conns, condition, timeout=1):
+    '''Drives conns the way the Syncer loop does, until condition() holds'''
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            raise Exception("Timeout in pump(%s)" % condition)
+        for conn in conns:
+            if not conn.closed():
+                conn.flush()
+        readable, _, _ = select([conn for conn in conns if conn.wants_read()], (), (), 0.01)
+        for conn in readable:
+            conn.receive()
+        for conn in conns:
+            while conn.process(inline(conn.db)):
+                pass
+
+
+def read_until_closed(sock, timeout=1):
+    '''Returns the messages received on a plain socket, until closed by the other end'''
+    sock.settimeout(timeout)
+    queue = MessageQueue(MESSAGE_DECODER)
+    data = sock.recv(1024)
+    while data:
+        queue(data)
+        data = sock.recv(1024)
+    return queue.clear()
+
+
 class TestSyncConnection():
     def setup(self):
         self.obj = Object(u'some_obj', {u'apa': TimedValues(u'banan', t=0)})
 
-        self.db1 = DB(':memory:')
-        self.db2 = DB(':memory:')
+        self.db1 = self.make_db()
+        self.db2 = self.make_db()
 
         self.connect()
 
-    def connect(self):
-        c1, c2 = socket_pair()
-        self.syncer1 = SyncConnection(self.db1, 'syncer1', c1, None)
-        self.syncer2 = SyncConnection(self.db2, 'syncer2', c2, None)
+    def make_db(self):
+        return DB(':memory:')
 
-    def wait_for_equal(self, id):
-        wait_for(lambda: self.db1[id] == self.db2[id])
+    def connect(self, compress=True):
+        c1, c2 = socket_pair()
+        self.syncer1 = SyncConnection(self.db1, 'syncer1', c1)
+        self.syncer2 = SyncConnection(self.db2, 'syncer2', c2, compress=compress)
 
     def assert_equal(self, id):
         assert_equal(self.db1[id], self.db2[id])
 
     def handshake(self):
-        return run_parallel(
-            self.syncer1.handshake,
-            self.syncer2.handshake,
-        )
+        running = lambda: self.syncer1.stage == self.syncer2.stage == SyncConnection.RUNNING
+        pump([self.syncer1, self.syncer2], running)
 
-    def test_setup(self):
-        res1, res2 = self.handshake()
-        assert_is(res1, self.syncer1)
-        assert_is(res2, self.syncer2)
-
-    @patch('distdb.syncer.HANDSHAKE_TIMEOUT', 0.1)
-    def test_handshake_timeout(self):
-        c1, c2 = socket_pair()
-        self.syncer1 = SyncConnection(self.db1, 'syncer1', c1, None)
-        assert_is_none(self.syncer1.handshake())
+    def step(self, src, dst):
+        '''Pushes changes from src, and applies them in dst'''
+        res = src.push()
+        pump([src, dst], lambda: dst._last_serial_received >= src._last_serial_sent)
+        return res
 
-    @patch('distdb.syncer.HANDSHAKE_TIMEOUT', 0.1)
-    def test_handshake_timeout2(self):
-        c1, c2 = socket_pair()
-        self.syncer1 = SyncConnection(self.db1, 'syncer1', c1, None)
-        MESSAGE_ENCODER(c2.send)('hello', sync_pb2.Hello(name="apa"))
-        assert_is_none(self.syncer1.handshake())
+    def test_setup(self):
+        self.handshake()
+        assert_equal(self.syncer1.peername, 'syncer2')
+        assert_equal(self.syncer2.peername, 'syncer1')
 
     def test_context_manager(self):
         assert_false(self.syncer1.closed())
@@ -98,8 +125,8 @@ class TestSyncConnection():
 
         assert_true(self.syncer1.closed())
         assert_is_none(self.syncer1._sendmsg())
-        assert_false(self.syncer1.read_chunk())
-        assert_is_none(self.syncer1.read_msg())
+        assert_false(self.syncer1.wants_read())
+        assert_false(self.syncer1.process(inline(self.db1)))
 
     def test_simple_step(self):
         self.handshake()
@@ -110,8 +137,40 @@ class TestSyncConnection():
         assert_in(u'apa', self.db1[self.obj.id])
         assert_not_in(u'apa', self.db2[self.obj.id])
 
-        self.syncer1.db_push()
-        self.syncer2._step()
+        self.step(self.syncer1, self.syncer2)
+        self.assert_equal(self.obj.id)
+
+    def test_adaptive_push_batch(self):
+        self.handshake()
+        changes = self.syncer1._changes
+        assert_equal(changes.limit, 1024)
+
+        self.syncer1._adapt_batch_size(1024, 0)
+        assert_equal(changes.limit, 2048)
+        self.syncer1._adapt_batch_size(10, 0)
+        assert_equal(changes.limit, 2048)
+        for _ in range(10):
+            self.syncer1._adapt_batch_size(changes.limit, WRITE_TIMEOUT)
+        assert_equal(changes.limit, PUSH_BATCH_MIN)
+
+    def test_snapshot_handshake(self):
+        with self.db1.transaction() as t:
+            t.update(self.obj)
+        buf = StringIO()
+        serial = snapshot.export(self.db1, buf, 'syncer1')
+        snapshot.restore(self.db2, StringIO(buf.getvalue()))
+
+        # Even without sync state, syncer1 should skip what's in the snapshot
+        self.db2.set_sync_state('syncer1', 0)
+        self.handshake()
+        assert_equal(self.syncer1._last_serial_sent, serial)
+        # Neither is the snapshot pushed back to its source, only later changes
+        assert_equal(self.syncer2._last_serial_sent, serial)
+        self.assert_equal(self.obj.id)
+
+        with self.db2.transaction() as t:
+            t.update_attr(self.obj.id, u'new', TimedValues(u'value', t=1))
+        assert_equal(self.step(self.syncer2, self.syncer1), 1)
         self.assert_equal(self.obj.id)
 
     def test_future_change(self):
@@ -124,13 +183,26 @@ class TestSyncConnection():
         assert_in(u'apa', self.db1[self.obj.id])
         assert_not_in(u'apa', self.db2[self.obj.id])
 
-        self.syncer1.db_push()
-        self.syncer2._step()
+        self.step(self.syncer1, self.syncer2)
         self.assert_equal(self.obj.id)
 
     @raises(TypeError)
     def test_unknown_message(self):
-        self.syncer1._process_updates(["This is not a message"])
+        with self.db1.transaction() as t:
+            self.syncer1._process_updates(["This is not a message"], t)
+
+    def test_unexpected_handshake(self):
+        hello = ('hello', sync_pb2.Hello(name='other'))
+        checkpoint = ('checkpoint', sync_pb2.Checkpoint(serial=1))
+        for msgs, stage in (([checkpoint], SyncConnection.HELLO), ([hello, checkpoint], SyncConnection.SETUP)):
+            c1, c2 = socket_pair()
+            conn = SyncConnection(self.db1, 'syncer1', c1)
+            for field, msg in msgs:
+                MESSAGE_ENCODER(c2.sendall)(field, msg)
+            # Dropped in the stage expecting something else
+            pump([conn], conn.closed)
+            assert_equal(conn.stage, stage)
+            c2.close()
 
     def test_simple_sync(self):
         self.handshake()
@@ -141,11 +213,13 @@ class TestSyncConnection():
         assert_in(u'apa', self.db1[self.obj.id])
         assert_not_in(u'apa', self.db2[self.obj.id])
 
-        # Let syncer1 push update to syncer2
-        self.syncer1.db_push()
+        # Let syncer1 push update to syncer2, and hang up
+        self.syncer1.push()
+        pump([self.syncer1], lambda: self.syncer1.flush())
         self.syncer1.close()
-        self.syncer2.run()
 
+        # What was received before the end of stream is still applied
+        pump([self.syncer2], self.syncer2.closed)
         self.assert_equal(self.obj.id)
 
     def test_attribute_deletion(self):
@@ -154,16 +228,14 @@ class TestSyncConnection():
         self.obj[u'deleted'] = TimedValues([u"Something"], t=445)
         with self.db1.transaction() as t:
             t.update(self.obj)
-        self.syncer1.db_push()
-        self.syncer2._step()
+        self.step(self.syncer1, self.syncer2)
 
         self.assert_equal(self.obj.id)
 
         del self.obj[u'deleted']
         with self.db1.transaction() as t:
             t.update(self.obj)
-        self.syncer1.db_push()
-        self.syncer2._step()
+        self.step(self.syncer1, self.syncer2)
 
         self.assert_equal(self.obj.id)
 
@@ -172,15 +244,13 @@ class TestSyncConnection():
 
         with self.db1.transaction() as t:
             t.update(self.obj)
-        self.syncer1.db_push()
-        self.syncer2._step()
+        self.step(self.syncer1, self.syncer2)
 
         self.assert_equal(self.obj.id)
 
         with self.db1.transaction() as t:
             t.delete(self.obj)
-        self.syncer1.db_push()
-        self.syncer2._step()
+        self.step(self.syncer1, self.syncer2)
 
         self.assert_equal(self.obj.id)
 
@@ -190,122 +260,64 @@ class TestSyncConnection():
             t.update(self.obj)
 
         # Let syncer1 push update to syncer2
-        self.syncer1.db_push()
-        self.syncer2._step()
+        self.step(self.syncer1, self.syncer2)
         assert_true(self.syncer2._echo_prevention)
 
         # Verify syncer2 does not echo
-        self.syncer2.db_push()
+        assert_equal(self.syncer2.push(), 0)
         assert_false(self.syncer2._echo_prevention)
 
-        # Syncer1 should get nothing
-        self.syncer2.shutdown()
-        assert_false([x for x in self.syncer1.read_chunk() if isinstance(x, sync_pb2.Update)])
+    def test_compression(self):
+        self.handshake()
+        with self.db1.transaction() as t:
+            t.update_many([Object(u'tree:tiger:%d' % i, {u'directory': TimedValues(u'dir:some/long/path', t=1)})
+                           for i in range(100)])
+        self.step(self.syncer1, self.syncer2)
+        self.assert_equal(u'tree:tiger:99')
+
+        sent, compressed, _ = self.syncer1.compression_stats()['sent']
+        assert_less(compressed * 4, sent)
+        assert_equal(self.syncer2.compression_stats()['received'][:2], (sent, compressed))
+
+    def test_compression_fallback(self):
+        # Like a peer from before compression
+        self.syncer1.close()
+        self.syncer2.close()
+        self.connect(compress=False)
+        self.handshake()
+        assert_is_none(self.syncer1.compression_stats())
+        assert_is_none(self.syncer2.compression_stats())
+
+        with self.db1.transaction() as t:
+            t.update(self.obj)
+        self.step(self.syncer1, self.syncer2)
+        self.assert_equal(self.obj.id)
 
     def test_db_reset(self):
         self.test_simple_step()
         self.syncer1.close()
         self.syncer2.close()
 
-        self.db1 = DB(':memory:')
+        self.db1 = self.make_db()
         self.connect()
         self.handshake()
         assert_equal(self.syncer1._last_serial_received, 0)
         assert_equal(self.syncer2._last_serial_sent, 0)
         assert_not_in(u'apa', self.db1[self.obj.id])
 
-        self.syncer2.db_push()
-        self.syncer1._step()
+        self.step(self.syncer2, self.syncer1)
         assert_in(u'apa', self.db1[self.obj.id])
         self.assert_equal(self.obj.id)
 
 
-class TestP2P():
-    def setup(self):
-        self.s = P2P(0, self.spawn, connect_interval=0.05)
-
-    def spawn(self, sock, set_session):
-        msg = sock.recv(1024)
-        try:
-            while msg and len(msg):
-                if set_session(msg, True):
-                    sock.send(msg)
-                else:
-                    sock.send("")
-                    sock.shutdown(socket.SHUT_RDWR)
-                    break
-                msg = sock.recv(1024)
-        except socket.error:
-            pass
-
-    def test_setup(self):
-        assert_is_not_none(self.s.local_addr())
-
-    def test_connect(self):
-        s = connect(self.s.local_addr())
-        assert_is_not_none(s)
-        s.send("apa")
-        assert_equal(s.recv(1024), "apa")
-        s.close()
-
-    def test_connected(self):
-        s = connect(self.s.local_addr())
-        s.send("apa")
-        wait_for(lambda: "apa" in self.s.connections)
-        s.close()
-
-    def test_sessionTermination(self):
-        s = connect(self.s.local_addr())
-        s.send("apa")
-        wait_for(lambda: "apa" in self.s.connections)
-        s.shutdown(socket.SHUT_WR)
-        s.close()
-        wait_for(lambda: "apa" not in self.s.connections)
-
-    def test_already_connected(self):
-        s = connect(self.s.local_addr())
-        s.send("apa")
-        wait_for(lambda: "apa" in self.s.connections)
-
-        s1 = connect(self.s.local_addr())
-        s1.send("apa")
-        assert_equal(s1.recv(1024), "")
-
-    def test_connector(self):
-        s = listen(('', 0))
-        s.listen(3)
-        self.s.add_address(s.getsockname())
-        s.settimeout(0.4)
-        client, _ = s.accept()
-        uuid = "apa"
-        client.send(uuid)
-        wait_for(lambda: uuid in self.s._connectAddresses.values())
-
-    def test_connector_does_not_reconnect(self):
-        s = listen(('', 0))
-        s.listen(3)
-        self.s.add_address(s.getsockname())
-        s.settimeout(0.2)
-        client, _ = s.accept()
-
-        assert_raises(socket.error, s.accept)
-
-        uuid = "apa"
-        client.send(uuid)
-        assert_raises(socket.error, s.accept)
-
-        client.shutdown(socket.SHUT_RDWR)
-        client, _ = s.accept()
-
-    def test_close(self):
-        self.s.close()
-
-
 class TestSyncServer():
     def setup(self):
         self.db = DB(':memory:')
         self.s = Syncer(self.db, 'Syncer1', 0, db_poll_interval=0.1, connect_interval=0.2)
 
+    def teardown(self):
+        self.s.close()
+
     def wait_for_connection(self, other):
         wait_for(lambda: str(self.s.name) in other.connections)
         wait_for(lambda: str(other.name) in self.s.connections)
@@ -313,7 +325,7 @@ class TestSyncServer():
     def connect(self, name="Syncer2"):
         db = DB(':memory:')
         s = connect(self.s.local_addr())
-        return SyncConnection(db, name, s, None)
+        return SyncConnection(db, name, s)
 
     def test_simple_sync(self):
         db2 = DB(':memory:')
@@ -328,15 +340,92 @@ class TestSyncServer():
         with db2.transaction() as t:
             t.update(Object('apa', init={u"test": TimedValues(u"7")}))
         wait_for(lambda: self.db['apa']['test'] == TimedValues(u"7"))
+        wait_for(lambda: self.s.compression_stats().get('Syncer2'))
 
     def test_disconnect(self):
         s = self.connect()
-        s.handshake()
+        pump([s], lambda: s.stage == SyncConnection.RUNNING)
         self.s.close()
-        s.run()
+        pump([s], s.closed)
+
+    def test_many_peers(self):
+        threads = active_count()
+        peers = [self.connect("Peer%d" % i) for i in range(20)]
+        # Keeps flushing the peers, whose last handshake message may still be buffered
+        pump(peers, lambda: len(self.s.connections) == len(peers))
+        # All peers are served by the same threads
+        assert_equal(active_count(), threads)
+
+        with self.db.transaction() as t:
+            t.update(Object('apa', init={u"test": TimedValues(u"4", t=5)}))
+        pump(peers, lambda: all('test' in peer.db['apa'] for peer in peers))
+
+        peers[0]._sendmsg(['update', sync_pb2.Update(obj=u'bepa', key=u'test', tstamp=5, values=[u'5'])])
+        pump(peers[:1], lambda: 'test' in self.db['bepa'])
+        peers[0].close()
+        wait_for(lambda: "Peer0" not in self.s.connections)
 
     @patch('distdb.syncer.HANDSHAKE_TIMEOUT', 0.1)
     def test_handshake_timeout(self):
-        s = self.connect()
-        assert_equal(s.read_msg(), sync_pb2.Hello(name="Syncer1"))
-        assert_equal(s.read_msg(), None)
+        s = connect(self.s.local_addr())
+        assert_equal(read_until_closed(s), [sync_pb2.Hello(name="Syncer1", zlib_stream=True)])
+
+    @patch('distdb.syncer.HANDSHAKE_TIMEOUT', 0.1)
+    def test_handshake_timeout2(self):
+        s = connect(self.s.local_addr())
+        MESSAGE_ENCODER(s.sendall)('hello', sync_pb2.Hello(name="apa"))
+        msgs = read_until_closed(s)
+        assert_equal(msgs[0], sync_pb2.Hello(name="Syncer1", zlib_stream=True))
+        assert_is_instance(msgs[1], sync_pb2.Setup)
+
+
+def test_sync_writer():
+    db = DB(':memory:')
+    done = Queue()
+    writer = SyncWriter(db, lambda callback, result, exc: done.put((callback, result, exc)))
+
+    def fail(t):
+        raise ValueError("Broken")
+
+    writer.submit(lambda t: t.update_attr(u'o1', u'k', TimedValues(u'v', t=1)), 1)
+    writer.submit(fail, 2)
+    writer.submit(lambda t: t.update_attr(u'o2', u'k', TimedValues(u'v', t=1)) and 'ok', 3)
+    writer.start()
+    results = dict((callback, (result, exc)) for callback, result, exc in (done.get(timeout=5) for _ in range(3)))
+    writer.close()
+    writer.join()
+
+    # The failing job is retried alone, and the others are still committed
+    assert_is_none(results[1][1])
+    assert_is(results[2][1][0], ValueError)
+    assert_equal(results[3], ('ok', None))
+    assert_equal(db[u'o1'][u'k'], TimedValues(u'v'))
+    assert_equal(db[u'o2'][u'k'], TimedValues(u'v'))
+
+
+def test_sync_writer_retry():
+    db = DB(':memory:')
+    c1, _ = socket_pair()
+    conn = SyncConnection(db, 'syncer1', c1)
+    conn.peername = 'peer'
+    done = Queue()
+    writer = SyncWriter(db, lambda callback, result, exc: done.put((callback, result, exc)))
+
+    def fail(t):
+        raise ValueError("Broken")
+
+    chunk = [sync_pb2.Update(obj=u'o', key=u'k', tstamp=1, values=[u'v']), sync_pb2.Checkpoint(serial=5)]
+    writer.submit(lambda t: conn._process_updates(chunk, t), 1, conn._rolled_back)
+    writer.submit(fail, 2)
+    writer.start()
+    results = dict((callback, (result, exc)) for callback, result, exc in (done.get(timeout=5) for _ in range(2)))
+    writer.close()
+    writer.join()
+
+    # The retry writes the checkpoint, and only its own serials are kept from echoing
+    processed, exc = results[1]
+    assert_is_none(exc)
+    conn._received(processed)
+    assert_equal(conn._last_serial_received, 5)
+    assert_equal(db.get_sync_state('peer'), {"last_received": 5})
+    assert_equal(conn._echo_prevention, set([db.last_serial()]))